@@ -1,13 +1,16 @@
 # coding=utf-8
 
+import importlib.util
 import logging
 import mimetypes
+import signal
+import threading
 import time
 from abc import ABC
-from typing import Optional
+from contextlib import contextmanager
+from typing import Optional, Dict, List, Tuple
 
 import ehforwarderbot  # lgtm [py/import-and-import-from]
-from PIL import Image, WebPImagePlugin
 from ehforwarderbot import Channel, coordinator
 from ehforwarderbot import utils as efb_utils
 from ehforwarderbot.channel import MasterChannel
@@ -23,12 +26,25 @@ from ruamel.yaml import YAML
 
 from .chat_object_cache import ChatObjectCacheManager
 from .db import DatabaseManager
+from .diagnostics import DiagnosticsManager
+from .dispatcher import InboundDispatcher
 from .master_message import MasterMessageProcessor
+from .metrics import MetricsManager
+from .msg_id_cache import MessageIdCacheManager
+from .retention import RetentionManager
 from .server import ServerManager
 from .slave_message import SlaveMessageProcessor
+from .tracing import TraceManager
 from . import utils as epm_utils
 from .__version__ import __version__
 
+RESTART_REQUIRED_CONFIG = frozenset({
+    "host", "port", "db_synchronous", "db_cache_size", "db_mmap_size", "db_temp_store", "chat_snapshot",
+    "chat_warmup_workers", "dispatch_workers", "dispatch_queue_size", "ack_queue_size", "config_watch_interval",
+    "metrics_host", "metrics_port", "trace_exporter", "trace_file", "trace_file_max_bytes", "trace_file_backups",
+})
+"""Settings only applied on restart, all others are applied when the configuration is reloaded."""
+
 
 class ParaboxChannel(MasterChannel):
     # Meta Info
@@ -50,10 +66,12 @@ class ParaboxChannel(MasterChannel):
 
     def __init__(self, instance_id: InstanceID = None):
         super().__init__(instance_id)
+        self.started_at = time.perf_counter()
+        self.startup_times: Dict[str, float] = dict()
+        """Seconds taken by each phase of startup."""
 
-        # Check PIL support for WebP
-        Image.init()
-        if 'WEBP' not in Image.ID or not getattr(WebPImagePlugin, "SUPPORTED", None):
+        # Check PIL support for WebP without loading Pillow, which is fully checked in warm up.
+        if importlib.util.find_spec("PIL._webp") is None:
             raise EFBException(self._("WebP support of Pillow is required.\n"
                                       "Please refer to Pillow Documentation for instructions.\n"
                                       "https://pillow.readthedocs.io/"))
@@ -64,19 +82,70 @@ class ParaboxChannel(MasterChannel):
         logger.setLevel(logging.WARNING)
 
         # Load configs
-        self.load_config()
+        with self.startup_phase("config"):
+            self.config = self.load_config()
+            self.metrics: MetricsManager = MetricsManager(self)
+            self.tracing: TraceManager = TraceManager(self)
+            self.diagnostics: DiagnosticsManager = DiagnosticsManager(self)
 
         # Initialize managers
-        self.db: DatabaseManager = DatabaseManager(self)
-        self.chat_manager: ChatObjectCacheManager = ChatObjectCacheManager(self)
-        self.slave_messages: SlaveMessageProcessor = SlaveMessageProcessor(self)
-        self.master_messages: MasterMessageProcessor = MasterMessageProcessor(self)
-        self.server_manager: ServerManager = ServerManager(self)
+        with self.startup_phase("database"):
+            self.db: DatabaseManager = DatabaseManager(self)
+        with self.startup_phase("retention"):
+            self.retention: RetentionManager = RetentionManager(self)
+        with self.startup_phase("chat_cache"):
+            self.chat_manager: ChatObjectCacheManager = ChatObjectCacheManager(self)
+        with self.startup_phase("msg_ids"):
+            self.msg_ids: MessageIdCacheManager = MessageIdCacheManager(self)
+        with self.startup_phase("processors"):
+            self.slave_messages: SlaveMessageProcessor = SlaveMessageProcessor(self)
+            self.master_messages: MasterMessageProcessor = MasterMessageProcessor(self)
+            self.dispatcher: InboundDispatcher = InboundDispatcher(self)
+        with self.startup_phase("mimetypes"):
+            # Load predefined MIME types before any thread looks them up, as loading is not thread safe.
+            mimetypes.init(files=["mimetypes"])
+        with self.startup_phase("server"):
+            self.server_manager: ServerManager = ServerManager(self)
+
+        # Reload configuration on SIGHUP, or when the file is changed if enabled.
+        self.config_lock = threading.Lock()
+        if hasattr(signal, "SIGHUP") and threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGHUP, lambda *_: threading.Thread(
+                target=self.try_reload_config, name="EPMConfigReload", daemon=True).start())
+        if self.config.get("config_watch_interval", 0):
+            threading.Thread(target=self._config_watch_loop, name="EPMConfigWatch", daemon=True).start()
+
+        threading.Thread(target=self.warm_up, name="EPMWarmUp", daemon=True).start()
+        self.logger.info("%s started in %.3fs (%s).", self.channel_name, time.perf_counter() - self.started_at,
+                         ", ".join(f"{phase}: {duration:.3f}s" for phase, duration in self.startup_times.items()))
+
+    @contextmanager
+    def startup_phase(self, phase: str):
+        """Record the time taken by a phase of startup in :attr:`startup_times`."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.startup_times[phase] = time.perf_counter() - start
+
+    def warm_up(self):
+        """Load modules and data not needed to accept connections, after startup."""
+        with self.startup_phase("warm_up_pillow"):
+            from PIL import Image, WebPImagePlugin
+            Image.init()
+            if 'WEBP' not in Image.ID or not getattr(WebPImagePlugin, "SUPPORTED", None):
+                self.logger.error("WebP support of Pillow is required, but it failed to load. "
+                                  "Please refer to Pillow Documentation for instructions. "
+                                  "https://pillow.readthedocs.io/")
+        self.logger.debug("Warm up finished (Pillow: %.3fs).", self.startup_times["warm_up_pillow"])
 
-        # Load predefined MIME types
-        mimetypes.init(files=["mimetypes"])
+    def load_config(self) -> dict:
+        """
+        Load and verify the configuration file.
 
-    def load_config(self):
+        Returns:
+            The configuration, not yet applied.
+        """
         config_path = efb_utils.get_config_path(self.channel_id)
         if not config_path.exists():
             raise FileNotFoundError("Config File does not exist. ({path})")
@@ -90,7 +159,82 @@ class ParaboxChannel(MasterChannel):
                 raise ValueError('Websocket server port must be a number')
             if not isinstance(data.get('token', None), str):
                 raise ValueError('Websocket server token must be a string')
-            self.config = data.copy()
+            return data.copy()
+
+    def reload_config(self) -> Tuple[List[str], List[str]]:
+        """
+        Reload the configuration file and apply tunables to running managers.
+
+        The new configuration is verified in full before anything is
+        applied. Settings in :data:`RESTART_REQUIRED_CONFIG` keep their
+        running values until restart.
+
+        Returns:
+            Changed settings that are applied, and changed settings that
+            need a restart.
+
+        Raises:
+            Exception: If the new configuration cannot be loaded or is
+                invalid, nothing is applied.
+        """
+        with self.config_lock:
+            old = self.config
+            config = self.load_config()
+            changed = sorted(key for key in old.keys() | config.keys() if old.get(key) != config.get(key))
+            restart = [key for key in changed if key in RESTART_REQUIRED_CONFIG]
+            applied = [key for key in changed if key not in RESTART_REQUIRED_CONFIG]
+            for key in applied:
+                if not self._same_kind(old.get(key), config.get(key)):
+                    raise ValueError(f"Setting {key} cannot change from {old.get(key)!r} to {config.get(key)!r}")
+            for key in restart:
+                if key in old:
+                    config[key] = old[key]
+                else:
+                    config.pop(key, None)
+            self.config = config
+            for manager in (self.db, self.retention, self.chat_manager, self.msg_ids, self.slave_messages,
+                            self.master_messages, self.dispatcher, self.server_manager, self.tracing,
+                            self.diagnostics):
+                manager.apply_config(config)
+        self.logger.info("Configuration reloaded, applied: %s, need restart: %s.",
+                         ", ".join(applied) or "none", ", ".join(restart) or "none")
+        return applied, restart
+
+    @staticmethod
+    def _same_kind(old, new) -> bool:
+        """Check if a setting keeps its kind of value, so that it can be applied without failing."""
+        if old is None or new is None:
+            return True
+        if isinstance(old, bool) or isinstance(new, bool):
+            return isinstance(old, bool) and isinstance(new, bool)
+        if isinstance(old, (int, float)) or isinstance(new, (int, float)):
+            return isinstance(old, (int, float)) and isinstance(new, (int, float))
+        return isinstance(new, type(old)) or isinstance(old, type(new))
+
+    def try_reload_config(self):
+        """Reload the configuration, logging any error, see :meth:`reload_config`."""
+        # noinspection PyBroadException
+        try:
+            self.reload_config()
+        except Exception:
+            self.logger.exception("Failed to reload configuration, the running configuration is kept.")
+
+    def _config_watch_loop(self):
+        config_path = efb_utils.get_config_path(self.channel_id)
+        loaded_mtime = seen_mtime = config_path.stat().st_mtime_ns
+        while True:
+            time.sleep(self.config["config_watch_interval"])
+            try:
+                mtime = config_path.stat().st_mtime_ns
+            except FileNotFoundError:
+                continue
+            if mtime != seen_mtime:
+                # Wait for the file to settle, so that it is not read while being written.
+                seen_mtime = mtime
+                continue
+            if mtime != loaded_mtime:
+                loaded_mtime = mtime
+                self.try_reload_config()
 
     def send_message(self, msg: EFBMessage) -> EFBMessage:
         return self.slave_messages.send_message(msg)
@@ -105,6 +249,27 @@ class ParaboxChannel(MasterChannel):
         self.server_manager.send_status(status)
 
     def stop_polling(self):
+        """
+        Stop gracefully within ``shutdown_timeout`` seconds.
+
+        Messages from Parabox already queued are sent to slave channels, and
+        messages and acks queued for Parabox are sent to the client, until
+        the deadline. Messages not confirmed by the client are then stored
+        to be restored on the next start, and all pending database writes
+        are flushed.
+        """
         self.logger.debug("Gracefully stopping %s (%s).", self.channel_name, self.channel_id)
-        self.server_manager.graceful_stop()
-        pass
\ No newline at end of file
+        start = time.monotonic()
+        deadline = start + self.config.get("shutdown_timeout", 10)
+        if not self.dispatcher.stop(deadline):
+            self.logger.warning("Messages from Parabox still being sent are abandoned at shutdown.")
+        self.server_manager.graceful_stop(deadline)
+        pending = self.slave_messages.save_pending()
+        self.tracing.stop()
+        self.diagnostics.stop()
+        self.retention.stop()
+        self.msg_ids.stop()
+        self.chat_manager.stop()
+        self.db.stop_worker()
+        self.logger.info("%s stopped in %.2fs, %s messages not confirmed by the client are kept.",
+                         self.channel_name, time.monotonic() - start, pending)
\ No newline at end of file
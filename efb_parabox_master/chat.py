@@ -1,5 +1,7 @@
 import copy
+import json
 import pickle
+import sys
 import time
 from abc import ABC
 from contextlib import suppress
@@ -8,7 +10,8 @@ from typing import TYPE_CHECKING, TypeVar, Dict, Any, Optional, List, Union, Pat
 
 from ehforwarderbot import coordinator, Middleware
 from ehforwarderbot.channel import SlaveChannel
-from ehforwarderbot.chat import BaseChat, Chat, PrivateChat, ChatNotificationState, SystemChat, GroupChat
+from ehforwarderbot.chat import BaseChat, Chat, PrivateChat, ChatNotificationState, SystemChat, GroupChat, \
+    ChatMember, SelfChatMember
 from ehforwarderbot.types import ModuleID, ChatID
 
 from .constants import Emoji
@@ -82,11 +85,9 @@ class EPMChatMixin(EPMBaseChatMixin, Chat, ABC):
             Other: <Python Dictionary String>
 
         If a string is provided instead of compiled regular expression pattern,
-        simple string match is used instead.
-
-        String match is about 5x faster than re.search when there’s no
-        significance of regex used.
-        Ref: https://etm.1a23.studio/pull/77
+        it is looked for in each of the values instead, case insensitive,
+        without building the string. To find chats by string among many,
+        use :meth:`.ChatObjectCacheManager.search`, which uses an index.
 
         Args:
             pattern: Regex pattern or string to look for
@@ -96,6 +97,11 @@ class EPMChatMixin(EPMBaseChatMixin, Chat, ABC):
         """
         if pattern is None:
             return True
+        if isinstance(pattern, str):
+            pattern = pattern.casefold()
+            return any(pattern in str(i).casefold() for i in (
+                self.module_name, self.module_id, self.name, self.alias, self.uid, self.chat_type_name,
+                self.description, self.notification.name, self.vendor_specific))
         mode = []
         mode_str = ', '.join(mode)
         entry_string = f"Channel: {self.module_name}\n" \
@@ -108,10 +114,7 @@ class EPMChatMixin(EPMBaseChatMixin, Chat, ABC):
                        f"Description: {self.description}\n" \
                        f"Notification: {self.notification.name}\n" \
                        f"Other: {self.vendor_specific}"
-        if isinstance(pattern, str):
-            return pattern.lower() in entry_string.lower()
-        else:  # pattern is re.Pattern
-            return bool(pattern.search(entry_string))
+        return bool(pattern.search(entry_string))
 
     @property
     def full_name(self) -> str:
@@ -142,17 +145,37 @@ class EPMChatMixin(EPMBaseChatMixin, Chat, ABC):
                f"{self.display_name}"
 
     def update_to_db(self):
-        """Update this object to database."""
+        """Update this object to database.
+
+        Members are stored as rows of their own, and are not a part of the
+        chat record.
+        """
         self.db.set_slave_chat_info(self)
+        members = [i for i in self.members if not isinstance(i, SelfChatMember)]
+        if members:
+            self.db.set_slave_chat_members(self, members)
 
     @property
-    def pickle(self) -> bytes:
-        return pickle.dumps(self)
+    def record(self) -> bytes:
+        """Compact record of this chat for database storage, see :func:`chat_record`."""
+        return chat_record(self)
+
+    def get_member(self, member_id: ChatID) -> ChatMember:
+        """Find a member of chat by its ID, loading from database if not in memory.
+
+        Raises:
+            KeyError: when the ID provided is not found.
+        """
+        with suppress(KeyError):
+            return super().get_member(member_id)
+        m_log = self.db.get_slave_chat_info(self.module_id, member_id, self.uid)
+        if m_log is None or not m_log.record:
+            raise KeyError
+        return load_member(m_log.record, self)
 
     def remove_from_db(self):
         super().remove_from_db()
-        for i in self.members:
-            self.db.delete_slave_chat_info(self.module_id, i.uid, self.uid)
+        self.db.delete_slave_chat_members(self.module_id, self.uid)
 
 
 class EPMPrivateChat(EPMChatMixin, PrivateChat):
@@ -243,6 +266,142 @@ def convert_chat(db: 'DatabaseManager', chat: Chat) -> EPMChatType:
 
 
 def unpickle(data: bytes, db: 'DatabaseManager') -> EPMChatType:
+    """Load a chat from a pickle stored by earlier versions."""
     obj = pickle.loads(data)
     obj.db = db
     return obj
+
+
+RECORD_VERSION = 1
+"""Version of the chat record format, stored as the first field of a record."""
+
+_chat_classes = {cls.chat_type_name: cls for cls in (EPMPrivateChat, EPMSystemChat, EPMGroupChat)}
+
+
+def _vendor_specific(chat: BaseChat) -> Optional[Dict[str, Any]]:
+    """Vendor specific attributes of a chat if they can be stored as JSON."""
+    if not chat.vendor_specific:
+        return None
+    try:
+        json.dumps(chat.vendor_specific)
+    except (TypeError, ValueError):
+        return None
+    return chat.vendor_specific
+
+
+class ChatEntry:
+    """Compact representation of a chat held in the chat cache.
+
+    Only the fields of a chat record are kept, in slots, with strings shared
+    among chats of a module interned. Vendor specific attributes are kept as
+    interned JSON text, as they are often the same for chats of a channel.
+    Members are not kept; they are loaded from database when looked up on a
+    chat object built by :meth:`to_chat`.
+    """
+    __slots__ = ("type_name", "module_id", "module_name", "channel_emoji", "uid", "name", "alias", "description",
+                 "notification", "has_self", "other_is_self", "vendor_specific")
+
+    def __init__(self, type_name: str, module_id: ModuleID, module_name: str, channel_emoji: str, uid: ChatID,
+                 name: str, alias: Optional[str], description: str, notification: int, has_self: bool,
+                 other_is_self: bool, vendor_specific: Optional[Dict[str, Any]]):
+        self.type_name = sys.intern(type_name)
+        self.module_id = ModuleID(sys.intern(module_id))
+        self.module_name = sys.intern(module_name)
+        self.channel_emoji = sys.intern(channel_emoji)
+        self.uid = uid
+        self.name = name
+        self.alias = alias
+        self.description = description or ""
+        self.notification = notification
+        self.has_self = has_self
+        self.other_is_self = other_is_self
+        self.vendor_specific: Optional[str] = sys.intern(
+            json.dumps(vendor_specific, ensure_ascii=False, separators=(',', ':'))) if vendor_specific else None
+
+    @classmethod
+    def from_chat(cls, chat: EPMChatType) -> 'ChatEntry':
+        return cls(chat.chat_type_name, chat.module_id, chat.module_name, chat.channel_emoji, chat.uid, chat.name,
+                   chat.alias, chat.description, chat.notification.value, chat.has_self,
+                   isinstance(chat, PrivateChat) and chat.other is chat.self, _vendor_specific(chat))
+
+    @classmethod
+    def from_record(cls, data: bytes) -> 'ChatEntry':
+        """Load from a record made by :meth:`record`.
+
+        Raises:
+            ValueError: if the record is malformed or of an unknown version or type.
+        """
+        fields = json.loads(data)
+        if not fields or fields[0] != RECORD_VERSION:
+            raise ValueError(f"Unknown chat record version: {fields[:1]!r}")
+        if len(fields) != len(cls.__slots__) + 1:
+            raise ValueError(f"Malformed chat record: {fields!r}")
+        if fields[1] not in _chat_classes:
+            raise ValueError(f"Unknown chat type in record: {fields[1]!r}")
+        return cls(*fields[1:])
+
+    def record(self) -> bytes:
+        """Serialize into a compact record.
+
+        A record is a JSON array of fields in a fixed order, prefixed by
+        :data:`RECORD_VERSION`.
+        """
+        return json.dumps([RECORD_VERSION, self.type_name, self.module_id, self.module_name, self.channel_emoji,
+                           self.uid, self.name, self.alias, self.description, self.notification,
+                           self.has_self, self.other_is_self,
+                           json.loads(self.vendor_specific) if self.vendor_specific else None],
+                          ensure_ascii=False, separators=(',', ':')).encode()
+
+    def to_chat(self, db: 'DatabaseManager') -> EPMChatType:
+        """Build a full chat object."""
+        kwargs = dict(module_id=self.module_id, module_name=self.module_name, channel_emoji=self.channel_emoji,
+                      uid=self.uid, name=self.name, alias=self.alias, description=self.description,
+                      notification=ChatNotificationState(self.notification),
+                      vendor_specific=json.loads(self.vendor_specific) if self.vendor_specific else None,
+                      with_self=self.has_self)
+        if self.type_name == EPMPrivateChat.chat_type_name:
+            kwargs['other_is_self'] = self.other_is_self
+        return _chat_classes[self.type_name](db, **kwargs)
+
+    def __sizeof__(self) -> int:
+        return object.__sizeof__(self) + sum(sys.getsizeof(getattr(self, i))
+                                             for i in ("uid", "name", "alias", "description"))
+
+
+def chat_record(chat: EPMChatType) -> bytes:
+    """Serialize a chat into a compact record, see :meth:`ChatEntry.record`.
+
+    Members are not included, except the other party of a private chat
+    which is implied by the chat itself.
+    """
+    return ChatEntry.from_chat(chat).record()
+
+
+def load_chat(data: bytes, db: 'DatabaseManager') -> EPMChatType:
+    """Build a chat from a record made by :func:`chat_record`.
+
+    Raises:
+        ValueError: if the record is malformed or of an unknown version.
+    """
+    return ChatEntry.from_record(data).to_chat(db)
+
+
+def member_record(member: ChatMember) -> bytes:
+    """Serialize a chat member into a compact record."""
+    return json.dumps([RECORD_VERSION, member.uid, member.name, member.alias, member.description,
+                       _vendor_specific(member)],
+                      ensure_ascii=False, separators=(',', ':')).encode()
+
+
+def load_member(data: bytes, chat: Chat) -> ChatMember:
+    """Add a member to the chat from a record made by :func:`member_record`.
+
+    Raises:
+        ValueError: if the record is malformed or of an unknown version.
+    """
+    fields = json.loads(data)
+    if not fields or fields[0] != RECORD_VERSION:
+        raise ValueError(f"Unknown member record version: {fields[:1]!r}")
+    _, uid, name, alias, description, vendor_specific = fields
+    return chat.add_member(name, ChatID(uid), alias=alias, description=description,
+                           vendor_specific=vendor_specific)
@@ -0,0 +1,232 @@
+import hashlib
+import json
+import threading
+import uuid
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
+from typing import Dict, List, Tuple, NamedTuple, Optional, Iterable, Iterator, Set
+
+from .chat import ChatEntry, EPMGroupChat
+from . import utils
+
+DirectoryKey = Tuple[str, str]
+"""Key of a chat in the directory: module_id, chat_id"""
+
+STATE_VERSION = 1
+"""Version of the saved directory state, stored in its header line."""
+
+
+class DirectoryPage(NamedTuple):
+    reset: bool
+    """The client must discard its directory before applying this page."""
+    version: int
+    """Version the client is up to after applying this page."""
+    base: int
+    """Version the directory of the client is consistent with, once it has applied all pages."""
+    more: bool
+    """More changes follow after this page."""
+    added: List[DirectoryKey]
+    changed: List[DirectoryKey]
+    removed: List[DirectoryKey]
+
+
+class ChatDirectory:
+    """Versioned directory of chats known to the chat cache.
+
+    Every change of a chat (added, changed, removed) is given a new version
+    number, so that a client holding the directory up to version N only
+    needs changes after N. An initial sync is the same as changes since
+    version 0, without removals, and is paged by version as well. Chats
+    changed while a client is paging move to a later version, and are
+    included in a later page.
+
+    Versions are only meaningful within the same :attr:`epoch`. The epoch
+    is kept across a restart only if the directory state saved at shutdown
+    is restored by :meth:`restore`, and changes otherwise. Removals are remembered up to a limit; a client
+    that may hold a chat whose removal is forgotten has to sync again from
+    scratch. While paging through an initial sync, this is decided by the
+    version the sync started at (the base), instead of the version of the
+    last page.
+    """
+
+    def __init__(self, max_tombstones: int = 10000):
+        self.lock = threading.Lock()
+        self.epoch = uuid.uuid4().hex
+        self.version = 0
+        self.min_version = 0
+        """Oldest version that changes can be computed since."""
+        self.max_tombstones = max_tombstones
+
+        self.entries: Dict[DirectoryKey, Tuple[int, int, int]] = dict()
+        """Version added, version last changed and fingerprint of each chat."""
+        self.tombstones: 'OrderedDict[DirectoryKey, int]' = OrderedDict()
+        """Version of removed chats, in the order of removal."""
+        self.restored: Set[DirectoryKey] = set()
+        """Chats restored from saved state that are not yet updated since."""
+
+        # Log of changes in version order. Superseded changes are left in the
+        # log and skipped, until they outnumber the live ones.
+        self._log_versions = array('q')
+        self._log_keys: List[DirectoryKey] = []
+
+    def update(self, entry: ChatEntry):
+        """Record a chat enrolled to the cache, if it is new or changed."""
+        key = (entry.module_id, entry.uid)
+        # Stable across restarts, unlike hash() of bytes
+        fingerprint = int.from_bytes(hashlib.blake2b(entry.record(), digest_size=8).digest(), "big", signed=True)
+        with self.lock:
+            self.restored.discard(key)
+            current = self.entries.get(key)
+            if current is not None and current[2] == fingerprint:
+                return
+            self.version += 1
+            added = current[0] if current is not None else self.version
+            self.entries[key] = (added, self.version, fingerprint)
+            self.tombstones.pop(key, None)
+            self._append(key)
+
+    def remove(self, key: DirectoryKey):
+        """Record a chat removed from the cache."""
+        with self.lock:
+            if self.entries.pop(key, None) is None:
+                return
+            self.version += 1
+            self.tombstones[key] = self.version
+            self._append(key)
+            while len(self.tombstones) > self.max_tombstones:
+                _, version = self.tombstones.popitem(last=False)
+                self.min_version = version
+
+    def take_restored(self) -> Set[DirectoryKey]:
+        """Chats restored from saved state that are not updated since, forgetting them."""
+        with self.lock:
+            restored, self.restored = self.restored, set()
+        return restored
+
+    def dump(self) -> Iterator[bytes]:
+        """Serialize the state as lines, to be loaded by :meth:`restore` on the next start.
+
+        The first line is a header with the epoch and versions, followed by
+        one line per chat and per removed chat.
+        """
+        with self.lock:
+            entries = list(self.entries.items())
+            tombstones = list(self.tombstones.items())
+            header = {"version": STATE_VERSION, "epoch": self.epoch, "latest": self.version,
+                      "min_version": self.min_version}
+        yield json.dumps(header).encode()
+        for key, (added, changed, fingerprint) in entries:
+            yield json.dumps([key[0], key[1], added, changed, fingerprint], ensure_ascii=False).encode()
+        for key, version in tombstones:
+            yield json.dumps([key[0], key[1], version], ensure_ascii=False).encode()
+
+    def restore(self, lines: Iterable[bytes]) -> bool:
+        """Restore the epoch and versions of chats from lines made by :meth:`dump`.
+
+        Nothing is restored if the directory has changed since start, as
+        versions given out since would be reused.
+
+        Returns:
+            If the state is restored.
+
+        Raises:
+            ValueError: if the state is malformed.
+        """
+        lines = iter(lines)
+        header = json.loads(next(lines))
+        if header.get("version") != STATE_VERSION:
+            return False
+        entries: Dict[DirectoryKey, Tuple[int, int, int]] = dict()
+        tombstones: List[Tuple[int, DirectoryKey]] = []
+        for line in lines:
+            fields = json.loads(line)
+            if len(fields) == 5:
+                entries[(fields[0], fields[1])] = (fields[2], fields[3], fields[4])
+            else:
+                tombstones.append((fields[2], (fields[0], fields[1])))
+        with self.lock:
+            if self.version:
+                return False
+            self.epoch = header["epoch"]
+            self.version = header["latest"]
+            self.min_version = header["min_version"]
+            self.entries = entries
+            self.tombstones = OrderedDict((key, version) for version, key in sorted(tombstones))
+            self.restored = set(entries)
+            live = sorted([(i[1], key) for key, i in entries.items()] + tombstones)
+            self._log_versions = array('q', (i[0] for i in live))
+            self._log_keys = [i[1] for i in live]
+        return True
+
+    def _current_version(self, key: DirectoryKey) -> Optional[int]:
+        entry = self.entries.get(key)
+        if entry is not None:
+            return entry[1]
+        return self.tombstones.get(key)
+
+    def _append(self, key: DirectoryKey):
+        self._log_versions.append(self.version)
+        self._log_keys.append(key)
+        if len(self._log_keys) > 2 * (len(self.entries) + len(self.tombstones)) + 1024:
+            live = sorted((self._current_version(k), k) for k in set(self._log_keys)
+                          if self._current_version(k) is not None)
+            self._log_versions = array('q', (i[0] for i in live))
+            self._log_keys = [i[1] for i in live]
+
+    def changes(self, epoch: Optional[str], since: int, limit: int, base: Optional[int] = None) -> DirectoryPage:
+        """Changes after a version, in version order.
+
+        Args:
+            epoch: Epoch of the version held by the client, ``None`` if it
+                has not synced yet.
+            since: Version held by the client.
+            limit: Maximum number of chats in the page.
+            base: Base version of the previous page, same as ``since`` if
+                not given.
+        """
+        with self.lock:
+            if base is None:
+                base = since
+            reset = epoch != self.epoch or base < self.min_version or since > self.version or base > self.version
+            if reset:
+                since = 0
+                base = self.version
+            added: List[DirectoryKey] = []
+            changed: List[DirectoryKey] = []
+            removed: List[DirectoryKey] = []
+            version = since
+            more = False
+            for i in range(bisect_right(self._log_versions, since), len(self._log_keys)):
+                key = self._log_keys[i]
+                log_version = self._log_versions[i]
+                if self._current_version(key) != log_version:
+                    continue
+                if len(added) + len(changed) + len(removed) >= limit:
+                    more = True
+                    break
+                version = log_version
+                entry = self.entries.get(key)
+                if entry is None:
+                    if since:
+                        removed.append(key)
+                elif entry[0] > since:
+                    added.append(key)
+                else:
+                    changed.append(key)
+            if not more:
+                version = base = max(version, self.version)
+        return DirectoryPage(reset, version, base, more, added, changed, removed)
+
+
+def entry_json(entry: ChatEntry) -> dict:
+    """Representation of a chat in the directory sent to the client."""
+    return {
+        "slaveOriginUid": utils.chat_id_to_str(entry.module_id, entry.uid),
+        "name": entry.name,
+        "alias": entry.alias,
+        "description": entry.description,
+        "chatType": 1 if entry.type_name == EPMGroupChat.chat_type_name else 0,
+        "channelName": entry.module_name,
+        "channelEmoji": entry.channel_emoji,
+    }
@@ -1,13 +1,24 @@
+import json
 import logging
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from contextlib import suppress
-from typing import TYPE_CHECKING, Optional, Tuple, Dict, Iterator, overload, Literal
+from typing import TYPE_CHECKING, Optional, Tuple, Dict, Iterator, overload, Literal, Set, List, Union, Pattern
 
-from ehforwarderbot.chat import BaseChat
+from ehforwarderbot.chat import BaseChat, SelfChatMember
 from ehforwarderbot.exceptions import EFBChatNotFound
 from ehforwarderbot.types import ModuleID, ChatID
 
 from ehforwarderbot import coordinator, Chat
-from .chat import EPMChatType, convert_chat, unpickle, EPMSystemChat
+from ehforwarderbot.channel import SlaveChannel
+from ehforwarderbot import utils as efb_utils
+from .chat import EPMChatType, convert_chat, unpickle, EPMSystemChat, load_chat, ChatEntry
+from .chat_directory import ChatDirectory
+from .chat_search import ChatSearchIndex
 
 if TYPE_CHECKING:
     from . import ParaboxChannel
@@ -15,10 +26,22 @@ if TYPE_CHECKING:
 CacheKey = Tuple[ModuleID, ChatID]
 """Cache storage key: module_id, chat_id"""
 
+SNAPSHOT_VERSION = 1
+"""Version of the chat snapshot file, stored in its header line."""
+
 
 class ChatObjectCacheManager:
     """Maintain and update chat objects from all slave channels and
     middlewares.
+
+    The cache is shared by slave channel threads and the websocket thread.
+    All cache state is guarded by :attr:`lock`, which is only held for
+    dictionary operations; database and slave channel lookups run outside of
+    it, with concurrent lookups of the same chat deduplicated.
+
+    Chats are cached as compact :class:`.ChatEntry` records. Full chat
+    objects are built from them when looked up, and only the most recently
+    used ones are kept.
     """
 
     def __init__(self, channel: 'ParaboxChannel'):
@@ -26,29 +49,218 @@ class ChatObjectCacheManager:
         self.db = channel.db
         self.logger = logging.getLogger(__name__)
 
-        self.cache: Dict[CacheKey, EPMChatType] = dict()
+        self.lock = threading.Lock()
+        self.cache: 'OrderedDict[CacheKey, ChatEntry]' = OrderedDict()
+        """Cached chats in least recently used order."""
+        self._entries_snapshot: Optional[List[ChatEntry]] = None
+        """Copy of cached chats shared by iterations until the cache is changed."""
+        self.objects: 'OrderedDict[CacheKey, EPMChatType]' = OrderedDict()
+        """Chat objects of the most recently used cached chats."""
+        self.inflight: Dict[CacheKey, threading.Event] = dict()
+        """Chats being looked up from database or slave channels."""
+        self.cache_bytes = 0
+        """Estimated memory usage of cached chats, in bytes."""
+
+        self.negative: 'OrderedDict[CacheKey, Tuple[float, Optional[EPMChatType]]]' = OrderedDict()
+        """Chats not found anywhere: expiry time, and the dummy chat built if any, oldest first."""
+
+        self.search_index = ChatSearchIndex()
+        """Index of cached chats, maintained along with :attr:`cache`."""
+        self.directory = ChatDirectory()
+        """Versions of all chats enrolled, for synchronization with the client."""
+
+        self.counters: Dict[str, int] = {"hit": 0, "miss": 0, "negative_hit": 0, "db_hit": 0, "slave_hit": 0,
+                                         "not_found": 0, "eviction": 0, "inflight_wait": 0, "build": 0}
+
+        self.warmup_workers: int = channel.config.get("chat_warmup_workers", 4)
+        self.ready = threading.Event()
+        """Set when chats from all slave channels are loaded."""
+
+        self.snapshot_enabled: bool = channel.config.get("chat_snapshot", True)
+        self.snapshot_path = efb_utils.get_data_path(channel.channel_id) / "chat_snapshot"
+        self.stale: Set[CacheKey] = set()
+        """Keys of chats loaded from snapshot that are not yet confirmed by their slave channel."""
+        self.directory_path = efb_utils.get_data_path(channel.channel_id) / "chat_directory"
+        self.apply_config(channel.config)
+        if self.snapshot_enabled:
+            threading.Thread(target=self._snapshot_loop, name="EPMChatSnapshot", daemon=True).start()
 
+        # Load chats from snapshot and slave channels in background, chats are looked up on demand until then.
+        threading.Thread(target=self.warm_up, name="EPMChatWarmUp", daemon=True).start()
+
+    def apply_config(self, config: dict):
+        """Apply cache budgets from the configuration, also when it is reloaded.
+
+        Chats exceeding reduced budgets are evicted right away.
+        """
+        self.negative_ttl: float = config.get("chat_negative_ttl", 60)
+        self.max_negative: int = config.get("chat_negative_cache_size", 10000)
+        self.snapshot_interval: float = config.get("chat_snapshot_interval", 600)
+        self.directory.max_tombstones = config.get("chat_directory_tombstones", 10000)
+        with self.lock:
+            self.max_objects: int = config.get("chat_object_cache_size", 1000)
+            self.max_chats: int = config.get("chat_cache_size", 100000)
+            self.max_bytes: int = config.get("chat_cache_max_bytes", 256 * 1024 * 1024)
+            self._evict()
+            while len(self.objects) > self.max_objects:
+                self.objects.popitem(last=False)
+
+    def warm_up(self):
+        """Load chats from snapshot, then all chats from all slave channels
+        concurrently and convert to EPMChat objects."""
+        start = time.monotonic()
+        self.load_directory()
+        if self.snapshot_enabled:
+            self.load_snapshot()
         self.logger.debug("Loading chats from slave channels...")
-        # load all chats from all slave channels and convert to EPMChat object
-        for channel_id, module in coordinator.slaves.items():
+        with ThreadPoolExecutor(max_workers=max(1, self.warmup_workers),
+                                thread_name_prefix="EPMChatWarmUp") as executor:
+            futures = {executor.submit(self.load_slave_chats, channel_id, module): channel_id
+                       for channel_id, module in coordinator.slaves.items()}
+            failed = set()
+            for i, future in enumerate(as_completed(futures), 1):
+                # noinspection PyBroadException
+                try:
+                    count, duration = future.result()
+                except Exception:
+                    self.logger.exception("Error occurred while getting chats from %s. "
+                                          "EPM will report no chat from this channel until further noticed.",
+                                          futures[future])
+                    failed.add(futures[future])
+                    continue
+                self.logger.info("Chats from %s are ready: %s chats in %.2fs (%s/%s slave channels).",
+                                 futures[future], count, duration, i, len(futures))
+        # Chats in the restored directory that are no longer reported by their slave channel
+        for key in self.directory.take_restored():
+            if key[0] not in failed:
+                self.directory.remove(key)
+        self.ready.set()
+        self.logger.info("All chats are loaded in %.2fs.", time.monotonic() - start)
+
+    def load_slave_chats(self, channel_id: ModuleID, module) -> Tuple[int, float]:
+        """Load and enrol all chats from a slave channel.
+
+        Returns:
+            Number of chats loaded, and time taken in seconds.
+        """
+        start = time.monotonic()
+        self.logger.debug("Loading chats from '%s'...", channel_id)
+        chats = module.get_chats()
+        self.logger.debug("Found %s chats from '%s'.", len(chats), channel_id)
+        enrolled: List[EPMChatType] = []
+        for chat in chats:
+            key = self.get_cache_key(chat)
+            with self.lock:
+                if key in self.stale:
+                    # Replace the copy from snapshot with the one from the slave channel
+                    self.stale.discard(key)
+                elif key in self.cache:
+                    # Already looked up on demand
+                    continue
+            enrolled.append(self.compound_enrol(chat))
+        # Keep chats in database so that they can be reloaded after eviction from cache
+        self.db.set_slave_chat_infos(enrolled)
+        # Chats in snapshot that are no longer reported by the slave channel
+        with self.lock:
+            removed = [i for i in self.stale if i[0] == channel_id]
+            self.stale.difference_update(removed)
+        for key in removed:
+            self._forget(key)
+        self.db.delete_slave_chats(channel_id, [i[1] for i in removed])
+        return len(chats), time.monotonic() - start
+
+    def load_snapshot(self):
+        """Enrol all chats from the snapshot file written by :meth:`save_snapshot`."""
+        if not self.snapshot_path.exists():
+            return
+        start = time.monotonic()
+        # noinspection PyBroadException
+        try:
+            lines = self.snapshot_path.read_bytes().splitlines()
+            header = json.loads(lines[0])
+            if header.get("version") != SNAPSHOT_VERSION:
+                self.logger.info("Ignoring chat snapshot of unknown version %s.", header.get("version"))
+                return
+            for line in lines[1:]:
+                with suppress(ValueError, TypeError):
+                    entry = ChatEntry.from_record(line)
+                    key = self.get_cache_key(entry)
+                    with self.lock:
+                        if key in self.cache:
+                            # Already looked up on demand
+                            continue
+                        self.stale.add(key)
+                    self._enrol(entry)
+        except Exception:
+            self.logger.exception("Error occurred while loading chat snapshot.")
+            return
+        self.logger.info("Loaded %s chats from snapshot in %.2fs.", len(self.stale), time.monotonic() - start)
+
+    def save_snapshot(self):
+        """Write all cached chats into the snapshot file, replacing the previous one."""
+        start = time.monotonic()
+        entries = self._entries()
+        tmp_path = self.snapshot_path.with_suffix(".tmp")
+        with tmp_path.open("wb") as f:
+            f.write(json.dumps({"version": SNAPSHOT_VERSION, "created_at": int(time.time())}).encode())
+            for entry in entries:
+                f.write(b"\n")
+                f.write(entry.record())
+        os.replace(tmp_path, self.snapshot_path)
+        self.logger.debug("Saved %s chats to snapshot in %.2fs.", len(entries), time.monotonic() - start)
+
+    def load_directory(self):
+        """Restore the chat directory saved by :meth:`save_directory` at the last shutdown.
+
+        The saved state is removed once read, so that it is not restored
+        again after a crash, when it would be outdated.
+        """
+        if not self.directory_path.exists():
+            return
+        # noinspection PyBroadException
+        try:
+            lines = self.directory_path.read_bytes().splitlines()
+            self.directory_path.unlink()
+            if self.directory.restore(lines):
+                self.logger.debug("Restored chat directory of %s chats at version %s.",
+                                  len(self.directory.entries), self.directory.version)
+        except Exception:
+            self.logger.exception("Error occurred while restoring chat directory.")
+
+    def save_directory(self):
+        """Save the chat directory, so that clients can keep syncing from their version after restart."""
+        tmp_path = self.directory_path.with_suffix(".tmp")
+        with tmp_path.open("wb") as f:
+            f.write(b"\n".join(self.directory.dump()))
+        os.replace(tmp_path, self.directory_path)
+
+    def stop(self):
+        """Save the snapshot if enabled, and the chat directory."""
+        if self.snapshot_enabled:
+            self.save_snapshot()
+        self.save_directory()
+
+    def _snapshot_loop(self):
+        self.ready.wait()
+        while True:
+            time.sleep(self.snapshot_interval)
             # noinspection PyBroadException
             try:
-                self.logger.debug("Loading chats from '%s'...", channel_id)
-                chats = module.get_chats()
+                self.save_snapshot()
             except Exception:
-                self.logger.exception("Error occurred while getting chats from %. "
-                                      "ETM will report no chat from this channel until further noticed.", channel_id)
-                continue
-            self.logger.debug("Found %s chats from '%s'.", len(chats), channel_id)
-            for chat in chats:
-                self.compound_enrol(chat)
-            self.logger.debug("All %s chats from '%s' are enrolled.", len(chats), channel_id)
+                self.logger.exception("Error occurred while saving chat snapshot.")
 
     def compound_enrol(self, chat: Chat) -> EPMChatType:
         """Convert and enrol a chat object for the first time.
+
+        Members of the chat from the slave channel are stored in database,
+        as they are not kept in the cache nor the converted chat object.
         """
         epm_chat = convert_chat(self.db, chat)
         self.enrol(epm_chat)
+        members = [i for i in chat.members if not isinstance(i, SelfChatMember)]
+        if members:
+            self.db.set_slave_chat_members(epm_chat, members)
 
         return epm_chat
 
@@ -56,13 +268,57 @@ class ChatObjectCacheManager:
         """Add a chat object to the cache storage *for the first time*.
 
         This would not update the cached object upon conflicting.
+
+        Least recently used chats are evicted when the cache is over its
+        size limits.
         """
-        key = self.get_cache_key(chat)
-        self.cache[key] = chat
-        self.logger.debug("Enrolling key %s with value %s", key, chat)
+        self._enrol(ChatEntry.from_chat(chat), chat)
+
+    def _enrol(self, entry: ChatEntry, chat: Optional[EPMChatType] = None):
+        """Add a chat entry to the cache, and its chat object if already built."""
+        key = self.get_cache_key(entry)
+        size = self.estimate_size(entry)
+        self.directory.update(entry)
+        self.logger.debug("Enrolling key %s", key)
+        with self.lock:
+            self.search_index.add(entry)
+            replaced = self.cache.get(key)
+            self.cache[key] = entry
+            self.cache.move_to_end(key)
+            self.cache_bytes += size - (self.estimate_size(replaced) if replaced is not None else 0)
+            self.negative.pop(key, None)
+            self._entries_snapshot = None
+            if chat is not None:
+                self._keep_object(key, chat)
+            else:
+                self.objects.pop(key, None)
+            self._evict()
+
+    def _evict(self):
+        """Evict least recently used chats exceeding the budgets. Must be called with :attr:`lock` held."""
+        while len(self.cache) > 1 and (self.max_chats and len(self.cache) > self.max_chats or
+                                       self.max_bytes and self.cache_bytes > self.max_bytes):
+            evicted_key, evicted = self.cache.popitem(last=False)
+            self.search_index.remove(*evicted_key)
+            self._entries_snapshot = None
+            self.cache_bytes -= self.estimate_size(evicted)
+            self.objects.pop(evicted_key, None)
+            self.counters["eviction"] += 1
+
+    def _keep_object(self, key: CacheKey, chat: EPMChatType):
+        """Keep a built chat object of a cached chat. Must be called with :attr:`lock` held."""
+        self.objects[key] = chat
+        self.objects.move_to_end(key)
+        while len(self.objects) > self.max_objects:
+            self.objects.popitem(last=False)
+
+    @staticmethod
+    def estimate_size(entry: ChatEntry) -> int:
+        """Rough estimate of memory used by a cached chat, in bytes."""
+        return sys.getsizeof(entry)
 
     @staticmethod
-    def get_cache_key(chat: BaseChat) -> CacheKey:
+    def get_cache_key(chat: Union[BaseChat, ChatEntry]) -> CacheKey:
         module_id = chat.module_id
         chat_id = chat.uid
         return module_id, chat_id
@@ -84,41 +340,235 @@ class ChatObjectCacheManager:
 
         If build_dummy is set to True, this will return a dummy object with
         the module_id, chat_id and group_id specified.
+
+        Concurrent lookups of the same chat that is not in cache wait for the
+        first one instead of querying again.
         """
         key = (module_id, chat_id)
-        if key in self.cache:
-            return self.cache[key]
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry is not None:
+                self.cache.move_to_end(key)
+                self.counters["hit"] += 1
+                obj = self.objects.get(key)
+                if obj is not None:
+                    self.objects.move_to_end(key)
+                    return obj
+                self.counters["build"] += 1
+            else:
+                negative = self.negative.get(key)
+                if negative is not None:
+                    expiry, dummy = negative
+                    if expiry > time.monotonic():
+                        self.counters["negative_hit"] += 1
+                        if build_dummy and dummy is None:
+                            dummy = self.build_dummy(module_id, chat_id)
+                            self.negative[key] = (expiry, dummy)
+                        return dummy if build_dummy else None
+                    del self.negative[key]
 
+                event = self.inflight.get(key)
+                leader = event is None
+                if leader:
+                    event = self.inflight[key] = threading.Event()
+                    self.counters["miss"] += 1
+                else:
+                    self.counters["inflight_wait"] += 1
+
+        if entry is not None:
+            obj = entry.to_chat(self.db)
+            with self.lock:
+                if self.cache.get(key) is entry:
+                    # Keep the object built first by concurrent lookups
+                    obj = self.objects.get(key, obj)
+                    self._keep_object(key, obj)
+            return obj
+        if not leader:
+            # The result is in the cache, or the negative cache, when the lookup finishes.
+            event.wait()
+            return self.get_chat(module_id, chat_id, build_dummy)
+        try:
+            return self._look_up_chat(module_id, chat_id, build_dummy)
+        finally:
+            with self.lock:
+                del self.inflight[key]
+            event.set()
+
+    def _look_up_chat(self, module_id: ModuleID, chat_id: ChatID, build_dummy: bool) -> Optional[EPMChatType]:
+        """Look up a chat not in cache from database, then the slave channel."""
+        key = (module_id, chat_id)
         c_log = self.db.get_slave_chat_info(module_id, chat_id)
-        if c_log is not None and c_log.pickle:
+        if c_log is not None and c_log.record:
+            with suppress(ValueError):
+                obj = load_chat(c_log.record, self.db)
+                self.enrol(obj)
+                self._count("db_hit")
+                return obj
+        elif c_log is not None and c_log.pickle:
             # Suppress AttributeError caused by change of class name in EFB 2.0.0b26, ETM 2.0.0b40
             with suppress(AttributeError):
                 obj = unpickle(c_log.pickle, self.db)
+                # Replace the pickle with a record, and move members out of it
+                obj.update_to_db()
                 self.enrol(obj)
+                self._count("db_hit")
                 return obj
 
         # Only look up from slave channels as middlewares don’t have get_chat_by_id method.
         if module_id in coordinator.slaves:
             with suppress(EFBChatNotFound, KeyError):
                 chat_obj = coordinator.slaves[module_id].get_chat(chat_id)
-                return self.compound_enrol(chat_obj)
+                obj = self.compound_enrol(chat_obj)
+                obj.update_to_db()
+                self._count("slave_hit")
+                return obj
+
+        dummy = self.build_dummy(module_id, chat_id) if build_dummy else None
+        with self.lock:
+            self.counters["not_found"] += 1
+            if self.negative_ttl and self.max_negative:
+                now = time.monotonic()
+                # Expired chats are the oldest, and removed along with those beyond the limit.
+                while self.negative and (len(self.negative) >= self.max_negative or
+                                         next(iter(self.negative.values()))[0] <= now):
+                    self.negative.popitem(last=False)
+                self.negative[key] = (now + self.negative_ttl, dummy)
+        return dummy
+
+    def _count(self, counter: str):
+        with self.lock:
+            self.counters[counter] += 1
 
-        if build_dummy:
-            return EPMSystemChat(self.db,
-                                 module_id=module_id,
-                                 module_name=module_id,
-                                 uid=chat_id,
-                                 name=chat_id)
-        return None
+    def get_entries(self, keys: List[CacheKey]) -> List[ChatEntry]:
+        """Find chat entries in the cache or database, without building chat objects.
+
+        Unlike :meth:`get_chat`, this does not affect the order of eviction,
+        nor look up slave channels. Entries not in cache are read from
+        database in batches, and chats not found are left out of the result.
+        """
+        entries: Dict[CacheKey, ChatEntry] = dict()
+        missing: Dict[ModuleID, List[ChatID]] = dict()
+        with self.lock:
+            for key in keys:
+                entry = self.cache.get(key)
+                if entry is not None:
+                    entries[key] = entry
+                else:
+                    missing.setdefault(key[0], []).append(key[1])
+        for module_id, chat_ids in missing.items():
+            for chat_id, record in self.db.get_slave_chat_records(module_id, chat_ids).items():
+                with suppress(ValueError):
+                    entries[(module_id, chat_id)] = ChatEntry.from_record(record)
+        return [entries[key] for key in keys if key in entries]
+
+    def build_dummy(self, module_id: ModuleID, chat_id: ChatID) -> EPMChatType:
+        return EPMSystemChat(self.db,
+                             module_id=module_id,
+                             module_name=module_id,
+                             uid=chat_id,
+                             name=chat_id)
 
     def delete_chat_object(self, module_id: ModuleID, chat_id: ChatID):
-        """Remove chat object from cache."""
-        key = (module_id, chat_id)
-        if key not in self.cache:
+        """Remove a chat from cache, and the chat and its members from database."""
+        entry = self._forget((module_id, chat_id))
+        chat = entry.to_chat(self.db) if entry is not None else self.build_dummy(module_id, chat_id)
+        chat.remove_from_db()
+
+    def _forget(self, key: CacheKey) -> Optional[ChatEntry]:
+        """Remove a chat from cache, search index and directory.
+
+        Returns:
+            The cached entry of the chat, if any.
+        """
+        self.directory.remove(key)
+        with self.lock:
+            self.search_index.remove(*key)
+            entry = self.cache.pop(key, None)
+            if entry is not None:
+                self.cache_bytes -= self.estimate_size(entry)
+                self.objects.pop(key, None)
+                self._entries_snapshot = None
+        return entry
+
+    def update_chats(self, channel: SlaveChannel, chat_ids: List[ChatID]):
+        """Look up new or modified chats from a slave channel, and update them in cache and database."""
+        for chat_id in chat_ids:
+            try:
+                chat = channel.get_chat(chat_id)
+            except EFBChatNotFound:
+                self.logger.debug("Chat %s updated by %s is not found.", chat_id, channel.channel_id)
+                continue
+            with self.lock:
+                self.stale.discard(self.get_cache_key(chat))
+            self.compound_enrol(chat).update_to_db()
+
+    def update_members(self, channel: SlaveChannel, chat_id: ChatID, member_ids: List[ChatID],
+                       removed_ids: List[ChatID]):
+        """Update new or modified members of a group from a slave channel in database, and delete removed ones."""
+        key = (channel.channel_id, chat_id)
+        with self.lock:
+            # Drop the chat object, which may hold outdated members
+            self.objects.pop(key, None)
+        for member_id in removed_ids:
+            self.db.delete_slave_chat_info(channel.channel_id, member_id, chat_id)
+        if not member_ids:
+            return
+        try:
+            chat = channel.get_chat(chat_id)
+        except EFBChatNotFound:
+            self.logger.debug("Group %s with updated members is not found in %s.", chat_id, channel.channel_id)
             return
-        self.cache.pop(key)
+        member_ids = set(member_ids)
+        members = [i for i in chat.members if i.uid in member_ids and not isinstance(i, SelfChatMember)]
+        if members:
+            self.db.set_slave_chat_members(chat, members)
+
+    def search(self, pattern: Union[Pattern, str], module_id: Optional[ModuleID] = None,
+               limit: Optional[int] = None) -> List[EPMChatType]:
+        """Find cached chats matching a string or a compiled regex pattern.
+
+        Strings are looked up in the search index over chat names, aliases and
+        IDs, and results are ranked. Regex patterns are matched against every
+        cached chat with :meth:`.EPMChatMixin.match`, which builds chat
+        objects for all of them.
+        """
+        if not isinstance(pattern, str):
+            results = [i for i in self.all_chats
+                       if (module_id is None or i.module_id == module_id) and i.match(pattern)]
+            return results[:limit] if limit is not None else results
+        results = []
+        for key in self.search_index.search(pattern, module_id=module_id):
+            chat = self.get_chat(*key)
+            if chat is not None:
+                results.append(chat)
+                if limit is not None and len(results) >= limit:
+                    break
+        return results
+
+    def stats(self) -> Dict[str, int]:
+        """Cache size, estimated memory usage and lookup counters."""
+        with self.lock:
+            return dict(self.counters, size=len(self.cache), bytes=self.cache_bytes,
+                        negative_size=len(self.negative), inflight=len(self.inflight), objects=len(self.objects))
 
     @property
     def all_chats(self) -> Iterator[EPMChatType]:
-        """Return all chats that is not a group member and not myself."""
-        return (val for val in self.cache.values() if isinstance(val, EPMChatType))
+        """Return all chats that is not a group member and not myself.
+
+        Only chats currently held in the cache are included. Iteration runs
+        over a copy of the cache taken at the first call after a change, so
+        it is not affected by concurrent updates, and the copy is shared by
+        later calls until the next change. Chat objects not kept in the
+        cache are built during iteration.
+        """
+        objects = self.objects
+        for entry in self._entries():
+            obj = objects.get(self.get_cache_key(entry))
+            yield obj if obj is not None else entry.to_chat(self.db)
+
+    def _entries(self) -> List[ChatEntry]:
+        with self.lock:
+            entries = self._entries_snapshot
+            if entries is None:
+                entries = self._entries_snapshot = list(self.cache.values())
+        return entries
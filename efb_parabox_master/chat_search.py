@@ -0,0 +1,134 @@
+import threading
+from array import array
+from typing import Dict, Set, List, Tuple, Optional, Iterable
+
+from .chat import EPMChatType
+
+SearchKey = Tuple[str, str]
+"""Key of an indexed chat: module_id, chat_id"""
+
+
+class ChatSearchIndex:
+    """Trigram index over names, aliases and IDs of chats.
+
+    A query of 3 or more characters is looked up through the shortest
+    posting list among the trigrams it contains, and candidates are verified
+    by substring match. Shorter queries fall back to a scan over the
+    normalized index entries.
+
+    Postings are compact integer arrays that are only appended to. Removed
+    or updated entries are left in them and skipped on lookup, until they
+    outnumber the live entries and the postings are rebuilt.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ids: Dict[SearchKey, int] = dict()
+        self.keys: Dict[int, SearchKey] = dict()
+        self.texts: Dict[int, str] = dict()
+        """Normalized name, alias and ID of each entry, separated by new lines."""
+        self.trigrams: Dict[str, array] = dict()
+        self._next_id = 0
+        self._dead = 0
+
+    @staticmethod
+    def normalize(s: Optional[str]) -> str:
+        return s.casefold() if s else ""
+
+    @staticmethod
+    def get_trigrams(text: str) -> Set[str]:
+        return {text[i:i + 3] for i in range(len(text) - 2)}
+
+    def add(self, chat: EPMChatType):
+        """Index a chat, replacing its previous entry if any."""
+        key = (chat.module_id, chat.uid)
+        name = self.normalize(chat.name)
+        alias = self.normalize(chat.alias)
+        text = "\n".join((name, alias, self.normalize(chat.uid)))
+        with self.lock:
+            old_id = self.ids.get(key)
+            if old_id is not None:
+                if self.texts[old_id] == text:
+                    return
+                self._remove(old_id)
+            entry_id = self._next_id
+            self._next_id += 1
+            self.ids[key] = entry_id
+            self.keys[entry_id] = key
+            self.texts[entry_id] = text
+            self._post(entry_id, text)
+
+    def _post(self, entry_id: int, text: str):
+        for trigram in self.get_trigrams(text):
+            posting = self.trigrams.get(trigram)
+            if posting is None:
+                posting = self.trigrams[trigram] = array('l')
+            posting.append(entry_id)
+
+    def remove(self, module_id: str, chat_id: str):
+        """Remove a chat from the index."""
+        with self.lock:
+            entry_id = self.ids.pop((module_id, chat_id), None)
+            if entry_id is not None:
+                self._remove(entry_id)
+
+    def _remove(self, entry_id: int):
+        del self.keys[entry_id]
+        del self.texts[entry_id]
+        self._dead += 1
+        if self._dead > len(self.texts):
+            self._rebuild()
+
+    def _rebuild(self):
+        self.trigrams = dict()
+        for entry_id, text in self.texts.items():
+            self._post(entry_id, text)
+        self._dead = 0
+
+    def search(self, query: str, module_id: Optional[str] = None, limit: Optional[int] = None) -> List[SearchKey]:
+        """Find chats containing a string in their name, alias or ID.
+
+        Results are ranked by exact match of name, alias or ID first, then by
+        prefix match of name or alias, then by match anywhere else.
+
+        Args:
+            query: String to look for, case insensitive.
+            module_id: Only return chats of this module.
+            limit: Maximum number of results.
+
+        Returns:
+            Keys of matching chats.
+        """
+        query = self.normalize(query)
+        with self.lock:
+            candidates: Iterable[int]
+            if len(query) >= 3:
+                postings = [self.trigrams.get(i) for i in self.get_trigrams(query)]
+                if not all(postings):
+                    return []
+                candidates = min(postings, key=len)
+            else:
+                candidates = list(self.texts.keys())
+            results = []
+            for entry_id in candidates:
+                text = self.texts.get(entry_id)
+                if text is None or query not in text:
+                    continue
+                key = self.keys[entry_id]
+                if module_id is not None and key[0] != module_id:
+                    continue
+                name, alias, uid = text.rsplit("\n", 2)
+                if query == name or query == alias or query == uid:
+                    rank = 0
+                elif name.startswith(query) or alias.startswith(query):
+                    rank = 1
+                else:
+                    rank = 2
+                results.append((rank, len(name), key))
+        results.sort()
+        if limit is not None:
+            results = results[:limit]
+        return [i[2] for i in results]
+
+    def __len__(self):
+        return len(self.ids)
@@ -15,6 +15,12 @@ class Flags:
     SUGGEST_RECIPIENTS = 0x32
 
 
+class MsgState:
+    # Retry state of an outbound message record
+    PENDING = 0
+    DEAD = 1
+
+
 class Emoji:
     GROUP = "👥"
     USER = "👤"
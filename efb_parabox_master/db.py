@@ -1,19 +1,80 @@
 # coding=utf-8
 
 import logging
+import sqlite3
+import threading
 import time
-from typing import TYPE_CHECKING, Optional, Dict
+from typing import TYPE_CHECKING, Optional, Dict, List, Callable, Any, Tuple
 
 from ehforwarderbot import utils
+from ehforwarderbot.chat import ChatMember
 from ehforwarderbot.types import ModuleID, ChatID
-from peewee import TextField, CharField, BlobField, Model, DoesNotExist, IntegerField, TimestampField
+from peewee import TextField, CharField, BlobField, Model, DoesNotExist, IntegerField, TimestampField, \
+    Expression, Case, fn, SENTINEL, SQL
 from playhouse.migrate import SqliteMigrator, migrate
 from playhouse.sqliteq import SqliteQueueDatabase
 
+from .constants import MsgState
+from .metrics import Histogram
+
 if TYPE_CHECKING:
     from . import ParaboxChannel
+    from .chat import EPMChatType
+
+
+logger = logging.getLogger(__name__)
+
+
+class EPMQueueDatabase(SqliteQueueDatabase):
+    """Queue database keeping statistics of statements run by its writer."""
+
+    WRITE_STALL_THRESHOLD = 1.0
+    """Seconds a single write may take before it is logged as a stall."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.commit_count = 0
+        self.commit_time_total = 0.0
+        self.commit_time_max = 0.0
+        self.commit_time_last = 0.0
+        self.commit_histogram = Histogram()
+
+        execute = self._execute
+
+        def timed_execute(sql, params=None, commit=SENTINEL):
+            if not commit:
+                # Reads are run on the calling thread, not the writer.
+                return execute(sql, params, commit=commit)
+            start = time.perf_counter()
+            try:
+                return execute(sql, params, commit=commit)
+            finally:
+                self._record_commit(sql, time.perf_counter() - start)
 
-database = SqliteQueueDatabase(None, autostart=False)
+        self._execute = timed_execute
+
+    def _record_commit(self, sql: str, duration: float):
+        self.commit_count += 1
+        self.commit_time_total += duration
+        self.commit_time_last = duration
+        self.commit_histogram.observe(duration)
+        self.commit_time_max = max(self.commit_time_max, duration)
+        if duration > self.WRITE_STALL_THRESHOLD:
+            logger.warning("Database write took %.3fs with %s queued: %.100s",
+                           duration, self.queue_size(), sql)
+
+    def stats(self) -> Dict[str, Any]:
+        """Writer queue depth and commit latency."""
+        return {
+            "queue_depth": self.queue_size(),
+            "commit_count": self.commit_count,
+            "commit_time_avg": self.commit_time_total / self.commit_count if self.commit_count else 0.0,
+            "commit_time_max": self.commit_time_max,
+            "commit_time_last": self.commit_time_last,
+        }
+
+
+database = EPMQueueDatabase(None, autostart=False)
 
 
 class BaseModel(Model):
@@ -25,11 +86,18 @@ class SlaveChatInfo(BaseModel):
     slave_channel_id = TextField()
     slave_channel_emoji = CharField()
     slave_chat_uid = TextField()
-    slave_chat_group_id = TextField(null=True)
+    slave_chat_group_id = TextField(null=True, default='')
     slave_chat_name = TextField()
     slave_chat_alias = TextField(null=True)
     slave_chat_type = CharField()
     pickle = BlobField(null=True)
+    record = BlobField(null=True)
+
+    class Meta:
+        indexes = (
+            (('slave_channel_id', 'slave_chat_uid', 'slave_chat_group_id'), True),
+            (('slave_channel_id', 'slave_chat_group_id'), False),
+        )
 
 
 class MsgJson(BaseModel):
@@ -37,59 +105,181 @@ class MsgJson(BaseModel):
     json = TextField()
     tried = IntegerField()
     last_try_timestamp = TimestampField(default=0)
+    next_attempt_at = IntegerField(default=0)
+    state = IntegerField(default=MsgState.PENDING)
+    created_at = IntegerField(default=0, index=True)
+
+    class Meta:
+        indexes = (
+            (('state', 'next_attempt_at'), False),
+        )
+
+
+class MsgIdMap(BaseModel):
+    parabox_msg_id = TextField(primary_key=True)
+    slave_channel_id = TextField()
+    slave_origin_uid = TextField()
+    slave_msg_id = TextField()
+    content_hash = TextField(null=True)
+    created_at = IntegerField(index=True)
+
+    class Meta:
+        indexes = (
+            (('slave_channel_id', 'slave_msg_id'), False),
+        )
+
+
+SQLITE_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+"""If SQLite supports ``RETURNING`` clauses, otherwise rows are selected before they are changed."""
 
 
 class DatabaseManager:
     logger = logging.getLogger(__name__)
     FAIL_FLAG = '__fail__'
+    MEMBER_TYPE_NAME = 'Member'
 
     def __init__(self, channel: 'ParaboxChannel'):
         base_path = utils.get_data_path(channel.channel_id)
 
+        self.apply_config(channel.config)
+
+        # Storage profile
+        pragmas = {
+            # auto_vacuum must come before anything that initializes the database file.
+            "auto_vacuum": "incremental",
+            "journal_mode": "wal",
+            "synchronous": channel.config.get("db_synchronous", "normal"),
+            "cache_size": channel.config.get("db_cache_size", -16000),
+            "mmap_size": channel.config.get("db_mmap_size", 64 * 1024 * 1024),
+            "temp_store": channel.config.get("db_temp_store", "memory"),
+        }
         self.logger.debug("Loading database...")
-        database.init(str(base_path / 'pbdata.db'))
+        database.init(str(base_path / 'pbdata.db'), pragmas=pragmas)
         database.start()
         database.connect()
         self.logger.debug("Database loaded.")
+        if not SQLITE_RETURNING:
+            self.logger.info("SQLite %s does not support RETURNING (3.35 and later), messages are claimed for "
+                             "retry with a SELECT before the UPDATE.", sqlite3.sqlite_version)
 
         self.logger.debug("Checking database migration...")
-        if not MsgJson.table_exists():
-            self._create()
-        else:
-            msg_json_columns = {i.name for i in database.get_columns("msgjson")}
-            slave_chat_info_columns = {i.name for i in database.get_columns("slavechatinfo")}
-            if "last_try_timestamp" not in msg_json_columns:
-                self._migrate(0)
+        self._migrate()
+        self.incremental_vacuum = database.pragma("auto_vacuum") == 2
+        """If the database is set up for incremental vacuum, see :meth:`convert_auto_vacuum`."""
+
+        self._stop_maintenance = threading.Event()
+        self._maintenance_thread = threading.Thread(target=self._maintenance_loop, name="EPMDatabaseMaintenance",
+                                                    daemon=True)
+        self._maintenance_thread.start()
+
+    def apply_config(self, config: dict):
+        """Apply tunables from the configuration, also when it is reloaded.
+
+        Pragmas of the storage profile only change on restart.
+        """
+        # Retry scheduling of outbound messages
+        self.retry_base_delay: int = config.get("retry_base_delay", 5)
+        self.retry_max_delay: int = config.get("retry_max_delay", 600)
+        self.retry_max_attempts: int = config.get("retry_max_attempts", 20)
+        self.retry_batch_size: int = config.get("retry_batch_size", 100)
+
+        # Maintenance
+        self.checkpoint_interval: float = config.get("db_checkpoint_interval", 300)
+        self.vacuum_interval: float = config.get("db_vacuum_interval", 3600)
+        self.vacuum_pages: int = config.get("db_vacuum_pages", 1000)
+        self.vacuum_convert: bool = config.get("db_vacuum_convert", True)
 
     def stop_worker(self):
+        self._stop_maintenance.set()
         database.stop()
 
+    @staticmethod
+    def stats() -> Dict[str, Any]:
+        return database.stats()
+
+    @property
+    def commit_histogram(self) -> Histogram:
+        """Latency of database writes."""
+        return database.commit_histogram
+
+    def _maintenance_loop(self):
+        """Run WAL checkpoints and incremental vacuum on schedule."""
+        last_checkpoint = last_vacuum = time.monotonic()
+        while not self._stop_maintenance.wait(min(self.checkpoint_interval, self.vacuum_interval)):
+            now = time.monotonic()
+            # noinspection PyBroadException
+            try:
+                if now - last_checkpoint >= self.checkpoint_interval:
+                    last_checkpoint = now
+                    busy, log_pages, checkpointed = database.execute_sql("PRAGMA wal_checkpoint(PASSIVE)").fetchone()
+                    self.logger.debug("WAL checkpoint: %s of %s pages, busy: %s", checkpointed, log_pages, busy)
+                if now - last_vacuum >= self.vacuum_interval:
+                    last_vacuum = now
+                    if self.incremental_vacuum:
+                        database.execute_sql(f"PRAGMA incremental_vacuum({int(self.vacuum_pages)})").fetchall()
+                    elif self.vacuum_convert:
+                        self.convert_auto_vacuum()
+                self.logger.debug("Database writer stats: %s", database.stats())
+            except Exception:
+                self.logger.exception("Error occurred while running database maintenance.")
+
+    def convert_auto_vacuum(self):
+        """
+        Set up a database created before incremental vacuum for it.
+
+        ``auto_vacuum`` is set on connection, but only takes effect on
+        existing databases after a full ``VACUUM``, which rewrites the whole
+        file and holds all other writes until done. It is run once from the
+        maintenance thread instead of at startup, unless ``db_vacuum_convert``
+        is disabled.
+        """
+        start = time.perf_counter()
+        database.execute_sql("VACUUM").fetchall()
+        self.incremental_vacuum = database.pragma("auto_vacuum") == 2
+        self.logger.info("Database converted for incremental vacuum in %.3fs.", time.perf_counter() - start)
+
     @staticmethod
     def _create():
         """
         Initializing tables.
         """
-        database.create_tables([SlaveChatInfo, MsgJson])
+        database.create_tables([SlaveChatInfo, MsgJson, MsgIdMap])
 
-    @staticmethod
-    def _migrate(i: int):
+    def _migrate(self):
         """
-        Run migrations.
+        Bring the database schema up to date.
 
-        Args:
-            i: Migration ID
+        The schema version is recorded in ``PRAGMA user_version``, and each
+        pending migration in :data:`MIGRATIONS` is run once, in order.
+        A new database is created at the latest version directly.
         """
-        migrator = SqliteMigrator(database)
+        version = database.user_version
+        if version == 0 and not MsgJson.table_exists():
+            self._create()
+            database.user_version = len(MIGRATIONS)
+            return
 
-        if i <= 0:
-            # Migration 0: Add media file ID and editable message ID
-            migrate(
-                migrator.add_column("msgjson", "last_try_timestamp", MsgJson.last_try_timestamp),
-            )
+        migrator = SqliteMigrator(database)
+        for i in range(version, len(MIGRATIONS)):
+            self.logger.info("Running database migration %s...", i)
+            MIGRATIONS[i](migrator)
+            # Pragma queries go through the writer queue, so this waits for the migration.
+            database.user_version = i + 1
+        self.logger.debug("Database schema is at version %s.", len(MIGRATIONS))
 
     @staticmethod
-    def refresh_msg_json():
-        query = MsgJson.update(tried=0)
+    def refresh_msg_json(include_dead: bool = True):
+        """
+        Reschedule stored messages for immediate retry.
+
+        Args:
+            include_dead: Also revive dead letters, with all of their
+                attempts available again.
+        """
+        if include_dead:
+            query = MsgJson.update(tried=0, next_attempt_at=0, state=MsgState.PENDING)
+        else:
+            query = MsgJson.update(next_attempt_at=0).where(MsgJson.state == MsgState.PENDING)
         query.execute()
 
     @staticmethod
@@ -109,48 +299,176 @@ class DatabaseManager:
         else:
             return MsgJson.create(uid=uid,
                                   json=json,
-                                  tried=0)
+                                  tried=0,
+                                  created_at=int(time.time()))
 
-    @staticmethod
-    def take_msg_json() -> Optional[MsgJson]:
-        try:
-            msg_json: MsgJson = MsgJson.select() \
-                .where(int(time.time()) - MsgJson.last_try_timestamp > 5) \
-                .order_by(MsgJson.tried) \
-                .first()
-            if msg_json is not None:
-                msg_json.tried = msg_json.tried + 1
-                msg_json.last_try_timestamp = int(time.time())
-                msg_json.save()
-                return msg_json
-            else:
+    def add_msg_jsons(self, items: List[Tuple[str, str, int]]):
+        """
+        Store messages to Parabox already sent once, in batches, to be
+        retried until the client confirms them.
+
+        Args:
+            items: Message ID, JSON and timestamp of the first attempt of
+                each message.
+        """
+        rows = [{"uid": uid, "json": json, "tried": 1, "last_try_timestamp": sent_at,
+                 "next_attempt_at": sent_at + self.retry_base_delay, "state": MsgState.PENDING,
+                 "created_at": sent_at}
+                for uid, json, sent_at in items]
+        batch_size = 999 // len(MsgJson._meta.fields)
+        for i in range(0, len(rows), batch_size):
+            MsgJson.insert_many(rows[i:i + batch_size]).on_conflict_replace().execute()
+
+    def take_all_msg_json(self, limit: Optional[int] = None) -> Optional[List[MsgJson]]:
+        """
+        Claim a batch of messages that are due for another attempt.
+
+        The batch is claimed and rescheduled in a single ``UPDATE ... RETURNING``
+        statement, or an ``UPDATE`` of the messages selected before it on
+        SQLite older than 3.35, using exponential backoff with jitter on the
+        number of attempts. A message claimed for its last allowed attempt is moved to
+        the dead-letter state, and will not be claimed again until refreshed.
+
+        Args:
+            limit: Maximum number of messages to claim, ``retry_batch_size``
+                if not provided.
+
+        Returns:
+            List of claimed messages, oldest due first, None if nothing is due.
+        """
+        now = int(time.time())
+        is_due = (MsgJson.state == MsgState.PENDING) & (MsgJson.next_attempt_at <= now)
+        due = MsgJson.select(MsgJson.uid) \
+            .where(is_due) \
+            .order_by(MsgJson.next_attempt_at, MsgJson.created_at) \
+            .limit(limit or self.retry_batch_size)
+        # delay = min(max_delay, base_delay * 2 ^ tried), half of which is jitter
+        delay = fn.MIN(self.retry_max_delay, Expression(self.retry_base_delay, '<<', fn.MIN(MsgJson.tried, 30)))
+        query = MsgJson.update(
+            tried=MsgJson.tried + 1,
+            last_try_timestamp=now,
+            next_attempt_at=now + delay / 2 + fn.ABS(fn.RANDOM()) % (delay / 2 + 1),
+            state=Case(None, [(MsgJson.tried + 1 >= self.retry_max_attempts, MsgState.DEAD)], MsgState.PENDING),
+        )
+        if SQLITE_RETURNING:
+            msg_json_list = list(query.where(MsgJson.uid.in_(due)).returning(MsgJson).execute())
+        else:
+            # Messages still due when updated are claimed, and read back by the time of the attempt,
+            # as a claimed message is not due again within the same second.
+            uids = [i[0] for i in due.tuples()]
+            if not uids:
                 return None
-        except DoesNotExist:
-            return None
+            query.where(MsgJson.uid.in_(uids) & is_due).execute()
+            msg_json_list = list(MsgJson.select().where(MsgJson.uid.in_(uids) & (MsgJson.last_try_timestamp == now)))
+        msg_json_list.sort(key=lambda i: i.created_at)
+        if len(msg_json_list) > 0:
+            return msg_json_list
+        return None
 
     @staticmethod
-    def take_all_msg_json() -> Optional[list[MsgJson]]:
-        try:
-            query = MsgJson.select() \
-                .where(int(time.time()) - MsgJson.last_try_timestamp > 5) \
-                .order_by(MsgJson.tried)
-            msg_json_list = list(query)
-            if len(msg_json_list) > 0:
-                for msg_json in msg_json_list:
-                    msg_json.tried = msg_json.tried + 1
-                    msg_json.last_try_timestamp = int(time.time())
-                    msg_json.save()
-                return msg_json_list
-            else:
-                return None
-        except DoesNotExist:
-            return None
+    def get_msg_json_usage() -> Tuple[int, int]:
+        """
+        Returns:
+            Number of stored messages, and their total size in bytes.
+        """
+        count, size = MsgJson.select(fn.COUNT(MsgJson.uid), fn.SUM(fn.LENGTH(MsgJson.json)).coerce(False)) \
+            .scalar(as_tuple=True)
+        return count, size or 0
+
+    @staticmethod
+    def get_oldest_msg_json_sizes(limit: int) -> List[int]:
+        """Sizes in bytes of the oldest stored messages, in the order :meth:`delete_oldest_msg_json` deletes them."""
+        return [i[0] for i in MsgJson.select(fn.LENGTH(MsgJson.json).coerce(False))
+                .order_by(MsgJson.created_at, SQL("rowid")).limit(limit).tuples()]
+
+    @staticmethod
+    def delete_oldest_msg_json(limit: int, created_before: Optional[int] = None) -> Tuple[int, int]:
+        """
+        Delete a batch of the oldest stored messages.
+
+        On SQLite older than 3.35, without ``RETURNING``, the size of
+        messages confirmed while the batch is deleted is counted anyway.
+
+        Args:
+            limit: Maximum number of messages to delete.
+            created_before: Only delete messages created before this timestamp.
+
+        Returns:
+            Number of messages deleted, and their total size in bytes.
+        """
+        oldest = MsgJson.select(MsgJson.uid).order_by(MsgJson.created_at, SQL("rowid")).limit(limit)
+        if created_before is not None:
+            oldest = oldest.where(MsgJson.created_at < created_before)
+        if not SQLITE_RETURNING:
+            # Sizes are taken before the messages are deleted.
+            selected = list(oldest.select(MsgJson.uid, fn.LENGTH(MsgJson.json).coerce(False)).tuples())
+            deleted = MsgJson.delete().where(MsgJson.uid.in_([i[0] for i in selected])).execute() \
+                if selected else 0
+            return deleted, sum(i[1] for i in selected)
+        deleted = list(MsgJson.delete()
+                       .where(MsgJson.uid.in_(oldest))
+                       .returning(fn.LENGTH(MsgJson.json).coerce(False))
+                       .tuples()
+                       .execute())
+        return len(deleted), sum(i[0] for i in deleted)
+
+    @staticmethod
+    def get_pending_msg_json() -> List[Tuple[str, str]]:
+        """
+        All stored messages to Parabox, including dead letters, in the order they are stored.
+
+        Returns:
+            Message ID and JSON of each message.
+        """
+        return list(MsgJson.select(MsgJson.uid, MsgJson.json).order_by(MsgJson.created_at, SQL("rowid")).tuples())
+
+    @staticmethod
+    def delete_msg_jsons(uids: List[str]):
+        """Delete stored messages to Parabox, in batches."""
+        for i in range(0, len(uids), 999):
+            MsgJson.delete().where(MsgJson.uid.in_(uids[i:i + 999])).execute()
 
     @staticmethod
     def resort_msg_json(uid):
         return MsgJson.delete() \
             .where(MsgJson.uid == uid).execute()
 
+    @staticmethod
+    def set_msg_id_maps(rows: List[Dict[str, Any]]):
+        """
+        Insert or replace message ID mappings in batches.
+
+        Args:
+            rows: Mappings with the fields of :class:`MsgIdMap`.
+        """
+        batch_size = 999 // len(MsgIdMap._meta.fields)
+        for i in range(0, len(rows), batch_size):
+            MsgIdMap.replace_many(rows[i:i + batch_size]).execute()
+
+    @staticmethod
+    def get_msg_id_map(parabox_msg_id: str) -> Optional[MsgIdMap]:
+        return MsgIdMap.get_or_none(MsgIdMap.parabox_msg_id == parabox_msg_id)
+
+    @staticmethod
+    def get_msg_id_map_by_slave(slave_channel_id: ModuleID, slave_msg_id: str) -> Optional[MsgIdMap]:
+        return MsgIdMap.select() \
+            .where((MsgIdMap.slave_channel_id == slave_channel_id) &
+                   (MsgIdMap.slave_msg_id == slave_msg_id)) \
+            .order_by(MsgIdMap.created_at.desc()).first()
+
+    @staticmethod
+    def delete_msg_id_maps_before(created_before: int, limit: int) -> int:
+        """
+        Delete a batch of message ID mappings created before a timestamp.
+
+        Returns:
+            Number of mappings deleted.
+        """
+        oldest = MsgIdMap.select(MsgIdMap.parabox_msg_id) \
+            .where(MsgIdMap.created_at < created_before) \
+            .limit(limit)
+        return MsgIdMap.delete().where(MsgIdMap.parabox_msg_id.in_(oldest)).execute()
+
     @staticmethod
     def get_slave_chat_info(slave_channel_id: Optional[ModuleID] = None,
                             slave_chat_uid: Optional[ChatID] = None,
@@ -168,60 +486,239 @@ class DatabaseManager:
             return SlaveChatInfo.select() \
                 .where((SlaveChatInfo.slave_channel_id == slave_channel_id) &
                        (SlaveChatInfo.slave_chat_uid == slave_chat_uid) &
-                       (SlaveChatInfo.slave_chat_group_id == slave_chat_group_id)).first()
+                       (SlaveChatInfo.slave_chat_group_id == (slave_chat_group_id or ''))).first()
         except DoesNotExist:
             return None
 
-    def set_slave_chat_info(self, chat_object: 'ETMChatType') -> SlaveChatInfo:
+    @staticmethod
+    def get_slave_chat_records(slave_channel_id: ModuleID, slave_chat_uids: List[ChatID]) -> Dict[ChatID, bytes]:
+        """
+        Get records of many chats (not members) of a slave channel, in batches.
+
+        Returns:
+            Records of the chats found, by chat ID.
+        """
+        result: Dict[ChatID, bytes] = dict()
+        # Stay below the limit of bound parameters in a statement
+        batch_size = 900
+        for i in range(0, len(slave_chat_uids), batch_size):
+            query = SlaveChatInfo.select(SlaveChatInfo.slave_chat_uid, SlaveChatInfo.record) \
+                .where((SlaveChatInfo.slave_channel_id == slave_channel_id) &
+                       (SlaveChatInfo.slave_chat_uid.in_(slave_chat_uids[i:i + batch_size])) &
+                       (SlaveChatInfo.slave_chat_group_id == '') &
+                       (SlaveChatInfo.record.is_null(False))) \
+                .tuples()
+            result.update((ChatID(uid), bytes(record)) for uid, record in query)
+        return result
+
+    def set_slave_chat_info(self, chat_object: 'EPMChatType') -> SlaveChatInfo:
         """
         Insert or update slave chat info entry
 
         Args:
-            chat_object (ETMChatType): Chat object for pickling
+            chat_object (EPMChatType): Chat object to store
 
         Returns:
             SlaveChatInfo: The inserted or updated row
         """
-        slave_channel_id = chat_object.module_id
-        slave_channel_name = chat_object.module_name
-        slave_channel_emoji = chat_object.channel_emoji
-        slave_chat_uid = chat_object.uid
-        slave_chat_name = chat_object.name
-        slave_chat_alias = chat_object.alias
-        slave_chat_type = chat_object.chat_type_name
-        parent_chat: Optional['ETMChatType'] = getattr(chat_object, 'chat', None)
-        slave_chat_group_id: Optional[ChatID]
-        if parent_chat:
-            slave_chat_group_id = parent_chat.uid
-        else:
-            slave_chat_group_id = None
-
-        chat_info = self.get_slave_chat_info(slave_channel_id=slave_channel_id,
-                                             slave_chat_uid=slave_chat_uid,
-                                             slave_chat_group_id=slave_chat_group_id)
-        if chat_info is not None:
-            chat_info.slave_channel_name = slave_channel_name
-            chat_info.slave_channel_emoji = slave_channel_emoji
-            chat_info.slave_chat_name = slave_chat_name
-            chat_info.slave_chat_alias = slave_chat_alias
-            chat_info.slave_chat_type = slave_chat_type
-            chat_info.pickle = chat_object.pickle
-            chat_info.save()
-            return chat_info
-        else:
-            return SlaveChatInfo.create(slave_channel_id=slave_channel_id,
-                                        slave_channel_name=slave_channel_name,
-                                        slave_channel_emoji=slave_channel_emoji,
-                                        slave_chat_uid=slave_chat_uid,
-                                        slave_chat_group_id=slave_chat_group_id,
-                                        slave_chat_name=slave_chat_name,
-                                        slave_chat_alias=slave_chat_alias,
-                                        slave_chat_type=slave_chat_type,
-                                        pickle=chat_object.pickle)
+        fields = self._slave_chat_info_row(chat_object)
+        self._upsert_slave_chat_info([fields])
+        return SlaveChatInfo(**fields)
+
+    @staticmethod
+    def _slave_chat_info_row(chat_object: 'EPMChatType') -> Dict[str, Any]:
+        return dict(slave_channel_id=chat_object.module_id,
+                    slave_channel_emoji=chat_object.channel_emoji,
+                    slave_chat_uid=chat_object.uid,
+                    slave_chat_group_id='',
+                    slave_chat_name=chat_object.name,
+                    slave_chat_alias=chat_object.alias,
+                    slave_chat_type=chat_object.chat_type_name,
+                    pickle=None,
+                    record=chat_object.record)
+
+    def set_slave_chat_infos(self, chat_objects: List['EPMChatType']):
+        """
+        Insert or update slave chat info entries of many chats in batches.
+
+        Members are not stored.
+        """
+        if not chat_objects:
+            return
+        self._upsert_slave_chat_info([self._slave_chat_info_row(chat_object) for chat_object in chat_objects])
+
+    def set_slave_chat_members(self, chat_object: 'EPMChatType', members: List[ChatMember]):
+        """
+        Insert or update slave chat info entries of members of a chat in one statement.
+
+        Args:
+            chat_object (EPMChatType): Chat the members belong to
+            members: Members to store
+        """
+        from .chat import member_record
+        # Import inline to prevent cyclic import
+        self._upsert_slave_chat_info([
+            dict(slave_channel_id=chat_object.module_id,
+                 slave_channel_emoji=chat_object.channel_emoji,
+                 slave_chat_uid=member.uid,
+                 slave_chat_group_id=chat_object.uid,
+                 slave_chat_name=member.name,
+                 slave_chat_alias=member.alias,
+                 slave_chat_type=self.MEMBER_TYPE_NAME,
+                 pickle=None,
+                 record=member_record(member))
+            for member in members
+        ])
+
+    @staticmethod
+    def _upsert_slave_chat_info(rows: List[Dict]):
+        # Stay below the limit of bound parameters in a statement
+        batch_size = 999 // len(rows[0])
+        for i in range(0, len(rows), batch_size):
+            SlaveChatInfo.insert_many(rows[i:i + batch_size]) \
+                .on_conflict(conflict_target=[SlaveChatInfo.slave_channel_id,
+                                              SlaveChatInfo.slave_chat_uid,
+                                              SlaveChatInfo.slave_chat_group_id],
+                             preserve=[SlaveChatInfo.slave_channel_emoji,
+                                       SlaveChatInfo.slave_chat_name,
+                                       SlaveChatInfo.slave_chat_alias,
+                                       SlaveChatInfo.slave_chat_type,
+                                       SlaveChatInfo.pickle,
+                                       SlaveChatInfo.record]) \
+                .execute()
 
     @staticmethod
     def delete_slave_chat_info(slave_channel_id: ModuleID, slave_chat_uid: ChatID, slave_chat_group_id: ChatID = None):
         return SlaveChatInfo.delete() \
             .where((SlaveChatInfo.slave_channel_id == slave_channel_id) &
                    (SlaveChatInfo.slave_chat_uid == slave_chat_uid) &
+                   (SlaveChatInfo.slave_chat_group_id == (slave_chat_group_id or ''))).execute()
+
+    @staticmethod
+    def delete_slave_chats(slave_channel_id: ModuleID, slave_chat_uids: List[ChatID]):
+        """Delete many chats of a slave channel, and their members, in batches.
+
+        Statements are queued to the writer without waiting for them, and
+        written in SQL, as building long lists of parameters with the query
+        builder takes longer than running them.
+        """
+        # Stay below the limit of bound parameters in a statement
+        batch_size = 900
+        table = SlaveChatInfo._meta.table_name
+        for i in range(0, len(slave_chat_uids), batch_size):
+            uids = slave_chat_uids[i:i + batch_size]
+            placeholders = ", ".join("?" * len(uids))
+            database.execute_sql(f"DELETE FROM {table} WHERE slave_channel_id = ? AND slave_chat_group_id = '' "
+                                 f"AND slave_chat_uid IN ({placeholders})", [slave_channel_id, *uids])
+            database.execute_sql(f"DELETE FROM {table} WHERE slave_channel_id = ? "
+                                 f"AND slave_chat_group_id IN ({placeholders})", [slave_channel_id, *uids])
+
+    @staticmethod
+    def delete_slave_chat_members(slave_channel_id: ModuleID, slave_chat_group_id: ChatID) -> int:
+        """Delete all members of a group in one statement.
+
+        Returns:
+            Number of members deleted.
+        """
+        return SlaveChatInfo.delete() \
+            .where((SlaveChatInfo.slave_channel_id == slave_channel_id) &
                    (SlaveChatInfo.slave_chat_group_id == slave_chat_group_id)).execute()
+
+
+def _migration_0(migrator: SqliteMigrator):
+    """Add last try timestamp of outbound messages."""
+    # Databases created before versioning may already have the columns of
+    # migrations 0 and 1.
+    if "last_try_timestamp" not in {i.name for i in database.get_columns("msgjson")}:
+        migrate(
+            migrator.add_column("msgjson", "last_try_timestamp", MsgJson.last_try_timestamp),
+        )
+
+
+def _migration_1(migrator: SqliteMigrator):
+    """Add retry schedule and dead-letter state of outbound messages."""
+    if "next_attempt_at" not in {i.name for i in database.get_columns("msgjson")}:
+        migrate(
+            migrator.add_column("msgjson", "next_attempt_at", MsgJson.next_attempt_at),
+            migrator.add_column("msgjson", "state", MsgJson.state),
+            migrator.add_index("msgjson", ("state", "next_attempt_at"), False),
+        )
+
+
+def _migration_2(migrator: SqliteMigrator):
+    """Add unique index on slave chat info keys."""
+    # NULLs are distinct in a unique index, so chats that are not group
+    # members are stored with an empty group ID instead.
+    SlaveChatInfo.update(slave_chat_group_id='') \
+        .where(SlaveChatInfo.slave_chat_group_id.is_null()).execute()
+    latest = SlaveChatInfo.select(fn.MAX(SlaveChatInfo.id)) \
+        .group_by(SlaveChatInfo.slave_channel_id, SlaveChatInfo.slave_chat_uid, SlaveChatInfo.slave_chat_group_id)
+    SlaveChatInfo.delete().where(SlaveChatInfo.id.not_in(latest)).execute()
+    migrate(
+        migrator.add_index("slavechatinfo", ("slave_channel_id", "slave_chat_uid", "slave_chat_group_id"), True),
+    )
+
+
+def _migration_3(migrator: SqliteMigrator):
+    """Add compact chat records, replacing pickles."""
+    migrate(
+        migrator.add_column("slavechatinfo", "record", SlaveChatInfo.record),
+    )
+
+
+def _migration_4(migrator: SqliteMigrator):
+    """Enable incremental vacuum."""
+    # Existing databases are converted later by the maintenance thread, as a
+    # full VACUUM would hold startup, see DatabaseManager.convert_auto_vacuum.
+
+
+def _migration_5(migrator: SqliteMigrator):
+    """Add creation time of outbound messages for retention."""
+    migrate(
+        migrator.add_column("msgjson", "created_at", MsgJson.created_at),
+        migrator.add_index("msgjson", ("created_at",), False),
+    )
+
+
+def _migration_6(migrator: SqliteMigrator):
+    """Add mapping of message IDs between Parabox and slave channels."""
+    database.create_tables([MsgIdMap])
+
+
+def _migration_7(migrator: SqliteMigrator):
+    """Index chat info by group, for bulk operations on members."""
+    migrate(
+        migrator.add_index("slavechatinfo", ("slave_channel_id", "slave_chat_group_id"), False),
+    )
+
+
+def _migration_8(migrator: SqliteMigrator):
+    """Add content hash of messages from Parabox, for deduplication."""
+    # The table may be created by migration 6 with the current columns.
+    if "content_hash" not in {i.name for i in database.get_columns("msgidmap")}:
+        migrate(
+            migrator.add_column("msgidmap", "content_hash", MsgIdMap.content_hash),
+        )
+
+
+def _migration_9(migrator: SqliteMigrator):
+    """Set creation time of outbound messages stored before it was recorded."""
+    # Messages without it would be the first to expire in retention.
+    MsgJson.update(created_at=Case(None, [(MsgJson.last_try_timestamp > 0, MsgJson.last_try_timestamp)],
+                                   int(time.time()))) \
+        .where(MsgJson.created_at == 0).execute()
+
+
+MIGRATIONS: List[Callable[[SqliteMigrator], None]] = [
+    _migration_0,
+    _migration_1,
+    _migration_2,
+    _migration_3,
+    _migration_4,
+    _migration_5,
+    _migration_6,
+    _migration_7,
+    _migration_8,
+    _migration_9,
+]
+"""Schema migrations, indexed by the schema version they upgrade from."""
@@ -0,0 +1,310 @@
+# coding=utf-8
+
+import gc
+import hmac
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple
+
+from ehforwarderbot import utils as efb_utils
+
+if TYPE_CHECKING:
+    from . import ParaboxChannel
+
+FrameKey = Tuple[str, int, str]
+"""Function in a sampled stack: file name, first line number, function name"""
+
+StackKey = Tuple[str, Tuple[FrameKey, ...]]
+"""Sampled stack: thread name, frames from innermost to outermost"""
+
+IDLE_FRAMES = frozenset({
+    ("threading.py", "wait"), ("threading.py", "_wait_for_tstate_lock"), ("selectors.py", "select"),
+    ("queue.py", "get"), ("thread.py", "_worker"),
+})
+"""Innermost functions of threads waiting for work, by file name and function name."""
+
+
+class SamplingProfiler:
+    """CPU profiler sampling the stacks of all threads at an interval.
+
+    Samples are taken from a thread of its own with
+    :func:`sys._current_frames`, so that the profiled code runs unchanged,
+    at a cost that only depends on the interval.
+    """
+
+    def __init__(self, interval: float, max_duration: float):
+        self.interval = interval
+        self.max_duration = max_duration
+        self.stacks: 'Counter[StackKey]' = Counter()
+        self.samples = 0
+        self.started_at = time.monotonic()
+        self.stopped_at: Optional[float] = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="EPMProfiler", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+                    frame = frame.f_back
+                self.stacks[(names.get(ident, str(ident)), tuple(stack))] += 1
+            self.samples += 1
+            if time.monotonic() - self.started_at > self.max_duration:
+                break
+        self.stopped_at = time.monotonic()
+
+    @property
+    def running(self) -> bool:
+        return self._thread.is_alive()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def summary(self, limit: int) -> Dict[str, Any]:
+        """Functions taking the most samples, by own samples and samples
+        including callees, leaving out threads waiting for work."""
+        own: 'Counter[FrameKey]' = Counter()
+        total: 'Counter[FrameKey]' = Counter()
+        threads: 'Counter[str]' = Counter()
+        idle = 0
+        for (thread, stack), count in self.stacks.items():
+            if (os.path.basename(stack[0][0]), stack[0][2]) in IDLE_FRAMES:
+                idle += count
+                continue
+            own[stack[0]] += count
+            for frame in set(stack):
+                total[frame] += count
+            threads[thread] += count
+
+        def top(counter: 'Counter[FrameKey]') -> List[Dict[str, Any]]:
+            return [{"function": format_frame(frame), "samples": count} for frame, count in counter.most_common(limit)]
+
+        return {
+            "duration": round((self.stopped_at or time.monotonic()) - self.started_at, 3),
+            "samples": self.samples,
+            "interval": self.interval,
+            "idle": idle,
+            "threads": dict(threads.most_common()),
+            "own": top(own),
+            "total": top(total),
+        }
+
+    def write_folded(self, path: Path):
+        """Write stacks in the folded format of flame graph tools, outermost frame first."""
+        with open(path, "w", encoding="utf-8") as f:
+            for (thread, stack), count in self.stacks.most_common():
+                f.write(";".join([thread] + [format_frame(i) for i in reversed(stack)]) + f" {count}\n")
+
+
+def format_frame(frame: FrameKey) -> str:
+    return f"{frame[2]} ({os.path.basename(frame[0])}:{frame[1]})"
+
+
+class DiagnosticsManager:
+    """Profile and inspect memory of the running bridge, on request of the client.
+
+    Requests are ``diagnostics`` frames carrying ``admin_token``, and are
+    refused if it is not set. Actions are:
+
+    * ``summary``: sizes of queues, caches and other big structures.
+    * ``cpu_start``, ``cpu_stop``: sample stacks of all threads, and
+      report the functions taking the most samples. Stacks are also
+      written for flame graphs to ``profiles`` in the data directory.
+    * ``memory_start``, ``memory_snapshot``, ``memory_stop``: trace memory
+      allocations with :mod:`tracemalloc`, and report where the most memory
+      is allocated, and the growth since the last snapshot.
+    """
+
+    def __init__(self, channel: 'ParaboxChannel'):
+        self.channel = channel
+        self.logger = logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        self.profiler: Optional[SamplingProfiler] = None
+        self.last_snapshot: Optional[tracemalloc.Snapshot] = None
+        self.profile_path = efb_utils.get_data_path(channel.channel_id) / "profiles"
+        self.apply_config(channel.config)
+
+    def apply_config(self, config: dict):
+        """Apply tunables from the configuration, also when it is reloaded."""
+        self.admin_token: Optional[str] = config.get("admin_token")
+        self.profile_interval: float = config.get("profile_interval", 0.01)
+        self.profile_max_duration: float = config.get("profile_max_duration", 300)
+
+    def handle(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Run an action of a ``diagnostics`` frame.
+
+        Returns:
+            Result of the action.
+
+        Raises:
+            PermissionError: If the token is incorrect, or diagnostics are
+                disabled.
+            ValueError: If the action is unknown, or not possible now.
+        """
+        self.check_admin_token(data.get('token'), "diagnostics")
+        action = data['action']
+        limit = data.get('limit', 20)
+        self.logger.info("Running diagnostics action %s.", action)
+        with self.lock:
+            if action == 'summary':
+                return self.summary()
+            if action == 'cpu_start':
+                return self.start_cpu_profile(data.get('interval', self.profile_interval))
+            if action == 'cpu_stop':
+                return self.stop_cpu_profile(limit)
+            if action == 'memory_start':
+                return self.start_memory_trace(data.get('frames', 1))
+            if action == 'memory_snapshot':
+                return self.memory_snapshot(limit)
+            if action == 'memory_stop':
+                return self.stop_memory_trace()
+        raise ValueError(f"unknown action {action!r}")
+
+    def check_admin_token(self, token: Optional[str], feature: str):
+        """
+        Check the admin token of a request for an admin feature.
+
+        Raises:
+            PermissionError: If the token is incorrect, or admin features
+                are disabled.
+        """
+        if not self.admin_token:
+            raise PermissionError(f"{feature} is disabled")
+        if not hmac.compare_digest(str(token or "").encode(), str(self.admin_token).encode()):
+            raise PermissionError("token incorrect")
+
+    def start_cpu_profile(self, interval: float) -> Dict[str, Any]:
+        if self.profiler is not None and self.profiler.running:
+            raise ValueError("CPU profile is already running")
+        if not 0.001 <= interval <= 1:
+            raise ValueError("interval must be between 0.001 and 1 seconds")
+        self.profiler = SamplingProfiler(interval, self.profile_max_duration)
+        return {"interval": interval, "max_duration": self.profile_max_duration}
+
+    def stop_cpu_profile(self, limit: int) -> Dict[str, Any]:
+        profiler, self.profiler = self.profiler, None
+        if profiler is None:
+            raise ValueError("CPU profile is not running")
+        profiler.stop()
+        self.profile_path.mkdir(parents=True, exist_ok=True)
+        path = self.profile_path / time.strftime("cpu-%Y%m%d-%H%M%S.folded")
+        profiler.write_folded(path)
+        return dict(profiler.summary(limit), path=str(path))
+
+    def start_memory_trace(self, frames: int) -> Dict[str, Any]:
+        if tracemalloc.is_tracing():
+            raise ValueError("memory trace is already running")
+        tracemalloc.start(frames)
+        self.last_snapshot = None
+        return {"frames": frames}
+
+    def memory_snapshot(self, limit: int) -> Dict[str, Any]:
+        if not tracemalloc.is_tracing():
+            raise ValueError("memory trace is not running")
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ))
+        current, peak = tracemalloc.get_traced_memory()
+        result = {
+            "traced_bytes": current,
+            "peak_bytes": peak,
+            "top": [{"location": str(i.traceback), "bytes": i.size, "count": i.count}
+                    for i in snapshot.statistics("lineno")[:limit]],
+        }
+        if self.last_snapshot is not None:
+            result["growth"] = [{"location": str(i.traceback), "bytes": i.size_diff, "count": i.count_diff}
+                                for i in snapshot.compare_to(self.last_snapshot, "lineno")[:limit]]
+        self.last_snapshot = snapshot
+        return result
+
+    def stop_memory_trace(self) -> Dict[str, Any]:
+        if not tracemalloc.is_tracing():
+            raise ValueError("memory trace is not running")
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        self.last_snapshot = None
+        return {"traced_bytes": current, "peak_bytes": peak}
+
+    def summary(self) -> Dict[str, Any]:
+        """Sizes of queues, caches and other big structures of the bridge."""
+        channel = self.channel
+        server = channel.server_manager
+        uploads = list(channel.master_messages.uploads.values())
+        return {
+            "process": {
+                "rss_bytes": get_rss(),
+                "max_rss_bytes": get_max_rss(),
+                "threads": threading.active_count(),
+                "gc_objects": len(gc.get_objects()),
+            },
+            "outbound": {
+                "queued": server.msg_temp.qsize(),
+                "unconfirmed": len(channel.slave_messages.msg_temp),
+                "unconfirmed_bytes": channel.slave_messages.msg_temp_bytes,
+                "pending_acks": len(server.acks),
+            },
+            "inbound": {
+                "lanes": channel.dispatcher.stats(),
+                "uploads": len(uploads),
+                "upload_bytes": sum(i.tell() for i in uploads if not i.closed),
+                "inflight": len(channel.master_messages.inflight),
+            },
+            "chat_cache": channel.chat_manager.stats(),
+            "msg_ids": {
+                "cached": len(channel.msg_ids.by_parabox),
+                "pending": len(channel.msg_ids.pending),
+            },
+            "database": channel.db.stats(),
+            "frames": server.frames.stats(),
+            "traces": {
+                "open": len(channel.tracing.active),
+                "export_queue": channel.tracing.queue.qsize(),
+            },
+        }
+
+    def stop(self):
+        """Stop profiling and tracing memory, if running."""
+        with self.lock:
+            if self.profiler is not None:
+                self.profiler.stop()
+                self.profiler = None
+            if tracemalloc.is_tracing():
+                tracemalloc.stop()
+
+
+def get_rss() -> Optional[int]:
+    """Resident set size of the process in bytes, if available."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+def get_max_rss() -> Optional[int]:
+    """Peak resident set size of the process in bytes, if available."""
+    try:
+        import resource
+    except ImportError:
+        # Not available on Windows.
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS, and in KiB on Linux and BSDs.
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
@@ -0,0 +1,294 @@
+# coding=utf-8
+
+import logging
+import threading
+import time
+from contextlib import suppress
+from queue import Queue, Full, Empty
+from typing import TYPE_CHECKING, Dict, List, Optional, IO, Any, Tuple
+
+from ehforwarderbot import coordinator
+from ehforwarderbot.types import ModuleID
+
+from . import utils
+from .master_message import AckCode
+from .utils import EFBChannelChatIDStr
+
+if TYPE_CHECKING:
+    from . import ParaboxChannel
+
+DispatchItem = Tuple[float, str, Dict[str, Any], Optional[IO[bytes]]]
+"""Queued frame from Parabox: time enqueued, action (``message`` or ``recall``), data of the frame,
+media received in binary frames"""
+
+
+class DispatchLane:
+    """Worker threads sending messages from Parabox to one slave channel.
+
+    Each worker has its own bounded queue, and all messages to the same chat
+    go through the same worker, so that they are sent in order. Recalls go
+    through the worker of the chat of the message they recall, so that they
+    are processed after the message is sent.
+    """
+
+    def __init__(self, channel: 'ParaboxChannel', slave_channel_id: ModuleID, workers: int, queue_size: int,
+                 timeout: float):
+        self.channel = channel
+        self.slave_channel_id = slave_channel_id
+        self.logger = logging.getLogger(__name__)
+        self.timeout = timeout
+        """Seconds a message may wait in queue before it is dropped, or take
+        to send before the lane is reported as stalled."""
+
+        self.queues: List['Queue[Optional[DispatchItem]]'] = [Queue(maxsize=queue_size) for _ in range(workers)]
+        self.lock = threading.Lock()
+        self.counters: Dict[str, int] = {"processed": 0, "rejected": 0, "expired": 0, "stalled": 0,
+                                         "in_progress": 0}
+        self.stopping = False
+        """Set when stopping, workers exit once their queue is empty."""
+        self.threads = [threading.Thread(target=self._worker, args=(queue,), daemon=True,
+                                         name=f"EPMDispatch-{slave_channel_id}-{i}")
+                        for i, queue in enumerate(self.queues)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, param: Dict[str, Any], media: Optional[IO[bytes]] = None,
+               slave_origin_uid: Optional[EFBChannelChatIDStr] = None, action: str = "message") -> bool:
+        """Queue a message, or a recall, to the worker of its chat.
+
+        Args:
+            param: Data of the frame.
+            media: Media of the message received in binary frames.
+            slave_origin_uid: Chat of the frame, ``slaveOriginUid`` of the
+                frame if not given.
+            action: ``message`` or ``recall``.
+
+        Returns:
+            If the frame is queued, False if the queue is full.
+        """
+        queue = self.queues[hash(slave_origin_uid or param['slaveOriginUid']) % len(self.queues)]
+        received_at = time.monotonic()
+        try:
+            queue.put_nowait((received_at, action, param, media))
+        except Full:
+            self._count("rejected")
+            self.logger.warning("[%s] Queue to %s is full, %s is dropped.",
+                                param['slaveMsgId'], self.slave_channel_id, action)
+            if media is not None:
+                media.close()
+            self.channel.master_messages.ack(param, AckCode.REJECTED, received_at, action=action)
+            return False
+        return True
+
+    def _count(self, counter: str, value: int = 1):
+        with self.lock:
+            self.counters[counter] += value
+
+    def _worker(self, queue: 'Queue[Optional[DispatchItem]]'):
+        while True:
+            if self.stopping:
+                # The queue may have been full when stopping, with no room to wake the worker up.
+                try:
+                    item = queue.get_nowait()
+                except Empty:
+                    break
+            else:
+                item = queue.get()
+            if item is None:
+                break
+            enqueued_at, action, param, media = item
+            waited = time.monotonic() - enqueued_at
+            if waited > self.timeout:
+                self._count("expired")
+                self.logger.warning("[%s] %s to %s expired after waiting for %.1fs in queue.",
+                                    param['slaveMsgId'], action.capitalize(), self.slave_channel_id, waited)
+                if media is not None:
+                    media.close()
+                self.channel.master_messages.ack(param, AckCode.EXPIRED, enqueued_at, action=action)
+                if action == "message":
+                    self.channel.dispatcher.done(param['slaveMsgId'])
+                continue
+            self._count("in_progress")
+            start = time.monotonic()
+            self.channel.metrics.observe("inbound_queue_wait", start - enqueued_at)
+            # noinspection PyBroadException
+            try:
+                if action == "recall":
+                    self.channel.master_messages.process_parabox_message_recall(param, enqueued_at)
+                else:
+                    self.channel.tracing.get("inbound", param['slaveMsgId']).add("queue_wait", enqueued_at, start)
+                    self.channel.master_messages.process_parabox_message_message(param, media, enqueued_at)
+            except Exception:
+                self.logger.exception("[%s] Error occurred while sending %s to %s.",
+                                      param['slaveMsgId'], action, self.slave_channel_id)
+            finally:
+                if action == "message":
+                    self.channel.dispatcher.done(param['slaveMsgId'])
+                with self.lock:
+                    self.counters["in_progress"] -= 1
+                    self.counters["processed"] += 1
+            duration = time.monotonic() - start
+            self.channel.metrics.observe("inbound_send", duration)
+            if duration > self.timeout:
+                self._count("stalled")
+                self.logger.warning("[%s] Sending message to %s took %.1fs, other messages of the lane were held.",
+                                    param['slaveMsgId'], self.slave_channel_id, duration)
+
+    def stats(self) -> Dict[str, float]:
+        """Queue depth, age of the oldest queued message in seconds, and counters."""
+        now = time.monotonic()
+        oldest = 0.0
+        for queue in self.queues:
+            with queue.mutex:
+                if queue.queue and queue.queue[0] is not None:
+                    oldest = max(oldest, now - queue.queue[0][0])
+        with self.lock:
+            return dict(self.counters, queued=sum(i.qsize() for i in self.queues), oldest_wait=oldest)
+
+    def stop(self):
+        """Stop workers after messages already queued are processed, without waiting."""
+        self.stopping = True
+        for queue in self.queues:
+            # Workers of a full queue stop once it is empty.
+            with suppress(Full):
+                queue.put_nowait(None)
+
+    def join(self, deadline: float) -> bool:
+        """
+        Wait for workers to stop.
+
+        Returns:
+            If all workers have stopped by the deadline.
+        """
+        for thread in self.threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+        return not any(thread.is_alive() for thread in self.threads)
+
+
+class InboundDispatcher:
+    """Dispatch messages from Parabox to slave channels concurrently.
+
+    Each slave channel has a lane of its own, so that a slow slave channel
+    does not hold messages to others.
+    """
+
+    def __init__(self, channel: 'ParaboxChannel'):
+        self.channel = channel
+        self.logger = logging.getLogger(__name__)
+
+        config = channel.config
+        self.workers: int = config.get("dispatch_workers", 1)
+        self.queue_size: int = config.get("dispatch_queue_size", 1000)
+
+        self.lock = threading.Lock()
+        self.lanes: Dict[ModuleID, DispatchLane] = dict()
+        self.queued: Dict[str, EFBChannelChatIDStr] = dict()
+        """Chats of messages queued or being sent, by message ID, to dispatch recalls of them."""
+        self.stopped = False
+        """Set when stopping, messages are rejected from then on."""
+        self.apply_config(config)
+
+    def apply_config(self, config: dict):
+        """Apply timeouts from the configuration, also when it is reloaded.
+
+        Workers and queue sizes of lanes only change on restart.
+        """
+        self.timeout: float = config.get("dispatch_timeout", 300)
+        self.timeouts: Dict[str, float] = config.get("dispatch_timeouts") or dict()
+        """Timeouts of lanes by slave channel ID, overriding ``dispatch_timeout``."""
+        with self.lock:
+            for slave_channel_id, lane in self.lanes.items():
+                lane.timeout = self.timeouts.get(slave_channel_id, self.timeout)
+
+    def get_lane(self, slave_channel_id: ModuleID) -> DispatchLane:
+        with self.lock:
+            lane = self.lanes.get(slave_channel_id)
+            if lane is None:
+                lane = self.lanes[slave_channel_id] = DispatchLane(
+                    self.channel, slave_channel_id, max(1, self.workers), self.queue_size,
+                    self.timeouts.get(slave_channel_id, self.timeout))
+            return lane
+
+    def submit(self, param: Dict[str, Any], media: Optional[IO[bytes]] = None) -> bool:
+        """Queue a message from Parabox to the lane of its slave channel.
+
+        Returns:
+            If the message is queued.
+        """
+        slave_channel_id = utils.chat_id_str_to_id(param['slaveOriginUid'])[0]
+        if self.stopped:
+            self.logger.info("[%s] Rejecting message while stopping.", param['slaveMsgId'])
+            if media is not None:
+                media.close()
+            self.channel.master_messages.ack(param, AckCode.REJECTED, time.monotonic())
+            return False
+        if slave_channel_id not in coordinator.slaves:
+            self.logger.info("[%s] Slave channel %s is not found.", param['slaveMsgId'], slave_channel_id)
+            if media is not None:
+                media.close()
+            self.channel.master_messages.ack(param, AckCode.CHANNEL_NOT_FOUND, time.monotonic())
+            return False
+        with self.lock:
+            self.queued[param['slaveMsgId']] = param['slaveOriginUid']
+        if not self.get_lane(slave_channel_id).submit(param, media):
+            self.done(param['slaveMsgId'])
+            return False
+        return True
+
+    def submit_recall(self, param: Dict[str, Any]) -> bool:
+        """Queue a recall from Parabox behind the message it recalls, in the worker of its chat.
+
+        Recalls of messages that are neither queued nor sent are processed
+        right away, and acknowledged as not found.
+
+        Returns:
+            If the recall is queued.
+        """
+        msg_id = param['slaveMsgId']
+        with self.lock:
+            slave_origin_uid = self.queued.get(msg_id)
+        if slave_origin_uid is None:
+            entry = self.channel.msg_ids.get_slave(msg_id)
+            if entry is not None:
+                slave_origin_uid = entry.slave_origin_uid
+        slave_channel_id = utils.chat_id_str_to_id(slave_origin_uid)[0] if slave_origin_uid else None
+        if self.stopped:
+            self.logger.info("[%s] Rejecting recall while stopping.", msg_id)
+            self.channel.master_messages.ack(param, AckCode.REJECTED, time.monotonic(), action="recall")
+            return False
+        if slave_channel_id not in coordinator.slaves:
+            self.channel.master_messages.process_parabox_message_recall(param)
+            return False
+        return self.get_lane(slave_channel_id).submit(param, slave_origin_uid=slave_origin_uid, action="recall")
+
+    def done(self, msg_id: str):
+        """Forget the chat of a message that is sent, or dropped."""
+        with self.lock:
+            self.queued.pop(msg_id, None)
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """Statistics of each lane, see :meth:`DispatchLane.stats`."""
+        with self.lock:
+            lanes = list(self.lanes.items())
+        return {slave_channel_id: lane.stats() for slave_channel_id, lane in lanes}
+
+    def stop(self, deadline: Optional[float] = None) -> bool:
+        """
+        Reject new messages, and stop workers after messages already queued
+        are processed.
+
+        Args:
+            deadline: :func:`time.monotonic` to wait for workers until, do
+                not wait if not given.
+
+        Returns:
+            If all workers have stopped.
+        """
+        with self.lock:
+            self.stopped = True
+            lanes = list(self.lanes.values())
+        for lane in lanes:
+            lane.stop()
+        if deadline is None:
+            return False
+        return all([lane.join(deadline) for lane in lanes])
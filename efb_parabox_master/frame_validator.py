@@ -0,0 +1,192 @@
+# coding=utf-8
+
+import json
+import logging
+import threading
+from typing import Any, Callable, Dict, NoReturn, Tuple, Union
+
+from .master_message import MEDIA_TYPES
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+Schema = Union[type, Tuple[type, ...], Dict[str, Any]]
+"""Shape of a JSON value: a type, a tuple of allowed types, or a dict of
+schemas by key, where keys ending with ``?`` are optional."""
+
+Validator = Callable[[Any], None]
+
+MAX_HEADER_SIZE = 64 * 1024
+"""Maximum size of the JSON header of a binary frame in bytes."""
+
+FRAME_SCHEMAS: Dict[str, Schema] = {
+    "message": {"data": {"slaveOriginUid": str, "slaveMsgId": str, "content": {"type": int}},
+                "offset?": int, "more?": bool},
+    "recall": {"data": {"slaveMsgId": str}},
+    "response": {"data": str},
+    "refresh": {},
+    "reload_config": {"data?": {"token?": str}},
+    "diagnostics": {"data": {"action": str, "token?": str, "limit?": int, "interval?": (int, float),
+                             "frames?": int}},
+    "chat_sync": {"data?": {"epoch?": (str, type(None)), "version?": int, "base?": (int, type(None)),
+                            "limit?": int}},
+    "chat_search": {"data": {"query": str, "module_id?": str, "limit?": int}},
+}
+"""Schemas of text frames from Parabox by frame type."""
+
+CONTENT_SCHEMAS: Dict[int, Schema] = {
+    0: {"text": str},
+    **{content_type: {"fileName": str, "b64String": str} for content_type in MEDIA_TYPES},
+}
+"""Schemas of message content in text frames by content type. Other content
+types are left to be rejected as unsupported when sent."""
+
+BINARY_CONTENT_SCHEMAS: Dict[int, Schema] = {content_type: {"fileName": str} for content_type in MEDIA_TYPES}
+"""Schemas of message content in binary frames by content type, with media in the payload."""
+
+
+class InvalidFrame(ValueError):
+    """A frame from Parabox is rejected."""
+
+    def __init__(self, frame_type: str, reason: str):
+        super().__init__(f"{frame_type}: {reason}")
+        self.frame_type = frame_type
+        self.reason = reason
+
+
+def compile_schema(schema: Schema, path: str = "") -> Validator:
+    """Build a function raising :class:`ValueError` for values not matching a schema."""
+    if isinstance(schema, dict):
+        fields = [(key.rstrip("?"), key.endswith("?"), compile_schema(value, f"{path}.{key.rstrip('?')}"))
+                  for key, value in schema.items()]
+
+        def validate_dict(value):
+            if not isinstance(value, dict):
+                raise ValueError(f"{path or 'frame'} is not an object")
+            for key, optional, validate in fields:
+                if key in value:
+                    validate(value[key])
+                elif not optional:
+                    raise ValueError(f"{path}.{key} is missing")
+
+        return validate_dict
+
+    types = schema if isinstance(schema, tuple) else (schema,)
+    # bool is a subclass of int, but not accepted where int is expected.
+    reject_bool = bool not in types
+
+    def validate_value(value):
+        if not isinstance(value, types) or reject_bool and isinstance(value, bool):
+            raise ValueError(f"{path} is not {' or '.join(t.__name__ for t in types)}")
+
+    return validate_value
+
+
+class FrameValidator:
+    """Parse and validate frames received from Parabox.
+
+    Frames are checked for size before they are parsed, and against a
+    validator compiled from the schema of their type after, so that
+    processing can index them without checks. ``orjson`` is used to parse
+    when installed.
+    """
+
+    def __init__(self, max_size: int):
+        self.logger = logging.getLogger(__name__)
+        self.max_size = max_size
+        self.validators: Dict[str, Validator] = {
+            frame_type: compile_schema(schema) for frame_type, schema in FRAME_SCHEMAS.items()}
+        self.content_validators: Dict[int, Validator] = {
+            content_type: compile_schema(schema, ".data.content")
+            for content_type, schema in CONTENT_SCHEMAS.items()}
+        self.binary_content_validators: Dict[int, Validator] = {
+            content_type: compile_schema(schema, ".data.content")
+            for content_type, schema in BINARY_CONTENT_SCHEMAS.items()}
+        self.lock = threading.Lock()
+        self.received: Dict[str, int] = dict()
+        self.rejected: Dict[str, int] = dict()
+        """Frames rejected by frame type, or ``oversized``, ``malformed`` and ``unknown``."""
+
+    @staticmethod
+    def loads(s: Union[str, bytes, memoryview]) -> Any:
+        if orjson is not None:
+            return orjson.loads(s)
+        return json.loads(bytes(s) if isinstance(s, memoryview) else s)
+
+    def parse(self, frame: str) -> Dict[str, Any]:
+        """
+        Parse a text frame.
+
+        Raises:
+            InvalidFrame: If the frame is rejected.
+        """
+        if len(frame) > self.max_size:
+            self._reject("oversized", f"frame of {len(frame)} characters")
+        try:
+            json_obj = self.loads(frame)
+        except ValueError as e:
+            self._reject("malformed", str(e))
+        self._validate(json_obj, self.content_validators)
+        return json_obj
+
+    def parse_binary(self, frame: bytes) -> Tuple[Dict[str, Any], memoryview]:
+        """
+        Parse a binary frame carrying media without base64.
+
+        A frame is a 4-byte big-endian length of a JSON header, the header,
+        then raw media bytes. The header is a ``message`` frame whose content
+        has no ``b64String``.
+
+        Returns:
+            Header and payload of the frame.
+
+        Raises:
+            InvalidFrame: If the frame is rejected.
+        """
+        if len(frame) > self.max_size:
+            self._reject("oversized", f"frame of {len(frame)} bytes")
+        header_size = int.from_bytes(frame[:4], "big")
+        if len(frame) < 4 or header_size > min(MAX_HEADER_SIZE, len(frame) - 4):
+            self._reject("malformed", f"header of {header_size} bytes")
+        try:
+            header = self.loads(memoryview(frame)[4:4 + header_size])
+        except ValueError as e:
+            self._reject("malformed", str(e))
+        if isinstance(header, dict) and header.get('type') != 'message':
+            self._reject("malformed", "binary frame is not a message frame")
+        self._validate(header, self.binary_content_validators)
+        return header, memoryview(frame)[4 + header_size:]
+
+    def _validate(self, json_obj: Any, content_validators: Dict[int, Validator]):
+        if not isinstance(json_obj, dict) or not isinstance(json_obj.get('type'), str):
+            self._reject("malformed", "frame type is missing")
+        frame_type = json_obj['type']
+        validator = self.validators.get(frame_type)
+        if validator is None:
+            self._reject("unknown", f"frame type {frame_type!r}")
+        try:
+            validator(json_obj)
+            if frame_type == 'message':
+                data = json_obj['data']
+                if " " not in data['slaveOriginUid']:
+                    raise ValueError(".data.slaveOriginUid is not a chat ID")
+                content_validator = content_validators.get(data['content']['type'])
+                if content_validator is not None:
+                    content_validator(data['content'])
+        except ValueError as e:
+            self._reject(frame_type, str(e))
+        with self.lock:
+            self.received[frame_type] = self.received.get(frame_type, 0) + 1
+
+    def _reject(self, frame_type: str, reason: str) -> NoReturn:
+        with self.lock:
+            self.rejected[frame_type] = self.rejected.get(frame_type, 0) + 1
+        self.logger.warning("Rejected frame (%s): %s", frame_type, reason)
+        raise InvalidFrame(frame_type, reason)
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """Frames received and rejected by frame type."""
+        with self.lock:
+            return {"received": self.received.copy(), "rejected": self.rejected.copy()}
@@ -1,18 +1,21 @@
 import asyncio
-import base64
+import binascii
+import hashlib
+import json
 import logging
+import threading
+import time
+from enum import IntEnum
 from io import BytesIO
-import tempfile
+from pathlib import Path
 from queue import Queue
 from tempfile import NamedTemporaryFile
 from threading import Thread
-from typing import Optional, TYPE_CHECKING, Tuple, Any
+from typing import Optional, TYPE_CHECKING, Tuple, Any, IO, Dict, Set
 
-from PIL import Image
 from ehforwarderbot import coordinator
 from ehforwarderbot.chat import SelfChatMember
 from ehforwarderbot.constants import MsgType
-from ehforwarderbot import utils as efb_utils
 from ehforwarderbot.exceptions import EFBMessageTypeNotSupported, EFBChatNotFound, \
     EFBMessageError, EFBOperationNotSupported, EFBException
 from ehforwarderbot.message import LocationAttribute, Message
@@ -20,13 +23,68 @@ from ehforwarderbot.status import MessageRemoval
 from ehforwarderbot.types import ModuleID, MessageID, ChatID
 from . import utils, ChatObjectCacheManager
 from .message import EPMMsg
-from .utils import get_chat_id
+from .utils import get_chat_id, get_media_path
 
 if TYPE_CHECKING:
     from . import ParaboxChannel
     from .db import DatabaseManager
 
 
+MEDIA_TYPES: Dict[int, Tuple[str, str]] = {
+    1: (".jpg", "image/jpeg"),
+    2: (".mp3", "audio/mpeg"),
+    3: (".mpeg", "video/mpeg"),
+    4: ("", "application/octet-stream"),
+    5: (".gif", "image/gif"),
+}
+"""File name suffix and MIME type of media by Parabox content type."""
+
+BASE64_CHUNK_SIZE = 4 * 256 * 1024
+"""Characters of base64 decoded at a time, a multiple of 4."""
+
+MAX_PENDING_UPLOADS = 16
+"""Binary uploads in progress kept at a time, the least recently active ones are dropped."""
+
+FINGERPRINT_SAMPLE_SIZE = 4096
+"""Characters at each end of base64 media included in the content hash."""
+
+
+class AckCode(IntEnum):
+    """Result of a message from Parabox, reported back to the client in acks."""
+    SENT = 0
+    DUPLICATE = 1
+    """The message has already been sent, under the slave message ID in the ack."""
+    FAILED = 2
+    UNSUPPORTED = 3
+    """The message type is not supported by the slave channel."""
+    CHAT_NOT_FOUND = 4
+    CHANNEL_NOT_FOUND = 5
+    REJECTED = 6
+    """The queue to the slave channel is full, or the channel is stopping."""
+    EXPIRED = 7
+    """The message has waited in queue longer than the dispatch timeout."""
+    MESSAGE_NOT_FOUND = 8
+    """The message to recall is not found among messages sent from Parabox."""
+
+
+def content_hash(content: Dict[str, Any]) -> str:
+    """
+    Hash of the content of a message from Parabox, for deduplication.
+
+    Base64 media are only sampled at both ends along with their length, so
+    that resent media are recognized without hashing them in full. Media in
+    binary frames are identified by the other fields of the content.
+    """
+    h = hashlib.blake2b(digest_size=8)
+    h.update(json.dumps({k: v for k, v in content.items() if k != 'b64String'}, sort_keys=True).encode())
+    b64_string = content.get('b64String')
+    if b64_string:
+        h.update(str(len(b64_string)).encode())
+        h.update(b64_string[:FINGERPRINT_SAMPLE_SIZE].encode())
+        h.update(b64_string[-FINGERPRINT_SAMPLE_SIZE:].encode())
+    return h.hexdigest()
+
+
 class MasterMessageProcessor:
     def __init__(self, channel: 'ParaboxChannel'):
         self.channel = channel
@@ -34,6 +92,17 @@ class MasterMessageProcessor:
         self.logger = logging.getLogger(__name__)
         self.logger.debug("MasterMessageProcessor initialized.")
         self.chat_manager: ChatObjectCacheManager = channel.chat_manager
+        self.media_path = get_media_path(channel.channel_id)
+        self.uploads: Dict[str, IO[bytes]] = dict()
+        """Media files of binary uploads in progress, by message ID."""
+        self.inflight_lock = threading.Lock()
+        self.inflight: Set[str] = set()
+        """IDs of messages from Parabox being sent."""
+        self.apply_config(channel.config)
+
+    def apply_config(self, config: dict):
+        """Apply tunables from the configuration, also when it is reloaded."""
+        self.dedup_window: float = config.get("dedup_window", 24 * 3600)
 
     def process_parabox_message(self, json_obj):
         """
@@ -41,10 +110,10 @@ class MasterMessageProcessor:
         """
         if json_obj['type'] == 'message':
             self.logger.info("Processing message from Parabox.")
-            self.process_parabox_message_message(json_obj['data'])
+            self.channel.dispatcher.submit(json_obj['data'])
         elif json_obj['type'] == 'recall':
             self.logger.info("Processing message recall from Parabox.")
-            self.process_parabox_message_recall(json_obj['data'])
+            self.channel.dispatcher.submit_recall(json_obj['data'])
         elif json_obj['type'] == 'response':
             self.logger.info("Processing response from Parabox.")
             # self.db.resort_msg_json(json_obj['data'])
@@ -56,21 +125,195 @@ class MasterMessageProcessor:
         else:
             self.logger.warning("Unknown message type: %s", json_obj['type'])
 
-    def process_parabox_message_message(self, param):
-        data_path = efb_utils.get_data_path(self.channel.channel_id)
+    def process_parabox_binary(self, header: Dict[str, Any], payload: memoryview):
+        """
+        Process a binary frame received from Parabox, carrying media without base64.
+
+        Large media can be split into multiple frames of the same message,
+        all but the last with ``"more": true`` in the header, so that only
+        one chunk is held in memory at a time. Each frame carries the byte
+        ``offset`` of its chunk in the media. A frame at offset 0 starts the
+        upload over, and one at any other offset than the size received so
+        far fails the message, so that the client sends it again from the
+        start.
+
+        Args:
+            header: Header of the frame, a ``message`` frame whose content
+                has no ``b64String``.
+            payload: Raw media bytes.
+        """
+        param = header['data']
+        msg_id = param['slaveMsgId']
+        received_at = time.monotonic()
+        if self.is_duplicate(param, content_hash(param['content']), received_at):
+            return
+        offset = header.get('offset', 0)
+        media = self.uploads.pop(msg_id, None)
+        if media is not None and offset == 0:
+            self.logger.info("[%s] Upload is started over.", msg_id)
+            media.close()
+            media = None
+        if offset != (media.tell() if media is not None else 0):
+            self.logger.warning("[%s] Upload chunk at offset %s does not follow the %s bytes received.",
+                                msg_id, offset, media.tell() if media is not None else 0)
+            if media is not None:
+                media.close()
+            self.ack(param, AckCode.FAILED, received_at)
+            return
+        if media is None:
+            suffix = MEDIA_TYPES.get(param['content']['type'], ("", ""))[0]
+            media = self.new_media_file(suffix)
+        media.write(payload)
+        if header.get('more'):
+            self.uploads[msg_id] = media
+            while len(self.uploads) > MAX_PENDING_UPLOADS:
+                dropped_id = next(iter(self.uploads))
+                self.logger.warning("[%s] Dropping incomplete upload.", dropped_id)
+                self.uploads.pop(dropped_id).close()
+            return
+        media.seek(0)
+        self.logger.info("Processing binary message from Parabox.")
+        self.channel.dispatcher.submit(param, media)
+
+    def drop_uploads(self):
+        """Drop binary uploads in progress, when the connection of the client is closed."""
+        while self.uploads:
+            msg_id, media = self.uploads.popitem()
+            self.logger.info("[%s] Dropping incomplete upload of a closed connection.", msg_id)
+            media.close()
+
+    def new_media_file(self, suffix: str) -> IO[bytes]:
+        """
+        Create a temporary file for inbound media in the media directory,
+        which is removed when closed.
+
+        Slave channels are given the file by its name, so media are always
+        written to a file, never kept in memory.
+        """
+        return NamedTemporaryFile(suffix=suffix, dir=self.media_path)
+
+    def decode_media(self, b64_string: str, suffix: str) -> IO[bytes]:
+        """Decode base64 media into a temporary file in chunks, see :meth:`new_media_file`.
+
+        Raises:
+            binascii.Error: if the media is not valid base64.
+        """
+        f = self.new_media_file(suffix)
+        try:
+            remainder = ""
+            for i in range(0, len(b64_string), BASE64_CHUNK_SIZE):
+                # Line breaks in the media are left out, and characters beyond a
+                # multiple of 4 are carried to the next chunk, to keep it aligned.
+                chunk = remainder + "".join(b64_string[i:i + BASE64_CHUNK_SIZE].split())
+                aligned = len(chunk) // 4 * 4
+                f.write(binascii.a2b_base64(chunk[:aligned]))
+                remainder = chunk[aligned:]
+            if remainder:
+                f.write(binascii.a2b_base64(remainder))
+        except binascii.Error:
+            f.close()
+            raise
+        f.seek(0)
+        return f
+
+    def is_duplicate(self, param: Dict[str, Any], msg_hash: str, received_at: float) -> bool:
+        """
+        Check if a message from Parabox is being sent, or has been sent
+        within ``dedup_window`` seconds with the same content.
+        """
+        msg_id = param['slaveMsgId']
+        if msg_id in self.inflight:
+            # Acknowledged once the message being sent is done.
+            self.logger.info("[%s] Ignoring duplicate of a message being sent.", msg_id)
+            return True
+        return self.is_sent(param, msg_hash, received_at)
+
+    def is_sent(self, param: Dict[str, Any], msg_hash: str, received_at: float) -> bool:
+        """
+        Check if a message from Parabox has been sent within ``dedup_window``
+        seconds with the same content, and acknowledge it again if so.
+        """
+        msg_id = param['slaveMsgId']
+        entry = self.channel.msg_ids.get_slave(msg_id)
+        if entry is not None and entry.content_hash == msg_hash and \
+                entry.created_at > time.time() - self.dedup_window:
+            self.logger.info("[%s] Ignoring duplicate of a message sent as %s.", msg_id, entry.slave_msg_id)
+            self.ack(param, AckCode.DUPLICATE, received_at, entry.slave_msg_id or None)
+            return True
+        return False
+
+    def ack(self, param: Dict[str, Any], code: AckCode, received_at: float,
+            sent_msg_id: Optional[MessageID] = None, action: str = "message"):
+        """
+        Report the result of a message from Parabox to the client.
+
+        Args:
+            param: Data of the message frame.
+            code: Result of the message.
+            received_at: :func:`time.monotonic` when the message was received.
+            sent_msg_id: ID of the message in the slave channel, if sent.
+            action: ``message``, or ``recall`` for a recall of a message.
+        """
+        if action == "recall":
+            self.channel.metrics.inc("inbound_recalls", result=code.name.lower())
+        else:
+            self.channel.metrics.inc("inbound_messages", content_type=str(param['content']['type']),
+                                     result=code.name.lower())
+            self.channel.tracing.finish("inbound", param['slaveMsgId'], result=code.name.lower())
+        self.channel.server_manager.send_ack({
+            "action": action,
+            "slaveMsgId": param['slaveMsgId'],
+            "slaveOriginUid": param.get('slaveOriginUid'),
+            "sentMsgId": sent_msg_id,
+            "code": int(code),
+            "msg": code.name.lower(),
+            "time": round((time.monotonic() - received_at) * 1000, 1),
+        })
+
+    def process_parabox_message_message(self, param, media: Optional[IO[bytes]] = None,
+                                        received_at: Optional[float] = None):
+        """
+        Send a message from Parabox to a slave channel, and acknowledge the
+        result to the client.
+
+        Messages resent by Parabox are ignored, see :meth:`is_duplicate`.
+
+        Args:
+            param: Data of the message frame.
+            media: Media already received in a binary frame, instead of
+                ``b64String`` in content.
+            received_at: :func:`time.monotonic` when the message was
+                received, now if not given.
+        """
+        if received_at is None:
+            received_at = time.monotonic()
         destination = param['slaveOriginUid']
         msg_id = param["slaveMsgId"]
         mtype = param['content']['type']
         channel, uid, gid = utils.chat_id_str_to_id(destination)
         if channel not in coordinator.slaves:
+            self.ack(param, AckCode.CHANNEL_NOT_FOUND, received_at)
             return
+        msg_hash = content_hash(param['content'])
+        with self.inflight_lock:
+            if msg_id in self.inflight:
+                self.logger.info("[%s] Ignoring duplicate of a message being sent.", msg_id)
+                return
+            self.inflight.add(msg_id)
         m = EPMMsg()
+        code = AckCode.FAILED
+        trace = self.channel.tracing.get("inbound", msg_id)
         try:
+            # Checked after claiming the message, as the mapping is recorded before it is released.
+            if self.is_sent(param, msg_hash, received_at):
+                code = None
+                return
             m.uid = MessageID(msg_id)
             m.type = get_msg_type(mtype)
             self.logger.debug("[%s] EFB message type: %s", m.uid, m.type)
             # Chat and author related stuff
-            m.chat = self.chat_manager.get_chat(channel, uid, build_dummy=True)
+            with trace.span("chat_lookup"):
+                m.chat = self.chat_manager.get_chat(channel, uid, build_dummy=True)
             if m.chat.has_self:
                 m_author = SelfChatMember(m.chat)
             else:
@@ -87,57 +330,27 @@ class MasterMessageProcessor:
 
             if mtype == 0:
                 m.text = param['content']['text']
-            elif mtype == 1:
-                file_name = param['content']['fileName']
-                f = tempfile.NamedTemporaryFile(suffix=".jpg")
-                f.write(base64.b64decode(param['content']['b64String']))
-                f.seek(0)
-                m.file = f
-                m.filename = file_name
-                m.mime = "image/jpeg"
-            elif mtype == 2:
-                file_name = param['content']['fileName']
-                f = tempfile.NamedTemporaryFile(suffix=".mp3")
-                f.write(base64.b64decode(param['content']['b64String']))
-                f.seek(0)
-                m.file = f
-                m.filename = file_name
-                m.mime = "audio/mpeg"
-            elif mtype == 3:
-                file_name = param['content']['fileName']
-                f = tempfile.NamedTemporaryFile(suffix=".mpeg")
-                f.write(base64.b64decode(param['content']['b64String']))
-                f.seek(0)
-                m.file = f
-                m.filename = file_name
-                m.mime = "video/mpeg"
-            elif mtype == 4:
-                file_name = param['content']['fileName']
-                f = tempfile.NamedTemporaryFile()
-                f.name = file_name
-                f.write(base64.b64decode(param['content']['b64String']))
-                f.seek(0)
-                m.file = f
-                m.filename = file_name
-                m.mime = "application/octet-stream"
-
-            elif mtype == 5:
-                file_name = param['content']['fileName']
-                f = tempfile.NamedTemporaryFile(suffix=".gif")
-                f.write(base64.b64decode(param['content']['b64String']))
-                f.seek(0)
-                m.file = f
-                m.filename = file_name
-                m.mime = "image/gif"
-
-            slave_msg = coordinator.send_message(m)
-            if slave_msg and slave_msg.uid:
-                m.uid = slave_msg.uid
-            else:
-                m.uid = None
+            elif mtype in MEDIA_TYPES:
+                suffix, mime = MEDIA_TYPES[mtype]
+                if media is None:
+                    with trace.span("decode_media"):
+                        media = self.decode_media(param['content']['b64String'], suffix)
+                m.file = media
+                m.filename = param['content']['fileName']
+                m.mime = mime
+                m.path = Path(media.name)
+
+            with trace.span("slave_send"):
+                slave_msg = coordinator.send_message(m)
+            m.uid = slave_msg.uid if slave_msg else None
+            # Recorded even without a slave message ID, to recognize duplicates.
+            self.channel.msg_ids.add(msg_id, destination, m.uid, msg_hash)
+            code = AckCode.SENT
         except EFBChatNotFound as e:
+            code = AckCode.CHAT_NOT_FOUND
             self.logger.exception("Chat is not found.. (exception: %s)", e)
         except EFBMessageTypeNotSupported as e:
+            code = AckCode.UNSUPPORTED
             self.logger.exception("Message type is not supported... (exception: %s)", e)
         except EFBOperationNotSupported as e:
             self.logger.exception("Message editing is not supported.. (exception: %s)", e)
@@ -146,10 +359,62 @@ class MasterMessageProcessor:
         except Exception as e:
             self.logger.exception("Message is not sent. (exception: %s)", e)
         finally:
-            pass
+            with self.inflight_lock:
+                self.inflight.discard(msg_id)
+            if code is not None:
+                self.ack(param, code, received_at, m.uid if code == AckCode.SENT else None)
+
+    def process_parabox_message_recall(self, param, received_at: Optional[float] = None):
+        """
+        Recall a message sent from Parabox in its slave channel, and
+        acknowledge the result to the client.
+
+        The slave channel, chat and message ID are taken from the mapping
+        recorded when the message was sent, see :class:`.MessageIdCacheManager`.
 
-    def process_parabox_message_recall(self, param):
-        pass
+        Args:
+            param: Data of the recall frame.
+            received_at: :func:`time.monotonic` when the recall was
+                received, now if not given.
+        """
+        if received_at is None:
+            received_at = time.monotonic()
+        msg_id = param["slaveMsgId"]
+        entry = self.channel.msg_ids.get_slave(msg_id)
+        if entry is None or not entry.slave_msg_id:
+            self.logger.info("[%s] Message to recall is not found.", msg_id)
+            self.ack(param, AckCode.MESSAGE_NOT_FOUND, received_at, action="recall")
+            return
+        param = dict(param, slaveOriginUid=entry.slave_origin_uid)
+        channel, uid, gid = utils.chat_id_str_to_id(entry.slave_origin_uid)
+        if channel not in coordinator.slaves:
+            self.ack(param, AckCode.CHANNEL_NOT_FOUND, received_at, action="recall")
+            return
+        code = AckCode.FAILED
+        try:
+            # Messages to a member of a group are sent in the group.
+            chat = self.chat_manager.get_chat(channel, gid or uid)
+            if chat is None:
+                code = AckCode.CHAT_NOT_FOUND
+                self.logger.info("[%s] Chat of the message to recall is not found: %s",
+                                 msg_id, entry.slave_origin_uid)
+                return
+            m = EPMMsg(chat=chat, author=chat.self or chat.add_self(), uid=entry.slave_msg_id,
+                       deliver_to=coordinator.slaves[channel])
+            coordinator.send_status(MessageRemoval(source_channel=self.channel,
+                                                   destination_channel=coordinator.slaves[channel],
+                                                   message=m))
+            code = AckCode.SENT
+        except EFBOperationNotSupported as e:
+            code = AckCode.UNSUPPORTED
+            self.logger.exception("Message recall is not supported.. (exception: %s)", e)
+        except EFBException as e:
+            self.logger.exception("Message is not recalled. (exception: %s)", e)
+        except Exception as e:
+            self.logger.exception("Message is not recalled. (exception: %s)", e)
+        finally:
+            self.ack(param, code, received_at, entry.slave_msg_id if code == AckCode.SENT else None,
+                     action="recall")
 
 
 def get_msg_type(msg_type: int) -> MsgType:
@@ -0,0 +1,212 @@
+# coding=utf-8
+
+import asyncio
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Dict, Tuple, List, Optional
+
+if TYPE_CHECKING:
+    from . import ParaboxChannel
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+"""Upper bounds of latency histogram buckets in seconds."""
+
+STAGES = ("build_json", "avatar", "queue_wait", "websocket_send", "inbound_queue_wait", "inbound_send")
+"""Stages of message processing with a latency histogram: building, fetching avatars of, waiting in queue for
+and sending messages to the client, then waiting in queue for and sending messages to slave channels."""
+
+METRICS_PREFIX = "epm_"
+
+LabelSet = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    """Latency histogram with fixed buckets, safe to observe from any thread."""
+
+    __slots__ = ("lock", "counts", "sum", "count")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds: float):
+        i = bisect_left(LATENCY_BUCKETS, seconds)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += seconds
+            self.count += 1
+
+    def snapshot(self) -> Tuple[List[int], float, int]:
+        """Cumulative bucket counts, sum and count."""
+        with self.lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        cumulative = []
+        running = 0
+        for i in counts:
+            running += i
+            cumulative.append(running)
+        return cumulative, total, count
+
+
+class MetricsManager:
+    """Counters and latency histograms of hot paths, served in Prometheus
+    text format over HTTP when ``metrics_port`` is set.
+
+    Hot paths only increment counters and observe histograms. Queue depths,
+    cache statistics and database latency are collected from the managers
+    when scraped, so there is no other cost when no one is scraping.
+    """
+
+    def __init__(self, channel: 'ParaboxChannel'):
+        self.channel = channel
+        self.logger = logging.getLogger(__name__)
+        self.host: str = channel.config.get("metrics_host", "127.0.0.1")
+        self.port: Optional[int] = channel.config.get("metrics_port")
+
+        self.lock = threading.Lock()
+        self.counters: Dict[Tuple[str, LabelSet], int] = dict()
+        self.histograms: Dict[str, Histogram] = {stage: Histogram() for stage in STAGES}
+
+    def inc(self, name: str, value: int = 1, **labels: str):
+        """Increment a counter, identified by its name and labels."""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, stage: str, seconds: float):
+        """Record the time taken by a stage in :data:`STAGES`."""
+        self.histograms[stage].observe(seconds)
+
+    @contextmanager
+    def time(self, stage: str):
+        """Record the time taken by the enclosed block as a stage in :data:`STAGES`."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.histograms[stage].observe(time.perf_counter() - start)
+
+    async def start(self):
+        """Serve metrics from the running loop, if ``metrics_port`` is set.
+
+        Metrics are not served if the port cannot be bound, without
+        affecting the websocket server.
+        """
+        if not self.port:
+            return
+        try:
+            await asyncio.start_server(self.handle, self.host, self.port)
+        except OSError as e:
+            self.logger.warning("Metrics are not served, failed to listen at %s:%s: %s", self.host, self.port, e)
+            return
+        self.logger.info("Metrics served at http://%s:%s/metrics", self.host, self.port)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        # noinspection PyBroadException
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5)
+            method, path = request.split(b" ", 2)[:2]
+            if method == b"GET" and path.split(b"?")[0] == b"/metrics":
+                body = (await asyncio.get_event_loop().run_in_executor(None, self.render)).encode()
+                status = b"200 OK"
+            else:
+                body = b"Not found\n"
+                status = b"404 Not Found"
+            writer.write(b"HTTP/1.1 " + status + b"\r\n"
+                         b"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                         b"Content-Length: " + str(len(body)).encode() + b"\r\n"
+                         b"Connection: close\r\n\r\n" + body)
+            await writer.drain()
+        except Exception as e:
+            self.logger.debug("Failed to serve metrics: %s", e)
+        finally:
+            writer.close()
+
+    def render(self) -> str:
+        """All metrics in Prometheus text format."""
+        lines: List[str] = []
+
+        def metric(name: str, metric_type: str, help_text: str, samples: List[Tuple[LabelSet, float]]):
+            lines.append(f"# HELP {METRICS_PREFIX}{name} {help_text}")
+            lines.append(f"# TYPE {METRICS_PREFIX}{name} {metric_type}")
+            for labels, value in samples:
+                lines.append(f"{METRICS_PREFIX}{name}{format_labels(labels)} {value}")
+
+        with self.lock:
+            counters = dict(self.counters)
+        by_name: Dict[str, List[Tuple[LabelSet, float]]] = dict()
+        for (name, labels), value in sorted(counters.items()):
+            by_name.setdefault(name, []).append((labels, value))
+        for name, samples in by_name.items():
+            metric(name + "_total", "counter", COUNTER_HELP.get(name, name), samples)
+
+        lines.append(f"# HELP {METRICS_PREFIX}stage_seconds Time taken by each stage of message processing.")
+        lines.append(f"# TYPE {METRICS_PREFIX}stage_seconds histogram")
+        for stage, histogram in self.histograms.items():
+            self._render_histogram(lines, "stage_seconds", (("stage", stage),), histogram)
+
+        channel = self.channel
+        server = channel.server_manager
+        metric("clients", "gauge", "Connected clients.", [((), len(server.websocket_users))])
+        metric("outbound_queue", "gauge", "Messages queued to be sent to the client.", [((), server.msg_temp.qsize())])
+        metric("unconfirmed_messages", "gauge", "Messages sent to the client and not yet confirmed.",
+               [((), len(channel.slave_messages.msg_temp))])
+        metric("unconfirmed_bytes", "gauge", "Size of messages not yet confirmed by the client.",
+               [((), channel.slave_messages.msg_temp_bytes)])
+        metric("pending_acks", "gauge", "Acks queued to be sent to the client.", [((), len(server.acks))])
+
+        lanes = channel.dispatcher.stats()
+        metric("inbound_queue", "gauge", "Messages from Parabox queued per slave channel.",
+               [((("slave", slave),), lane["queued"]) for slave, lane in lanes.items()])
+        metric("inbound_oldest_wait_seconds", "gauge", "Wait of the oldest queued message per slave channel.",
+               [((("slave", slave),), lane["oldest_wait"]) for slave, lane in lanes.items()])
+
+        frames = server.frames.stats()
+        metric("frames_received_total", "counter", "Frames received from the client by type.",
+               [((("type", k),), v) for k, v in sorted(frames["received"].items())])
+        metric("frames_rejected_total", "counter", "Frames rejected by type or reason.",
+               [((("type", k),), v) for k, v in sorted(frames["rejected"].items())])
+
+        cache = channel.chat_manager.stats()
+        metric("chat_cache_lookups_total", "counter", "Chat cache lookups by result.",
+               [((("result", k),), cache[k])
+                for k in ("hit", "miss", "negative_hit", "db_hit", "slave_hit", "not_found", "inflight_wait")])
+        metric("chat_cache_chats", "gauge", "Chats in the chat cache.", [((), cache["size"])])
+        metric("chat_cache_bytes", "gauge", "Estimated memory used by the chat cache.", [((), cache["bytes"])])
+
+        db = channel.db.stats()
+        metric("db_write_queue", "gauge", "Writes queued for the database writer.", [((), db["queue_depth"])])
+        lines.append(f"# HELP {METRICS_PREFIX}db_commit_seconds Time taken by database writes.")
+        lines.append(f"# TYPE {METRICS_PREFIX}db_commit_seconds histogram")
+        self._render_histogram(lines, "db_commit_seconds", (), channel.db.commit_histogram)
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _render_histogram(lines: List[str], name: str, labels: LabelSet, histogram: Histogram):
+        cumulative, total, count = histogram.snapshot()
+        for bound, value in zip(LATENCY_BUCKETS + ("+Inf",), cumulative):
+            lines.append(f"{METRICS_PREFIX}{name}_bucket{format_labels(labels + (('le', str(bound)),))} {value}")
+        lines.append(f"{METRICS_PREFIX}{name}_sum{format_labels(labels)} {total}")
+        lines.append(f"{METRICS_PREFIX}{name}_count{format_labels(labels)} {count}")
+
+
+COUNTER_HELP: Dict[str, str] = {
+    "outbound_messages": "Messages from slave channels to the client by message type.",
+    "inbound_messages": "Messages from the client to slave channels by content type and result.",
+    "inbound_recalls": "Recalls of messages from the client by result.",
+    "outbound_retries": "Messages resent to the client as they are not confirmed in time.",
+    "outbound_dropped": "Messages not confirmed by the client dropped beyond the limits kept.",
+}
+"""Descriptions of counters incremented through :meth:`MetricsManager.inc`."""
+
+
+def format_labels(labels: LabelSet) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"')
+                                           .replace("\n", "\\n")) for k, v in labels) + "}"
@@ -0,0 +1,138 @@
+# coding=utf-8
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Optional, NamedTuple, List, Dict, Any, Tuple
+
+from ehforwarderbot.types import ModuleID, MessageID
+
+from . import utils
+from .utils import EFBChannelChatIDStr
+
+if TYPE_CHECKING:
+    from . import ParaboxChannel
+    from .db import DatabaseManager
+
+
+class MsgIdEntry(NamedTuple):
+    parabox_msg_id: str
+    slave_channel_id: ModuleID
+    slave_origin_uid: EFBChannelChatIDStr
+    slave_msg_id: MessageID
+    content_hash: Optional[str]
+    created_at: int
+
+
+class MessageIdCacheManager:
+    """Map message IDs in Parabox to message IDs in slave channels.
+
+    Recent mappings are kept in an in-memory LRU cache for both directions.
+    New mappings are written to the database in batches from a background
+    thread.
+
+    Mappings also record a hash of the message content, so that messages
+    resent by Parabox can be recognized as duplicates. Messages the slave
+    channel gives no ID for are recorded with an empty slave message ID,
+    and are only found by their ID in Parabox.
+    """
+
+    def __init__(self, channel: 'ParaboxChannel'):
+        self.channel = channel
+        self.db: 'DatabaseManager' = channel.db
+        self.logger = logging.getLogger(__name__)
+
+        self.lock = threading.Lock()
+        self.by_parabox: 'OrderedDict[str, MsgIdEntry]' = OrderedDict()
+        self.by_slave: 'OrderedDict[Tuple[ModuleID, MessageID], MsgIdEntry]' = OrderedDict()
+        self.pending: List[Dict[str, Any]] = []
+        self.apply_config(channel.config)
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._flush_loop, name="EPMMsgIdFlush", daemon=True)
+        self._thread.start()
+
+    def apply_config(self, config: dict):
+        """Apply tunables from the configuration, also when it is reloaded."""
+        self.flush_interval: float = config.get("msg_id_flush_interval", 1)
+        with self.lock:
+            self.cache_size: int = config.get("msg_id_cache_size", 10000)
+            self._trim()
+
+    def add(self, parabox_msg_id: str, slave_origin_uid: EFBChannelChatIDStr, slave_msg_id: Optional[MessageID],
+            content_hash: Optional[str] = None):
+        """Record the slave channel message ID of a message sent from Parabox, if given by the slave channel."""
+        slave_channel_id = utils.chat_id_str_to_id(slave_origin_uid)[0]
+        entry = MsgIdEntry(parabox_msg_id, slave_channel_id, slave_origin_uid, slave_msg_id or MessageID(""),
+                           content_hash, int(time.time()))
+        with self.lock:
+            self._cache(entry)
+            self.pending.append(entry._asdict())
+
+    def get_slave(self, parabox_msg_id: str) -> Optional[MsgIdEntry]:
+        """Find the slave message of a message ID in Parabox."""
+        with self.lock:
+            entry = self.by_parabox.get(parabox_msg_id)
+            if entry is not None:
+                self.by_parabox.move_to_end(parabox_msg_id)
+                return entry
+        row = self.db.get_msg_id_map(parabox_msg_id)
+        return self._cache_row(row)
+
+    def get_parabox(self, slave_channel_id: ModuleID, slave_msg_id: MessageID) -> Optional[MsgIdEntry]:
+        """Find the Parabox message of a message ID in a slave channel."""
+        if not slave_msg_id:
+            return None
+        key = (slave_channel_id, slave_msg_id)
+        with self.lock:
+            entry = self.by_slave.get(key)
+            if entry is not None:
+                self.by_slave.move_to_end(key)
+                return entry
+        row = self.db.get_msg_id_map_by_slave(slave_channel_id, slave_msg_id)
+        return self._cache_row(row)
+
+    def _cache_row(self, row) -> Optional[MsgIdEntry]:
+        if row is None:
+            return None
+        entry = MsgIdEntry(row.parabox_msg_id, ModuleID(row.slave_channel_id),
+                           EFBChannelChatIDStr(row.slave_origin_uid), MessageID(row.slave_msg_id),
+                           row.content_hash, row.created_at)
+        with self.lock:
+            self._cache(entry)
+        return entry
+
+    def _cache(self, entry: MsgIdEntry):
+        self.by_parabox[entry.parabox_msg_id] = entry
+        self.by_parabox.move_to_end(entry.parabox_msg_id)
+        if entry.slave_msg_id:
+            self.by_slave[(entry.slave_channel_id, entry.slave_msg_id)] = entry
+            self.by_slave.move_to_end((entry.slave_channel_id, entry.slave_msg_id))
+        self._trim()
+
+    def _trim(self):
+        while len(self.by_parabox) > self.cache_size:
+            self.by_parabox.popitem(last=False)
+        while len(self.by_slave) > self.cache_size:
+            self.by_slave.popitem(last=False)
+
+    def flush(self):
+        """Write pending mappings to the database."""
+        with self.lock:
+            pending, self.pending = self.pending, []
+        if pending:
+            self.db.set_msg_id_maps(pending)
+            self.logger.debug("Flushed %s message ID mappings.", len(pending))
+
+    def _flush_loop(self):
+        while not self._stop.wait(self.flush_interval):
+            # noinspection PyBroadException
+            try:
+                self.flush()
+            except Exception:
+                self.logger.exception("Error occurred while writing message ID mappings.")
+
+    def stop(self):
+        self._stop.set()
+        self.flush()
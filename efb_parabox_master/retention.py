@@ -0,0 +1,174 @@
+# coding=utf-8
+
+import logging
+import threading
+import time
+from pathlib import Path
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+
+from .utils import get_media_path
+
+if TYPE_CHECKING:
+    from . import ParaboxChannel
+    from .db import DatabaseManager
+
+
+class RetentionManager:
+    """Enforce retention policies on stored outbound messages and media files.
+
+    Policies are limits on age (seconds), count and total size (bytes); a
+    limit set to 0 or ``None`` is disabled. The oldest entries are removed
+    first, in small batches from a background thread, so that the sending
+    path is never blocked for long.
+    """
+
+    def __init__(self, channel: 'ParaboxChannel'):
+        self.channel = channel
+        self.db: 'DatabaseManager' = channel.db
+        self.logger = logging.getLogger(__name__)
+        self.media_path: Path = get_media_path(channel.channel_id)
+
+        self.apply_config(channel.config)
+
+        self.reclaimed: Dict[str, int] = {"msg_count": 0, "msg_bytes": 0, "media_count": 0, "media_bytes": 0,
+                                          "msg_id_count": 0}
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._compactor_loop, name="EPMRetention", daemon=True)
+        self._thread.start()
+
+    def apply_config(self, config: dict):
+        """Apply tunables from the configuration, also when it is reloaded."""
+        self.interval: float = config.get("retention_interval", 600)
+        self.batch_size: int = config.get("retention_batch_size", 500)
+        self.msg_max_age: Optional[int] = config.get("msg_max_age", 7 * 24 * 3600)
+        self.msg_max_count: Optional[int] = config.get("msg_max_count", 10000)
+        self.msg_max_bytes: Optional[int] = config.get("msg_max_bytes", 256 * 1024 * 1024)
+        self.media_max_age: Optional[int] = config.get("media_max_age", 24 * 3600)
+        self.media_max_count: Optional[int] = config.get("media_max_count", 1000)
+        self.media_max_bytes: Optional[int] = config.get("media_max_bytes", 1024 * 1024 * 1024)
+        self.media_inflight_window: float = config.get("media_inflight_window", 600)
+        self.msg_id_max_age: Optional[int] = config.get("msg_id_max_age", 30 * 24 * 3600)
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self) -> Dict[str, int]:
+        """Total amount of data reclaimed since start."""
+        return self.reclaimed.copy()
+
+    def _compactor_loop(self):
+        while not self._stop.wait(self.interval):
+            # noinspection PyBroadException
+            try:
+                self.compact()
+            except Exception:
+                self.logger.exception("Error occurred while enforcing retention policies.")
+
+    def compact(self) -> Dict[str, int]:
+        """Run one round of retention on messages and media.
+
+        Returns:
+            Amount of data reclaimed in this round.
+        """
+        msg_count, msg_bytes = self.compact_msg_json()
+        media_count, media_bytes = self.compact_media()
+        msg_id_count = self.compact_msg_id_map()
+        result = {"msg_count": msg_count, "msg_bytes": msg_bytes,
+                  "media_count": media_count, "media_bytes": media_bytes,
+                  "msg_id_count": msg_id_count}
+        for key, value in result.items():
+            self.reclaimed[key] += value
+        if msg_count or media_count or msg_id_count:
+            self.logger.info("Retention reclaimed %s messages (%s bytes), %s media files (%s bytes) "
+                             "and %s message ID mappings.",
+                             msg_count, msg_bytes, media_count, media_bytes, msg_id_count)
+        return result
+
+    def compact_msg_json(self) -> Tuple[int, int]:
+        """Delete stored outbound messages exceeding the policies, in batches."""
+        total_count = total_bytes = 0
+        if self.msg_max_age:
+            while not self._stop.is_set():
+                count, size = self.db.delete_oldest_msg_json(self.batch_size,
+                                                              created_before=int(time.time()) - self.msg_max_age)
+                total_count += count
+                total_bytes += size
+                if count < self.batch_size:
+                    break
+        if self.msg_max_count or self.msg_max_bytes:
+            stored_count, stored_bytes = self.db.get_msg_json_usage()
+            while not self._stop.is_set() and \
+                    (self.msg_max_count and stored_count > self.msg_max_count or
+                     self.msg_max_bytes and stored_bytes > self.msg_max_bytes):
+                excess_count = stored_count - self.msg_max_count if self.msg_max_count else 0
+                excess_bytes = stored_bytes - self.msg_max_bytes if self.msg_max_bytes else 0
+                # Size the batch by the oldest messages it would free.
+                limit = freed = 0
+                for size in self.db.get_oldest_msg_json_sizes(self.batch_size):
+                    if limit >= excess_count and freed >= excess_bytes:
+                        break
+                    limit += 1
+                    freed += size
+                count, size = self.db.delete_oldest_msg_json(limit) if limit else (0, 0)
+                if not count:
+                    break
+                stored_count -= count
+                stored_bytes -= size
+                total_count += count
+                total_bytes += size
+        return total_count, total_bytes
+
+    def compact_msg_id_map(self) -> int:
+        """Delete expired message ID mappings, in batches."""
+        total_count = 0
+        if self.msg_id_max_age:
+            while not self._stop.is_set():
+                count = self.db.delete_msg_id_maps_before(int(time.time()) - self.msg_id_max_age, self.batch_size)
+                total_count += count
+                if count < self.batch_size:
+                    break
+        return total_count
+
+    def compact_media(self) -> Tuple[int, int]:
+        """Delete stored media files exceeding the policies, oldest first.
+
+        Files modified within ``media_inflight_window`` seconds are kept, as
+        they may still be written, or be sent to a slave channel.
+        """
+        files: List[Tuple[float, int, Path]] = []
+        for path in self.media_path.iterdir():
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            if path.is_file():
+                files.append((stat.st_mtime, stat.st_size, path))
+        files.sort()
+
+        stored_count = len(files)
+        stored_bytes = sum(i[1] for i in files)
+        now = time.time()
+        expire_before = now - self.media_max_age if self.media_max_age else None
+        inflight_after = now - self.media_inflight_window
+        total_count = total_bytes = 0
+        for mtime, size, path in files:
+            if self._stop.is_set() or total_count >= self.batch_size or mtime > inflight_after:
+                break
+            if not (expire_before and mtime < expire_before or
+                    self.media_max_count and stored_count > self.media_max_count or
+                    self.media_max_bytes and stored_bytes > self.media_max_bytes):
+                break
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                # Files still open on some platforms cannot be removed.
+                self.logger.debug("Failed to remove media file %s: %s", path, e)
+                continue
+            stored_count -= 1
+            stored_bytes -= size
+            total_count += 1
+            total_bytes += size
+        return total_count, total_bytes
@@ -4,9 +4,10 @@ import itertools
 import json
 import logging
 import time
+from collections import deque
 from json import JSONDecodeError
 from queue import Queue
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, Optional, Tuple, Deque, Dict, Any
 import threading
 
 from ehforwarderbot import Status
@@ -16,13 +17,16 @@ import asyncio
 from asyncio.exceptions import TimeoutError
 import websockets
 
-# import nest_asyncio
-#
-# nest_asyncio.apply()
+from . import utils
+from .chat import ChatEntry
+from .chat_directory import entry_json
+from .frame_validator import FrameValidator, InvalidFrame, MAX_HEADER_SIZE
+from .tracing import NULL_TRACE
 
 if TYPE_CHECKING:
     from . import ParaboxChannel
     from .db import DatabaseManager
+    from .tracing import Trace
 
 
 class ServerManager:
@@ -33,58 +37,122 @@ class ServerManager:
 
         self.host = channel.config.get("host")
         self.port = channel.config.get("port")
-        self.sending_interval = channel.config.get("sending_interval")
-
+        self.frames = FrameValidator(256 * 1024 * 1024)
+        self.chat_sync_states: Dict[Any, Tuple[str, int, int]] = dict()
+        """Epoch, version and base version of the chat directory held by each connected client,
+        once it has caught up."""
         self.websocket_users = set()
-        self.loop = asyncio.get_event_loop()
+        self.apply_config(channel.config)
+        self.ack_lock = threading.Lock()
+        self.acks: Deque[Dict[str, Any]] = deque(maxlen=channel.config.get("ack_queue_size", 10000))
+        """Acks not sent yet, kept while no client is connected, the oldest are dropped when full."""
+        self.acks_ready: Optional[asyncio.Event] = None
+
+        # The server, and sending of messages, run on the loop of the websocket thread.
+        self.loop = asyncio.new_event_loop()
+        self.main_task = self.loop.create_task(self.server_main())
 
         # create queue to temp msg
         self.msg_temp = Queue()
+        self.msg_ready: Optional[asyncio.Event] = None
+
+        self.ws_thread = threading.Thread(target=self.run_main)
+        self.ws_thread.setDaemon(True)
+        self.ws_thread.start()
 
-        ws_thread = threading.Thread(target=self.run_main)
-        msg_thread = threading.Thread(target=self.msg_main, args=(self.msg_temp,))
-        ws_thread.setDaemon(True)
-        msg_thread.setDaemon(True)
-        ws_thread.start()
-        msg_thread.start()
+    def apply_config(self, config: dict):
+        """Apply tunables from the configuration, also when it is reloaded.
 
-    def msg_main(self, msg_temp):
-        self.loop.run_until_complete(self.msg_looper(msg_temp))
+        Host, port and the size of the ack queue only change on restart.
+        """
+        self.sending_interval = config.get("sending_interval")
+        self.frames.max_size = config.get("frame_max_size", 256 * 1024 * 1024)
+        # Frames beyond the limit are closed by websockets before they are buffered, with room
+        # for the header of binary frames, and checked again by the validator once received.
+        self.max_frame_bytes = self.frames.max_size + 4 + MAX_HEADER_SIZE
+        for websocket in list(self.websocket_users):
+            websocket.max_size = self.max_frame_bytes
+        self.chat_sync_page_size: int = config.get("chat_sync_page_size", 500)
+        self.chat_sync_interval: float = config.get("chat_sync_interval", 5)
+        self.ack_interval: float = config.get("ack_interval", 0.05)
+        self.ack_batch_size: int = config.get("ack_batch_size", 200)
 
     async def msg_looper(self, msg_temp: Queue):
         while True:
-            if not msg_temp.empty():
-                msg = msg_temp.get()
-                # self.logger.info("Sending message, msg_temp_size: %s", msg_temp.qsize())
-                await self.async_send_message(msg)
-                # self.logger.info("Message sent")
+            if msg_temp.empty():
+                self.msg_ready.clear()
+                # Check again, as a message may be queued before the event is cleared.
+                if msg_temp.empty():
+                    await self.msg_ready.wait()
+                continue
+            queued_at, msg, trace = msg_temp.get()
+            start = time.perf_counter()
+            self.channel.metrics.observe("queue_wait", start - queued_at)
+            now = time.monotonic()
+            trace.add("queue_wait", now - (start - queued_at), now)
+            # self.logger.info("Sending message, msg_temp_size: %s", msg_temp.qsize())
+            # noinspection PyBroadException
+            try:
+                with trace.span("websocket_send"):
+                    await self.async_send_message(msg)
+            except Exception:
+                # Resent by the retry of unconfirmed messages.
+                self.logger.exception("Error occurred while sending message to the client.")
+            self.channel.metrics.observe("websocket_send", time.perf_counter() - start)
+            # self.logger.info("Message sent")
             await asyncio.sleep(self.sending_interval)
 
     def run_main(self):
-        self.loop.run_until_complete(self.server_main())
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self.main_task)
+        except asyncio.CancelledError:
+            # Cancelled by graceful_stop
+            pass
+        finally:
+            tasks = asyncio.all_tasks(self.loop)
+            for task in tasks:
+                task.cancel()
+            self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            self.loop.close()
         # self.loop.run_forever()
 
     async def server_main(self):
         self.logger.info("Websocket listening at %s : %s", self.host, self.port)
-        async with websockets.serve(self.handler, self.host, self.port, max_size=1_000_000_000):
-            await asyncio.Future()
+        self.acks_ready = asyncio.Event()
+        self.msg_ready = asyncio.Event()
+        if not self.msg_temp.empty():
+            self.msg_ready.set()
+        self.loop.create_task(self.msg_looper(self.msg_temp))
+        await self.channel.metrics.start()
+        async with websockets.serve(self.handler, self.host, self.port, max_size=self.max_frame_bytes):
+            self.channel.startup_times["listening"] = time.perf_counter() - self.channel.started_at
+            self.logger.info("Websocket server accepting connections %.3fs after startup.",
+                             self.channel.startup_times["listening"])
+            await asyncio.gather(self.chat_sync_looper(), self.ack_looper())
 
     async def handler(self, websocket, path):
         if len(self.websocket_users) == 0:
+            # Applies the limit as of the latest reload.
+            websocket.max_size = self.max_frame_bytes
             try:
-                await self.check_user_permit(websocket)
+                if not await self.check_user_permit(websocket):
+                    return
                 await self.recv_user_msg(websocket)
             except websockets.ConnectionClosed:
                 self.logger.info("ConnectionClosed... %s", path)
-                self.websocket_users.remove(websocket)
+                self.websocket_users.discard(websocket)
                 self.logger.info("Websocket_users: %s", len(self.websocket_users))
             except websockets.InvalidState:
                 self.logger.info("InvalidState...")
                 self.logger.info("Websocket_users: %s", len(self.websocket_users))
             except Exception as e:
                 self.logger.info("Exception Name: %s: %s", type(e).__name__, e)
-                self.websocket_users.remove(websocket)
+                self.websocket_users.discard(websocket)
                 self.logger.info("Websocket_users: %s", len(self.websocket_users))
+            finally:
+                self.chat_sync_states.pop(websocket, None)
+                self.channel.master_messages.drop_uploads()
         else:
             self.logger.info("Already has a user, reject new user")
 
@@ -107,6 +175,9 @@ class ServerManager:
                             }
                         })
                     )
+                    if self.acks:
+                        self.acks_ready.set()
+                    self.channel.slave_messages.resend_pending()
                     return True
                 else:
                     self.logger.info("WebSocket client token incorrect: %s", websocket)
@@ -137,18 +208,276 @@ class ServerManager:
         self.logger.info("recv user msg...")
         while True:
             recv_text = await websocket.recv()
-            json_obj = json.loads(recv_text)
+            received_at = time.monotonic()
+            try:
+                if isinstance(recv_text, bytes):
+                    header, payload = self.frames.parse_binary(recv_text)
+                    self.start_trace(header, received_at)
+                    self.channel.master_messages.process_parabox_binary(header, payload)
+                    continue
+                json_obj = self.frames.parse(recv_text)
+                self.start_trace(json_obj, received_at)
+            except InvalidFrame as e:
+                await websocket.send(
+                    json.dumps({
+                        "type": "code",
+                        "data": {
+                            "code": 1002,
+                            "msg": f"invalid frame: {e}"
+                        }
+                    })
+                )
+                continue
+            if json_obj['type'] == 'reload_config':
+                await self.reload_config(websocket, json_obj.get('data') or {})
+                continue
+            if json_obj['type'] == 'diagnostics':
+                await self.diagnostics(websocket, json_obj['data'])
+                continue
+            if json_obj['type'] == 'chat_sync':
+                if not await self.check_authenticated(websocket):
+                    continue
+                data = json_obj.get('data') or {}
+                await self.sync_chats(websocket, data.get('epoch'), data.get('version', 0), data.get('base'),
+                                      data.get('limit', self.chat_sync_page_size))
+                continue
+            if json_obj['type'] == 'chat_search':
+                if not await self.check_authenticated(websocket):
+                    continue
+                await self.search_chats(websocket, json_obj['data'])
+                continue
             self.channel.master_messages.process_parabox_message(json_obj)
 
+    async def check_authenticated(self, websocket) -> bool:
+        """Check if a client passed :meth:`check_user_permit`, and refuse
+        the frame received otherwise."""
+        if websocket in self.websocket_users:
+            return True
+        self.logger.info("Refused frame from unauthenticated client: %s", websocket)
+        await websocket.send(
+            json.dumps({
+                "type": "code",
+                "data": {
+                    "code": 1000,
+                    "msg": "not authenticated"
+                }
+            })
+        )
+        return False
+
+    def start_trace(self, json_obj: Dict[str, Any], received_at: float):
+        """Open a trace of a message frame received, if sampled, with the time taken to parse it."""
+        if json_obj['type'] == 'message':
+            data = json_obj['data']
+            self.channel.tracing.start("inbound", data['slaveMsgId'], received_at,
+                                       content_type=data['content']['type'], chat=data['slaveOriginUid']) \
+                .add("parse", received_at, time.monotonic())
+
+    async def reload_config(self, websocket, data: Dict[str, Any]):
+        """Reload the configuration as requested by the client with the admin token,
+        and reply with the settings changed."""
+        try:
+            self.channel.diagnostics.check_admin_token(data.get('token'), "configuration reload")
+            applied, restart = await self.loop.run_in_executor(None, self.channel.reload_config)
+        except Exception as e:
+            if not isinstance(e, PermissionError):
+                self.logger.exception("Failed to reload configuration.")
+            await websocket.send(
+                json.dumps({
+                    "type": "code",
+                    "data": {
+                        "code": 1003,
+                        "msg": f"reload failed: {e}"
+                    }
+                })
+            )
+            return
+        await websocket.send(json.dumps({
+            "type": "reload_config",
+            "data": {
+                "applied": applied,
+                "restart": restart,
+            }
+        }))
+
+    async def diagnostics(self, websocket, data: Dict[str, Any]):
+        """Run a diagnostics action requested by the client, see :class:`.DiagnosticsManager`."""
+        try:
+            result = await self.loop.run_in_executor(None, self.channel.diagnostics.handle, data)
+        except Exception as e:
+            if not isinstance(e, (PermissionError, ValueError)):
+                self.logger.exception("Failed to run diagnostics action %s.", data['action'])
+            await websocket.send(
+                json.dumps({
+                    "type": "code",
+                    "data": {
+                        "code": 1004,
+                        "msg": f"diagnostics failed: {e}"
+                    }
+                })
+            )
+            return
+        await websocket.send(json.dumps({
+            "type": "diagnostics",
+            "data": {
+                "action": data['action'],
+                "result": result,
+            }
+        }))
+
+    async def sync_chats(self, websocket, epoch: Optional[str], version: int, base: Optional[int],
+                         limit: int) -> Optional[Tuple[str, int, int]]:
+        """Send a page of the chat directory since a version to the client.
+
+        The client sends ``{"type": "chat_sync", "data": {"epoch": ...,
+        "version": ..., "base": ..., "limit": ...}}`` with the epoch,
+        version and base of the last page it has applied, or without them
+        for the first sync, and keeps requesting while ``more`` is set in the
+        reply. Chats in
+        ``added`` and ``changed`` are inserted or updated, chats in
+        ``removed`` are deleted, and the whole directory is discarded first
+        if ``reset`` is set. Later changes are pushed in the same format.
+
+        Returns:
+            Epoch, version and base to request the next page with, if more
+            changes follow.
+        """
+        chat_manager = self.channel.chat_manager
+        directory = chat_manager.directory
+        page = directory.changes(epoch, version, max(1, min(limit, self.chat_sync_page_size)), base)
+
+        def to_json(keys):
+            return [entry_json(entry) for entry in chat_manager.get_entries(keys)]
+
+        # Chats evicted from the cache are read from the database
+        added, changed = await self.loop.run_in_executor(
+            None, lambda: (to_json(page.added), to_json(page.changed)))
+        await websocket.send(json.dumps({
+            "type": "chat_sync",
+            "data": {
+                "epoch": directory.epoch,
+                "reset": page.reset,
+                "version": page.version,
+                "base": page.base,
+                "latest": directory.version,
+                "more": page.more,
+                "added": added,
+                "changed": changed,
+                "removed": [utils.chat_id_to_str(*key) for key in page.removed],
+            }
+        }))
+        state = (directory.epoch, page.version, page.base)
+        if page.more:
+            # Changes are only pushed once the client has caught up.
+            self.chat_sync_states.pop(websocket, None)
+            return state
+        self.chat_sync_states[websocket] = state
+        return None
+
+    async def search_chats(self, websocket, data: Dict[str, Any]):
+        """Find chats by name, alias or ID for the client, see :meth:`.ChatObjectCacheManager.search`.
+
+        The client sends ``{"type": "chat_search", "data": {"query": ...,
+        "module_id": ..., "limit": ...}}``, and matching chats are sent back
+        in the format of the chat directory, best matches first.
+        """
+        limit = max(1, min(data.get('limit', self.chat_sync_page_size), self.chat_sync_page_size))
+        chats = await self.loop.run_in_executor(
+            None, self.channel.chat_manager.search, data['query'], data.get('module_id'), limit)
+        await websocket.send(json.dumps({
+            "type": "chat_search",
+            "data": {
+                "query": data['query'],
+                "results": [entry_json(ChatEntry.from_chat(chat)) for chat in chats],
+            }
+        }))
+
+    async def chat_sync_looper(self):
+        """Push changes of the chat directory to the client once it has synced."""
+        while True:
+            await asyncio.sleep(self.chat_sync_interval)
+            for websocket, state in list(self.chat_sync_states.items()):
+                if state[1] >= self.channel.chat_manager.directory.version:
+                    continue
+                # noinspection PyBroadException
+                try:
+                    next_page: Optional[Tuple[str, int, int]] = state
+                    while next_page is not None:
+                        next_page = await self.sync_chats(websocket, *next_page, self.chat_sync_page_size)
+                except Exception:
+                    self.logger.exception("Error occurred while pushing chat directory changes.")
+
+    def send_ack(self, ack: Dict[str, Any]):
+        """Queue an ack of a message or recall from Parabox to the client, thread safe.
+
+        Acks are sent in ``{"type": "ack", "data": [...]}`` frames. Acks
+        queued within ``ack_interval`` seconds of the first one are sent in
+        the same frame, up to ``ack_batch_size`` per frame.
+        """
+        with self.ack_lock:
+            self.acks.append(ack)
+            first = len(self.acks) == 1
+        if first and self.acks_ready is not None:
+            self.loop.call_soon_threadsafe(self.acks_ready.set)
+
+    async def ack_looper(self):
+        """Send queued acks to the client in batches."""
+        while True:
+            await self.acks_ready.wait()
+            await asyncio.sleep(self.ack_interval)
+            self.acks_ready.clear()
+            if not self.websocket_users:
+                continue
+            while self.acks:
+                with self.ack_lock:
+                    batch = [self.acks.popleft() for _ in range(min(len(self.acks), self.ack_batch_size))]
+                frame = json.dumps({"type": "ack", "data": batch})
+                # noinspection PyBroadException
+                try:
+                    for websocket in list(self.websocket_users):
+                        await websocket.send(frame)
+                except Exception:
+                    self.logger.exception("Error occurred while sending %s acks.", len(batch))
+                    break
+
     def pulling(self):
         pass
 
-    def graceful_stop(self):
+    def graceful_stop(self, deadline: Optional[float] = None):
+        """
+        Stop the websocket server.
+
+        Messages and acks still queued are sent to the connected client
+        first, then connections are closed cleanly.
+
+        Args:
+            deadline: :func:`time.monotonic` to give up sending and closing
+                by, stop right away if not given.
+        """
+        if not self.ws_thread.is_alive():
+            return
+        if deadline is None:
+            deadline = time.monotonic()
+        while self.websocket_users and (not self.msg_temp.empty() or self.acks) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        if self.websocket_users:
+            future = asyncio.run_coroutine_threadsafe(self.close_connections(), self.loop)
+            try:
+                future.result(max(0.1, deadline - time.monotonic()))
+            except Exception as e:
+                self.logger.info("Connections are not closed cleanly: %s", e or type(e).__name__)
+        self.loop.call_soon_threadsafe(self.main_task.cancel)
+        self.ws_thread.join(max(0.1, deadline - time.monotonic()))
         self.logger.debug("Websocket server stopped")
-        self.loop.stop()
 
-    def send_message(self, json_str):
-        self.msg_temp.put(json_str)
+    async def close_connections(self):
+        await asyncio.gather(*(websocket.close(1001, "server stopping") for websocket in list(self.websocket_users)),
+                             return_exceptions=True)
+
+    def send_message(self, json_str, trace: 'Trace' = NULL_TRACE):
+        self.msg_temp.put((time.perf_counter(), json_str, trace))
+        if self.msg_ready is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.msg_ready.set)
         # self.loop.create_task(self.async_send_message(json_str))
 
     async def async_send_message(self, json_str):
@@ -165,11 +494,16 @@ class ServerManager:
     def send_status(self, status: 'Status'):
         if isinstance(status, ChatUpdates):
             self.logger.debug("Received chat updates from channel %s", status.channel)
-            pass
+            chat_manager = self.channel.chat_manager
+            chat_manager.update_chats(status.channel, [*status.new_chats, *status.modified_chats])
+            for chat_id in status.removed_chats:
+                chat_manager.delete_chat_object(status.channel.channel_id, chat_id)
         elif isinstance(status, MemberUpdates):
             self.logger.debug("Received member updates from channel %s about group %s",
                               status.channel, status.chat_id)
-            pass
+            self.channel.chat_manager.update_members(status.channel, status.chat_id,
+                                                     [*status.new_members, *status.modified_members],
+                                                     list(status.removed_members))
         elif isinstance(status, MessageRemoval):
             self.logger.debug("Received message removal request from channel %s on message %s",
                               status.source_channel, status.message)
@@ -3,11 +3,10 @@ import base64
 import io
 import logging
 import json
+import threading
 import time
-from queue import Queue
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, List, Dict, Tuple, Optional
 
-from PIL import Image
 from ehforwarderbot import Message, Status, coordinator
 from ehforwarderbot.chat import ChatNotificationState, SelfChatMember, GroupChat, PrivateChat, SystemChat, Chat
 from ehforwarderbot.constants import MsgType
@@ -16,61 +15,212 @@ from ehforwarderbot.message import LinkAttribute, LocationAttribute, MessageComm
     StatusAttribute
 from ehforwarderbot.status import ChatUpdates, MemberUpdates, MessageRemoval, MessageReactionsUpdate
 from . import utils
-import asyncio
-import nest_asyncio
-
-nest_asyncio.apply()
-
+from .constants import MsgState
+from .tracing import NULL_TRACE
 from .utils import str2int
 
 if TYPE_CHECKING:
     from . import ParaboxChannel
     from .db import DatabaseManager
+    from .tracing import Trace
 
 
 class SlaveMessageProcessor:
+    """Send messages from slave channels to Parabox.
+
+    Messages are kept until the client confirms them with a ``response``
+    frame. They are stored in the database in batches from a background
+    thread, which also resends them with exponential backoff while a client
+    is connected, see :meth:`.DatabaseManager.take_all_msg_json`.
+    """
+
     def __init__(self, channel: 'ParaboxChannel'):
         self.channel = channel
         self.db: 'DatabaseManager' = channel.db
         self.logger = logging.getLogger(__name__)
         self.logger.debug("SlaveMessageProcessor initialized.")
-        self.compatibility_mode = channel.config.get("compatibility_mode")
-        self.msg_temp = dict()
+        self.lock = threading.Lock()
+        self.msg_temp: Dict[str, str] = dict()
+        """JSON of messages not yet confirmed by the client, by message ID, oldest first."""
+        self.msg_temp_bytes = 0
+        self.unstored: List[Tuple[str, int]] = []
+        """IDs of messages sent but not stored yet, with the timestamp they are sent at."""
+        self.finished: List[str] = []
+        """IDs of messages confirmed by the client or dropped, to be deleted from the database."""
+        self.apply_config(channel.config)
+        self.restore_pending()
+
+        self._wake = threading.Event()
+        self._stopping = False
+        self._reschedule: Optional[bool] = None
+        """Messages to make due on the next round: all if True, all but dead letters if False."""
+        self._thread = threading.Thread(target=self._retry_loop, name="EPMRetry", daemon=True)
+        self._thread.start()
+
+    def apply_config(self, config: dict):
+        """Apply tunables from the configuration, also when it is reloaded."""
+        self.compatibility_mode = config.get("compatibility_mode")
+        self.retry_interval: float = config.get("retry_interval", 1)
+        self.max_count: Optional[int] = config.get("unconfirmed_max_count", 10000)
+        self.max_bytes: Optional[int] = config.get("unconfirmed_max_bytes", 64 * 1024 * 1024)
 
     def send_message(self, msg: Message) -> Message:
+        trace = self.channel.tracing.start("outbound", msg.uid, type=msg.type.name,
+                                           chat=utils.chat_id_to_str(chat=msg.chat))
         self.logger.info("msg_temp size: %s", len(self.msg_temp))
-        json_str = self.build_json(msg)
-        self.msg_temp[msg.uid] = json_str
-        # self.db.set_msg_json(uid=msg.uid, json=json_str)
-        self.channel.server_manager.send_message(json_str)
+        with self.channel.metrics.time("build_json"), trace.span("build_json"):
+            json_str = self.build_json(msg, trace)
+        self.channel.metrics.inc("outbound_messages", type=msg.type.name)
+        with self.lock:
+            self._keep(msg.uid, json_str)
+            self.unstored.append((msg.uid, int(time.time())))
+            dropped = self._trim()
+        if dropped:
+            self.channel.metrics.inc("outbound_dropped", dropped)
+            self.logger.warning("Dropped %s oldest messages not confirmed by the client, "
+                                "%s are kept (%s bytes).", dropped, len(self.msg_temp), self.msg_temp_bytes)
+        self.channel.server_manager.send_message(json_str, trace)
         return msg
 
+    def _keep(self, uid: str, json_str: str):
+        old = self.msg_temp.pop(uid, None)
+        if old is not None:
+            self.msg_temp_bytes -= len(old)
+        self.msg_temp[uid] = json_str
+        self.msg_temp_bytes += len(json_str)
+
+    def _trim(self) -> int:
+        """Drop the oldest messages beyond ``unconfirmed_max_count`` or ``unconfirmed_max_bytes``.
+
+        Returns:
+            Number of messages dropped.
+        """
+        dropped = 0
+        while len(self.msg_temp) > 1 and \
+                (self.max_count and len(self.msg_temp) > self.max_count or
+                 self.max_bytes and self.msg_temp_bytes > self.max_bytes):
+            uid = next(iter(self.msg_temp))
+            self.msg_temp_bytes -= len(self.msg_temp.pop(uid))
+            self.finished.append(uid)
+            dropped += 1
+        return dropped
+
     def resort_message(self, uid: str):
-        try:
-            self.msg_temp.pop(uid)
-        except KeyError:
-            pass
+        self.channel.tracing.finish("outbound", uid, last_span="client_ack")
+        with self.lock:
+            json_str = self.msg_temp.pop(uid, None)
+            if json_str is not None:
+                self.msg_temp_bytes -= len(json_str)
+                self.finished.append(uid)
+
+    def flush(self):
+        """Store messages sent since the last flush, and delete confirmed or dropped ones from the database."""
+        with self.lock:
+            unstored, self.unstored = self.unstored, []
+            finished, self.finished = self.finished, []
+            items = [(uid, self.msg_temp[uid], sent_at) for uid, sent_at in unstored if uid in self.msg_temp]
+        if items:
+            self.db.add_msg_jsons(items)
+        if finished:
+            self.db.delete_msg_jsons(finished)
+
+    def retry(self):
+        """Resend a batch of messages due for another attempt."""
+        reschedule, self._reschedule = self._reschedule, None
+        if reschedule is not None:
+            self.db.refresh_msg_json(include_dead=reschedule)
+        stale = []
+        for msg_json in self.db.take_all_msg_json() or []:
+            with self.lock:
+                json_str = self.msg_temp.get(msg_json.uid)
+            if json_str is None:
+                # Confirmed or dropped since the last flush
+                stale.append(msg_json.uid)
+                continue
+            if msg_json.state == MsgState.DEAD:
+                self.logger.warning("[%s] Message is not confirmed by the client after %s attempts, "
+                                    "giving up until refreshed.", msg_json.uid, msg_json.tried)
+            self.channel.metrics.inc("outbound_retries")
+            self.channel.server_manager.send_message(json_str)
+        if stale:
+            self.db.delete_msg_jsons(stale)
+
+    def _retry_loop(self):
+        while True:
+            self._wake.wait(self.retry_interval)
+            self._wake.clear()
+            if self._stopping:
+                break
+            # noinspection PyBroadException
+            try:
+                self.flush()
+                # Attempts are not spent while no client is connected.
+                if self.channel.server_manager.websocket_users:
+                    self.retry()
+            except Exception:
+                self.logger.exception("Error occurred while retrying messages to Parabox.")
+
+    def save_pending(self) -> int:
+        """
+        Stop retrying, and store all messages not yet confirmed by the
+        client, so that they are restored on the next start.
+
+        Returns:
+            Number of messages kept.
+        """
+        self._stopping = True
+        self._wake.set()
+        self._thread.join()
+        self.flush()
+        return len(self.msg_temp)
+
+    def restore_pending(self) -> int:
+        """
+        Restore messages not confirmed by the client before the last stop.
+        They are resent as soon as a client is connected.
+
+        Returns:
+            Number of messages restored.
+        """
+        restored = self.db.get_pending_msg_json()
+        with self.lock:
+            for uid, json_str in restored:
+                self._keep(uid, json_str)
+            self._trim()
+        if restored:
+            self.db.refresh_msg_json()
+            self.logger.info("Restored %s messages not confirmed by the client before the last stop.", len(restored))
+        return len(restored)
+
+    def resend_pending(self):
+        """Resend messages not yet confirmed right away, except dead letters, as a client is connected."""
+        self._reschedule = self._reschedule or False
+        self._wake.set()
 
     def refresh_msg(self):
-        for msg_json in self.msg_temp.values():
-            self.channel.server_manager.send_message(msg_json)
+        """Resend all messages not yet confirmed right away, with all of their attempts available again."""
+        self._reschedule = True
+        self._wake.set()
 
-    def build_json(self, msg: Message) -> str:
+    def build_json(self, msg: Message, trace: 'Trace' = NULL_TRACE) -> str:
         slave_msg_id = msg.uid
         slave_origin_uid = utils.chat_id_to_str(chat=msg.chat)
         channel, uid, gid = utils.chat_id_str_to_id(slave_origin_uid)
 
         content_obj = self.get_content_obj(msg)
+        with self.channel.metrics.time("avatar"), trace.span("avatar"):
+            sender_avatar = self.get_sender_avatar_bytes_str(msg)
+            chat_avatar = self.get_chat_avatar_bytes_str(msg)
 
         json_obj = {
             "contents": [content_obj],
             "profile": {
                 "name": msg.author.name,
-                "avatar": self.get_sender_avatar_bytes_str(msg),
+                "avatar": sender_avatar,
             },
             "subjectProfile": {
                 "name": msg.chat.name,
-                "avatar": self.get_chat_avatar_bytes_str(msg),
+                "avatar": chat_avatar,
             },
             "timestamp": int(round(time.time() * 1000)),
             "chatType": self.get_chat_type(msg.chat),
@@ -85,6 +235,8 @@ class SlaveMessageProcessor:
         picture = coordinator.slaves[channel].get_chat_picture(msg.chat)
         if not picture:
             raise EFBOperationNotSupported()
+        # Pillow is loaded on first use, see ParaboxChannel.warm_up.
+        from PIL import Image
         pic_img = Image.open(picture)
 
         # if pic_img.size[0] < 256 or \
@@ -108,6 +260,7 @@ class SlaveMessageProcessor:
             picture = coordinator.slaves[channel].get_chat_member_picture(msg.author)
             if not picture:
                 raise EFBOperationNotSupported()
+            from PIL import Image
             pic_img = Image.open(picture)
 
             # if pic_img.size[0] < 256 or \
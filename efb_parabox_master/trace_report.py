@@ -0,0 +1,63 @@
+# coding=utf-8
+"""Print the slowest traces of messages written by :class:`~.tracing.TraceManager`.
+
+Usage: ``python -m efb_parabox_master.trace_report [-n 10] [-d outbound|inbound] [path]``
+"""
+
+import argparse
+import heapq
+import json
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional
+
+from .tracing import get_trace_path
+
+
+def read_traces(path: Path) -> Iterator[Dict[str, Any]]:
+    """Traces in a trace file and its rotated backups."""
+    for file in [path] + sorted(path.parent.glob(path.name + ".*")):
+        try:
+            with open(file, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        continue
+        except FileNotFoundError:
+            continue
+
+
+def format_trace(record: Dict[str, Any]) -> str:
+    lines = ["{:10.1f} ms  {:8}  {}  {}  {}".format(
+        record["duration"] * 1000, record["direction"],
+        datetime.fromtimestamp(record["time"]).strftime("%Y-%m-%d %H:%M:%S"), record["key"],
+        " ".join(f"{k}={v}" for k, v in record["attrs"].items()))]
+    for span in record["spans"]:
+        lines.append("    {:20} +{:10.1f} ms {:10.1f} ms".format(
+            span["name"], span["start"] * 1000, span["duration"] * 1000))
+    return "\n".join(lines)
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(prog="python -m efb_parabox_master.trace_report",
+                                     description="Print the slowest traces of messages.")
+    parser.add_argument("path", nargs="?", type=Path,
+                        help="trace file, traces.jsonl in the data directory of the profile if not given")
+    parser.add_argument("-n", type=int, default=10, help="number of traces to print")
+    parser.add_argument("-p", "--profile", default="default", help="EFB profile of the channel")
+    parser.add_argument("-d", "--direction", choices=("outbound", "inbound"), help="only traces of a direction")
+    args = parser.parse_args(argv)
+
+    path = args.path
+    if path is None:
+        from ehforwarderbot import coordinator
+        coordinator.profile = args.profile
+        path = get_trace_path("ojhdt.parabox")
+    traces = (i for i in read_traces(path) if args.direction in (None, i.get("direction")))
+    for record in heapq.nlargest(args.n, traces, key=lambda i: i["duration"]):
+        print(format_trace(record))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,278 @@
+# coding=utf-8
+
+import importlib
+import json
+import logging
+import random
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+from queue import Queue
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple
+
+from ehforwarderbot import utils as efb_utils
+
+if TYPE_CHECKING:
+    from . import ParaboxChannel
+
+MAX_ACTIVE_TRACES = 10000
+"""Traces kept open at a time, the oldest ones are exported unfinished beyond this."""
+
+TraceKey = Tuple[str, str]
+"""Key of an open trace: direction (``outbound`` or ``inbound``), message ID"""
+
+
+class Trace:
+    """Spans of the stages a sampled message goes through.
+
+    Times are :func:`time.monotonic`, and are exported as offsets from the
+    start of the trace.
+    """
+
+    __slots__ = ("trace_id", "direction", "key", "started_at", "wall_time", "attrs", "spans")
+
+    def __init__(self, direction: str, key: str, started_at: float, attrs: Dict[str, Any]):
+        self.trace_id = uuid.uuid4().hex
+        self.direction = direction
+        self.key = key
+        self.started_at = started_at
+        self.wall_time = time.time() - (time.monotonic() - started_at)
+        self.attrs = attrs
+        self.spans: List[Tuple[str, float, float]] = []
+
+    def add(self, name: str, start: float, end: float):
+        """Record a span by its start and end time."""
+        self.spans.append((name, start, end))
+
+    @contextmanager
+    def span(self, name: str):
+        """Record the enclosed block as a span."""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.spans.append((name, start, time.monotonic()))
+
+    @property
+    def last_end(self) -> float:
+        """End of the latest span, or start of the trace if there is none."""
+        return max((i[2] for i in self.spans), default=self.started_at)
+
+    def record(self, end: float) -> Dict[str, Any]:
+        """Representation of the trace as exported."""
+        return {
+            "id": self.trace_id,
+            "direction": self.direction,
+            "key": self.key,
+            "time": round(self.wall_time, 3),
+            "duration": round(end - self.started_at, 6),
+            "attrs": self.attrs,
+            "spans": [{"name": name, "start": round(start - self.started_at, 6), "duration": round(end - start, 6)}
+                      for name, start, end in sorted(self.spans, key=lambda i: i[1])],
+        }
+
+
+class NullTrace:
+    """Stand-in for messages not sampled, recording nothing."""
+
+    __slots__ = ()
+    _null_context = nullcontext()
+
+    def add(self, name: str, start: float, end: float):
+        pass
+
+    def span(self, name: str):
+        return self._null_context
+
+
+NULL_TRACE = NullTrace()
+
+
+class RotatingFileExporter:
+    """Write traces as JSON lines to a file, rotated by size like
+    :class:`logging.handlers.RotatingFileHandler`."""
+
+    def __init__(self, path: Path, max_bytes: int, backups: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.lock = threading.Lock()
+        self.file = open(path, "a", encoding="utf-8")
+
+    def export(self, record: Dict[str, Any]):
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self.lock:
+            if self.max_bytes and self.file.tell() + len(line) > self.max_bytes and self.file.tell():
+                self._rotate()
+            self.file.write(line)
+            self.file.flush()
+
+    def _rotate(self):
+        self.file.close()
+        for i in range(self.backups - 1, 0, -1):
+            source = self.path.with_name(f"{self.path.name}.{i}")
+            if source.exists():
+                source.replace(self.path.with_name(f"{self.path.name}.{i + 1}"))
+        if self.backups:
+            self.path.replace(self.path.with_name(f"{self.path.name}.1"))
+        else:
+            self.path.unlink()
+        self.file = open(self.path, "a", encoding="utf-8")
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+class TraceManager:
+    """Sampled tracing of messages through the bridge.
+
+    A sampled message gets a trace when it enters the bridge, which is kept
+    open by direction and message ID so that stages in other threads can
+    add their spans to it, and exported when the message is done:
+
+    * Outbound, from the slave channel handing it over, through building
+      JSON, fetching avatars, waiting in queue and the websocket send, to
+      the confirmation from the client. Traces not confirmed within
+      ``trace_ack_timeout`` seconds are exported unconfirmed.
+    * Inbound, from the frame received, through waiting in the dispatch
+      lane, looking up the chat, decoding media and the send to the slave
+      channel, to the ack.
+
+    Traces are exported from a background thread, to a rotating file by
+    default. Another exporter can be given in ``trace_exporter`` as
+    ``module:attribute``, called with the configuration to create an object
+    with ``export(record)`` and ``close()`` methods. Run ``python -m efb_parabox_master.trace_report``
+    to print the slowest traces from the file.
+    """
+
+    def __init__(self, channel: 'ParaboxChannel'):
+        self.channel = channel
+        self.logger = logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        self.active: 'OrderedDict[TraceKey, Trace]' = OrderedDict()
+        self.exported = 0
+        self.queue: 'Queue[Optional[Tuple[Trace, float]]]' = Queue()
+        self.exporter = None
+        self._thread: Optional[threading.Thread] = None
+        self.apply_config(channel.config)
+
+    def apply_config(self, config: dict):
+        """Apply tunables from the configuration, also when it is reloaded.
+
+        The exporter is created once tracing is enabled, and kept until stop.
+        """
+        sample_rate: float = config.get("trace_sample_rate", 0)
+        if sample_rate and self.exporter is None:
+            exporter = config.get("trace_exporter")
+            if exporter:
+                module_name, _, attr = exporter.partition(":")
+                self.exporter = getattr(importlib.import_module(module_name), attr)(config)
+            else:
+                self.exporter = RotatingFileExporter(
+                    Path(config.get("trace_file") or get_trace_path(self.channel.channel_id)),
+                    config.get("trace_file_max_bytes", 10 * 1024 * 1024), config.get("trace_file_backups", 3))
+            self._thread = threading.Thread(target=self._export_loop, name="EPMTraceExport", daemon=True)
+            self._thread.start()
+        self.sample_rate = sample_rate
+        self.ack_timeout: float = config.get("trace_ack_timeout", 300)
+
+    def start(self, direction: str, key: str, started_at: Optional[float] = None, **attrs: Any) -> Trace:
+        """
+        Open a trace for a message, if it is sampled.
+
+        Args:
+            direction: ``outbound`` or ``inbound``.
+            key: ID of the message.
+            started_at: :func:`time.monotonic` the message entered the
+                bridge, now if not given.
+            attrs: Attributes of the message to export with the trace.
+
+        Returns:
+            The trace, or :data:`NULL_TRACE` if not sampled, or a trace of
+            the message is already open.
+        """
+        if not self.sample_rate or random.random() >= self.sample_rate:
+            return NULL_TRACE
+        now = time.monotonic()
+        trace = Trace(direction, key, now if started_at is None else started_at, attrs)
+        expired = []
+        with self.lock:
+            if (direction, key) in self.active:
+                return NULL_TRACE
+            self.active[(direction, key)] = trace
+            while self.active:
+                oldest = next(iter(self.active.values()))
+                if len(self.active) <= MAX_ACTIVE_TRACES and oldest.started_at > now - self.ack_timeout:
+                    break
+                expired.append(self.active.popitem(last=False)[1])
+        for i in expired:
+            i.attrs["finished"] = False
+            self.queue.put((i, now))
+        return trace
+
+    def get(self, direction: str, key: str) -> Trace:
+        """The open trace of a message, or :data:`NULL_TRACE` if there is none."""
+        if not self.active:
+            return NULL_TRACE
+        with self.lock:
+            return self.active.get((direction, key), NULL_TRACE)
+
+    def finish(self, direction: str, key: str, last_span: Optional[str] = None, **attrs: Any):
+        """
+        Export the open trace of a message, if there is one.
+
+        Args:
+            direction: ``outbound`` or ``inbound``.
+            key: ID of the message.
+            last_span: Name of a span to record from the end of the latest
+                span until now, such as waiting for confirmation.
+            attrs: Attributes of the result to export with the trace.
+        """
+        if not self.active:
+            return
+        with self.lock:
+            trace = self.active.pop((direction, key), None)
+        if trace is None:
+            return
+        now = time.monotonic()
+        if last_span:
+            trace.add(last_span, trace.last_end, now)
+        trace.attrs.update(attrs, finished=True)
+        self.queue.put((trace, now))
+
+    def _export_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            trace, end = item
+            # noinspection PyBroadException
+            try:
+                self.exporter.export(trace.record(end))
+                self.exported += 1
+            except Exception:
+                self.logger.exception("Failed to export trace of message %s.", trace.key)
+
+    def stop(self):
+        """Export traces still open as unfinished, and close the exporter, if tracing was enabled."""
+        if self._thread is None:
+            return
+        with self.lock:
+            traces = list(self.active.values())
+            self.active.clear()
+        now = time.monotonic()
+        for trace in traces:
+            trace.attrs["finished"] = False
+            self.queue.put((trace, now))
+        self.queue.put(None)
+        self._thread.join()
+        self.exporter.close()
+
+
+def get_trace_path(channel_id: str) -> Path:
+    """Default path of the trace file."""
+    return efb_utils.get_data_path(channel_id) / "traces.jsonl"
@@ -1,6 +1,8 @@
+from pathlib import Path
 from typing import NewType, TYPE_CHECKING, Optional, Tuple
 
 from ehforwarderbot import Channel
+from ehforwarderbot import utils as efb_utils
 from ehforwarderbot.chat import BaseChat, ChatMember
 from ehforwarderbot.types import ModuleID, ChatID
 
@@ -58,6 +60,16 @@ def chat_id_str_to_id(s: EFBChannelChatIDStr) -> Tuple[ModuleID, ChatID, Optiona
     return channel_id, chat_uid, group_id
 
 
+def get_media_path(channel_id: ModuleID) -> Path:
+    """
+    Directory of media files stored by the channel, created if not existing.
+    Files in this directory are subject to media retention.
+    """
+    media_path = efb_utils.get_data_path(channel_id) / "media"
+    media_path.mkdir(exist_ok=True)
+    return media_path
+
+
 def str2int(s: str) -> int:
     r = ''
     for i in s:
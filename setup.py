@@ -38,9 +38,11 @@ setup(
         "bullet>=2.2.0",
         "cjkwrap",
         "typing-extensions>=3.7.4.1",
-        "websockets~=10.4",
-        "nest_asyncio~=1.5.6"
+        "websockets~=10.4"
     ],
+    extras_require={
+        "orjson": ["orjson"]
+    },
     entry_points={
         "ehforwarderbot.master": "ojhdt.parabox = efb_parabox_master:ParaboxChannel",
         "ehforwarderbot.wizard": "ojhdt.parabox = efb_parabox_master.wizard:wizard"
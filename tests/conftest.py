@@ -0,0 +1,181 @@
+# coding=utf-8
+
+from queue import Queue
+from types import SimpleNamespace
+
+import pytest
+from ehforwarderbot import coordinator, MsgType
+from ehforwarderbot.channel import MasterChannel, SlaveChannel
+from ehforwarderbot.chat import PrivateChat, GroupChat
+
+from efb_parabox_master.db import DatabaseManager
+from efb_parabox_master.dispatcher import InboundDispatcher
+from efb_parabox_master.frame_validator import FrameValidator
+from efb_parabox_master.master_message import MasterMessageProcessor
+from efb_parabox_master.metrics import MetricsManager
+from efb_parabox_master.msg_id_cache import MessageIdCacheManager
+from efb_parabox_master.tracing import TraceManager
+
+
+class FakeChannel:
+    """Stand-in for :class:`efb_parabox_master.ParaboxChannel` with only a configuration."""
+
+    channel_id = "ojhdt.parabox"
+
+    def __init__(self, **config):
+        self.config = dict(host="127.0.0.1", port=0, token="token", sending_interval=0)
+        self.config.update(config)
+
+
+MasterChannel.register(FakeChannel)
+
+
+@pytest.fixture
+def data_path(tmp_path, monkeypatch):
+    monkeypatch.setenv("EFB_DATA_PATH", str(tmp_path))
+    monkeypatch.setattr(coordinator, "profile", "test", raising=False)
+    return tmp_path / "profiles" / "test" / FakeChannel.channel_id
+
+
+@pytest.fixture
+def channel(data_path):
+    return FakeChannel()
+
+
+@pytest.fixture
+def db(channel):
+    manager = DatabaseManager(channel)
+    channel.db = manager
+    yield manager
+    manager.stop_worker()
+
+
+class FakeServer:
+    """Stand-in for :class:`efb_parabox_master.server.ServerManager` recording what is sent."""
+
+    def __init__(self):
+        self.websocket_users = {"client"}
+        self.sent = []
+        self.acks = []
+
+    def send_message(self, json_str, trace=None):
+        self.sent.append(json_str)
+
+    def send_ack(self, ack):
+        self.acks.append(ack)
+
+
+class FakeSlave(SlaveChannel):
+    """Slave channel with a private chat and a group, recording what it is sent."""
+
+    channel_name = "Fake Slave"
+    channel_emoji = "F"
+    channel_id = "fake.slave"
+    supported_message_types = {MsgType.Text, MsgType.Image, MsgType.File}
+
+    def __init__(self):
+        self.sent = []
+        self.statuses = []
+        self.friend = PrivateChat(channel=self, uid="friend", name="Friend")
+        self.group = GroupChat(channel=self, uid="group", name="Group")
+        self.group.add_member(uid="alice", name="Alice")
+        self.group.add_member(uid="bob", name="Bob", alias="Bobby")
+        self.chats = [self.friend, self.group]
+
+    def get_chats(self):
+        return self.chats
+
+    def get_chat(self, chat_uid):
+        for chat in self.chats:
+            if chat.uid == chat_uid:
+                return chat
+        from ehforwarderbot.exceptions import EFBChatNotFound
+        raise EFBChatNotFound()
+
+    def send_message(self, msg):
+        self.sent.append(msg)
+        msg.uid = f"slave_{len(self.sent)}"
+        return msg
+
+    def send_status(self, status):
+        self.statuses.append(status)
+
+    def poll(self):
+        pass
+
+    def stop_polling(self):
+        pass
+
+    def get_message_by_id(self, chat, msg_id):
+        pass
+
+    def get_chat_picture(self, chat):
+        pass
+
+    def get_extra_functions(self):
+        return {}
+
+
+@pytest.fixture
+def slave(monkeypatch):
+    slave = FakeSlave()
+    monkeypatch.setattr(coordinator, "slaves", {slave.channel_id: slave})
+    return slave
+
+
+@pytest.fixture
+def msg_ids(channel, db):
+    channel.config["msg_id_flush_interval"] = 3600
+    manager = MessageIdCacheManager(channel)
+    channel.msg_ids = manager
+    yield manager
+    manager.stop()
+
+
+class FakeChatManager:
+    """Stand-in for :class:`efb_parabox_master.chat_object_cache.ChatObjectCacheManager`
+    looking up chats of slave channels directly."""
+
+    def get_chat(self, module_id, chat_id, build_dummy=False):
+        try:
+            return coordinator.slaves[module_id].get_chat(chat_id)
+        except Exception:
+            return None
+
+
+@pytest.fixture
+def master(channel, db, msg_ids, slave):
+    """Message processor of Parabox, with the server replaced by :class:`FakeServer`."""
+    channel.metrics = MetricsManager(channel)
+    channel.tracing = TraceManager(channel)
+    channel.server_manager = FakeServer()
+    channel.chat_manager = FakeChatManager()
+    processor = MasterMessageProcessor(channel)
+    channel.master_messages = processor
+    yield processor
+    channel.tracing.stop()
+
+
+@pytest.fixture
+def chat_manager(channel, db, slave):
+    """Chat cache with chats of :class:`FakeSlave` loaded."""
+    from efb_parabox_master.chat_object_cache import ChatObjectCacheManager
+    channel.config["chat_snapshot"] = False
+    manager = ChatObjectCacheManager(channel)
+    channel.chat_manager = manager
+    assert manager.ready.wait(5)
+    return manager
+
+
+@pytest.fixture
+def metrics(channel, master, chat_manager):
+    """Metrics of a channel with a message queued to the client, unconfirmed messages and pending acks."""
+    server = channel.server_manager
+    server.msg_temp = Queue()
+    server.msg_temp.put("message")
+    server.frames = FrameValidator(1024)
+    server.acks = [{}] * 3
+    channel.slave_messages = SimpleNamespace(msg_temp={"a": "{}", "b": "{}"}, msg_temp_bytes=4)
+    channel.dispatcher = InboundDispatcher(channel)
+    yield channel.metrics
+    channel.dispatcher.stop()
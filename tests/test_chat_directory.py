@@ -0,0 +1,76 @@
+# coding=utf-8
+
+from ehforwarderbot import coordinator
+from ehforwarderbot.chat import GroupChat
+from ehforwarderbot.status import ChatUpdates, MemberUpdates
+
+from efb_parabox_master.chat import ChatEntry
+from efb_parabox_master.chat_directory import ChatDirectory
+from efb_parabox_master.chat_object_cache import ChatObjectCacheManager
+from efb_parabox_master.server import ServerManager
+
+
+def entry(uid, name):
+    return ChatEntry("Private", "fake.slave", "Fake Slave", "F", uid, name, None, "", 0, True, False, None)
+
+
+def test_restored_directory_keeps_epoch_and_versions():
+    directory = ChatDirectory()
+    directory.update(entry("a", "A"))
+    directory.update(entry("b", "B"))
+    directory.remove(("fake.slave", "a"))
+    page = directory.changes(None, 0, 100)
+
+    restored = ChatDirectory()
+    assert restored.restore(list(directory.dump()))
+    assert (restored.epoch, restored.version) == (directory.epoch, directory.version)
+    # Unchanged chats keep their versions
+    restored.update(entry("b", "B"))
+    assert restored.changes(directory.epoch, page.version, 100) == directory.changes(directory.epoch, page.version, 100)
+    restored.update(entry("b", "Bee"))
+    later = restored.changes(directory.epoch, page.version, 100)
+    assert not later.reset and later.changed == [("fake.slave", "b")]
+
+
+def test_directory_is_not_restored_after_changes():
+    directory = ChatDirectory()
+    directory.update(entry("a", "A"))
+    other = ChatDirectory()
+    other.update(entry("b", "B"))
+    assert not other.restore(list(directory.dump()))
+    assert other.epoch != directory.epoch
+
+
+def test_directory_restored_once_on_restart(channel, chat_manager, slave):
+    epoch = chat_manager.directory.epoch
+    chat_manager.stop()
+    slave.chats.remove(slave.friend)
+
+    restarted = ChatObjectCacheManager(channel)
+    assert restarted.ready.wait(5)
+    assert restarted.directory.epoch == epoch
+    assert ("fake.slave", "friend") in restarted.directory.tombstones
+    assert not restarted.directory_path.exists()
+    # Not restored again after a crash
+    assert ChatObjectCacheManager(channel).directory.epoch != epoch
+
+
+def test_chat_and_member_updates(channel, chat_manager, slave, db, monkeypatch):
+    monkeypatch.setattr(coordinator, "master", channel, raising=False)
+    server = ServerManager.__new__(ServerManager)
+    server.logger = chat_manager.logger
+    server.channel = channel
+
+    slave.group.name = "Renamed"
+    carol = slave.group.add_member(uid="carol", name="Carol")
+    server.send_status(ChatUpdates(slave, modified_chats=["group"]))
+    assert chat_manager.search("Renamed")[0].uid == "group"
+    server.send_status(MemberUpdates(slave, "group", new_members=[carol.uid], removed_members=["alice"]))
+    assert db.get_slave_chat_info("fake.slave", "carol", "group") is not None
+    assert db.get_slave_chat_info("fake.slave", "alice", "group") is None
+
+    slave.chats.append(GroupChat(channel=slave, uid="new", name="New Group"))
+    server.send_status(ChatUpdates(slave, new_chats=["new"], removed_chats=["friend"]))
+    assert chat_manager.search("new group")[0].uid == "new"
+    assert chat_manager.search("friend") == []
+    assert ("fake.slave", "friend") in chat_manager.directory.tombstones
@@ -0,0 +1,183 @@
+# coding=utf-8
+
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from ehforwarderbot.chat import PrivateChat
+
+from efb_parabox_master.chat import ChatEntry
+from efb_parabox_master.chat_object_cache import ChatObjectCacheManager
+
+
+def keys(chats):
+    return [(i.module_id, i.uid) for i in chats]
+
+
+def test_search_by_name_alias_and_id(chat_manager):
+    assert keys(chat_manager.search("friend")) == [("fake.slave", "friend")]
+    assert keys(chat_manager.search("GRO")) == [("fake.slave", "group")]
+    assert keys(chat_manager.search("Bobby")) == []
+    assert len(chat_manager.search("i", limit=1)) == 1
+    assert chat_manager.search("friend", module_id="other.slave") == []
+
+
+def test_search_by_regex_matches_every_field(chat_manager):
+    assert keys(chat_manager.search(re.compile(r"^Type: Group$", re.M))) == [("fake.slave", "group")]
+
+
+def test_evicted_chats_leave_the_index(channel, chat_manager):
+    channel.config["chat_cache_size"] = 1
+    chat_manager.apply_config(channel.config)
+    assert len(chat_manager.search_index) == len(chat_manager.cache) == 1
+    assert chat_manager.search("friend") == []
+
+    # Looked up again, from the database
+    chat_manager.get_chat("fake.slave", "friend")
+    assert keys(chat_manager.search("friend")) == [("fake.slave", "friend")]
+    assert chat_manager.search("group") == []
+
+
+def test_deleted_chats_leave_the_index(chat_manager):
+    chat_manager.delete_chat_object("fake.slave", "friend")
+    assert chat_manager.search("friend") == []
+
+
+@pytest.mark.parametrize("pattern, found", [("FRIEND", True), ("private", True), ("ALL", True), ("nobody", False)])
+def test_match_string_without_regex(chat_manager, pattern, found):
+    assert chat_manager.get_chat("fake.slave", "friend").match(pattern) is found
+
+
+def test_group_members_round_trip_through_database(channel, chat_manager, db):
+    # Evict the group from cache, so that it is loaded from database
+    channel.config["chat_cache_size"] = 1
+    chat_manager.apply_config(channel.config)
+    chat_manager.get_chat("fake.slave", "friend")
+    assert ("fake.slave", "group") not in chat_manager.cache
+
+    group = chat_manager.get_chat("fake.slave", "group")
+    assert chat_manager.counters["db_hit"] == 2
+    bob = group.get_member("bob")
+    assert (bob.uid, bob.name, bob.alias) == ("bob", "Bob", "Bobby")
+    assert group.get_member("alice").name == "Alice"
+    with pytest.raises(KeyError):
+        group.get_member("carol")
+
+
+def test_deleted_chats_leave_the_database(chat_manager, db):
+    chat_manager.delete_chat_object("fake.slave", "group")
+    assert db.get_slave_chat_info("fake.slave", "group") is None
+    assert db.get_slave_chat_info("fake.slave", "alice", "group") is None
+
+
+def test_chats_gone_from_slave_channel_removed_on_restart(channel, chat_manager, slave, db):
+    chat_manager.save_snapshot()
+    slave.chats.remove(slave.group)
+    channel.config["chat_snapshot"] = True
+    restarted = ChatObjectCacheManager(channel)
+    assert restarted.ready.wait(5)
+    assert restarted.search("group") == []
+    # Wait for deletes queued to the writer
+    db.delete_slave_chat_info("fake.slave", "nobody")
+    assert db.get_slave_chat_info("fake.slave", "group") is None
+    assert db.get_slave_chat_info("fake.slave", "alice", "group") is None
+    assert db.get_slave_chat_info("fake.slave", "friend") is not None
+
+
+def test_least_recently_used_chat_evicted(channel, chat_manager):
+    chat_manager.get_chat("fake.slave", "friend")
+    channel.config["chat_cache_size"] = 1
+    chat_manager.apply_config(channel.config)
+    assert list(chat_manager.cache) == [("fake.slave", "friend")]
+    stats = chat_manager.stats()
+    assert (stats["size"], stats["eviction"]) == (1, 1)
+
+
+def test_chats_not_found_remembered(chat_manager, slave, monkeypatch):
+    lookups = []
+    get_chat = slave.get_chat
+    monkeypatch.setattr(slave, "get_chat", lambda uid: lookups.append(uid) or get_chat(uid))
+    assert chat_manager.get_chat("fake.slave", "nobody") is None
+    assert chat_manager.get_chat("fake.slave", "nobody", build_dummy=True).uid == "nobody"
+    assert lookups == ["nobody"]
+    stats = chat_manager.stats()
+    assert (stats["not_found"], stats["negative_hit"], stats["negative_size"]) == (1, 1, 1)
+
+
+@pytest.mark.parametrize("cache_size", [0, 100])
+def test_negative_cache_bounded_on_its_own(channel, chat_manager, cache_size):
+    channel.config.update(chat_cache_size=cache_size, chat_negative_cache_size=2)
+    chat_manager.apply_config(channel.config)
+    for i in range(5):
+        chat_manager.get_chat("fake.slave", f"nobody{i}")
+    assert list(chat_manager.negative) == [("fake.slave", "nobody3"), ("fake.slave", "nobody4")]
+
+
+def test_expired_chats_not_found_dropped(chat_manager):
+    chat_manager.negative[("fake.slave", "nobody0")] = (0.0, None)
+    chat_manager.get_chat("fake.slave", "nobody1")
+    assert list(chat_manager.negative) == [("fake.slave", "nobody1")]
+
+
+def test_negative_cache_disabled(channel, chat_manager):
+    channel.config["chat_negative_cache_size"] = 0
+    chat_manager.apply_config(channel.config)
+    chat_manager.get_chat("fake.slave", "nobody")
+    assert not chat_manager.negative
+
+
+def test_concurrent_misses_looked_up_once(chat_manager, slave, monkeypatch):
+    slave.chats.append(PrivateChat(channel=slave, uid="late", name="Late"))
+    lookups = []
+    get_chat = slave.get_chat
+
+    def slow_get_chat(uid):
+        lookups.append(uid)
+        time.sleep(0.1)
+        return get_chat(uid)
+
+    monkeypatch.setattr(slave, "get_chat", slow_get_chat)
+    start = threading.Barrier(16)
+
+    def look_up(_):
+        start.wait()
+        return chat_manager.get_chat("fake.slave", "late")
+
+    with ThreadPoolExecutor(16) as executor:
+        chats = list(executor.map(look_up, range(16)))
+    assert lookups == ["late"]
+    assert all(chat is chats[0] for chat in chats)
+
+
+def test_chats_iterated_while_enrolled(chat_manager, slave):
+    stop = threading.Event()
+
+    def enrol():
+        i = 0
+        while not stop.is_set():
+            chat_manager.compound_enrol(PrivateChat(channel=slave, uid=f"new{i}", name="New"))
+            i += 1
+
+    thread = threading.Thread(target=enrol)
+    thread.start()
+    try:
+        for _ in range(200):
+            assert {"friend", "group"} <= {chat.uid for chat in chat_manager.all_chats}
+    finally:
+        stop.set()
+        thread.join()
+
+
+def test_cache_keeps_entries_and_recent_chat_objects(channel, chat_manager):
+    assert all(isinstance(entry, ChatEntry) for entry in chat_manager.cache.values())
+    channel.config["chat_object_cache_size"] = 1
+    chat_manager.apply_config(channel.config)
+    friend = chat_manager.get_chat("fake.slave", "friend")
+    assert chat_manager.get_chat("fake.slave", "friend") is friend
+    chat_manager.get_chat("fake.slave", "group")
+    assert list(chat_manager.objects) == [("fake.slave", "group")]
+    # Built again from its entry
+    rebuilt = chat_manager.get_chat("fake.slave", "friend")
+    assert rebuilt is not friend and rebuilt.name == friend.name
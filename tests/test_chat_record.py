@@ -0,0 +1,80 @@
+# coding=utf-8
+
+import json
+import pickle
+
+import pytest
+from ehforwarderbot.chat import GroupChat, PrivateChat, SystemChat
+
+from efb_parabox_master.chat import ChatEntry, RECORD_VERSION, chat_record, convert_chat, load_chat, \
+    load_member, member_record
+from efb_parabox_master.db import SlaveChatInfo
+
+
+def fields(chat):
+    return (type(chat), chat.module_id, chat.module_name, chat.channel_emoji, chat.uid, chat.name, chat.alias,
+            chat.description, chat.notification, chat.has_self, chat.vendor_specific)
+
+
+@pytest.mark.parametrize("make", [
+    lambda slave: PrivateChat(channel=slave, uid="friend", name="Friend", alias="Pal", description="Met at work",
+                              vendor_specific={"is_mp": False}),
+    lambda slave: PrivateChat(channel=slave, uid="me", name="Me", other_is_self=True),
+    lambda slave: SystemChat(channel=slave, uid="system", name="System"),
+    lambda slave: GroupChat(channel=slave, uid="group", name="Group", alias="Team"),
+])
+def test_chat_round_trips_through_record(db, slave, make):
+    chat = convert_chat(db, make(slave))
+    loaded = load_chat(chat_record(chat), db)
+    assert fields(loaded) == fields(chat)
+    if isinstance(chat, PrivateChat):
+        assert (loaded.other is loaded.self) == (chat.other is chat.self)
+
+
+def test_record_leaves_out_members(db, slave):
+    record = json.loads(chat_record(convert_chat(db, slave.group)))
+    assert record[0] == RECORD_VERSION
+    assert "Alice" not in json.dumps(record)
+
+
+def test_vendor_specific_kept_only_as_json(db, slave):
+    chat = convert_chat(db, PrivateChat(channel=slave, uid="friend", name="Friend",
+                                        vendor_specific={"callback": object()}))
+    assert load_chat(chat_record(chat), db).vendor_specific == {}
+
+
+def test_member_round_trips_through_record(db, slave):
+    member = slave.group.get_member("bob")
+    group = convert_chat(db, GroupChat(channel=slave, uid="group", name="Group"))
+    loaded = load_member(member_record(member), group)
+    assert (loaded.uid, loaded.name, loaded.alias, loaded.chat) == ("bob", "Bob", "Bobby", group)
+
+
+@pytest.mark.parametrize("record", [
+    b"[]", b"[99, \"PrivateChat\"]", json.dumps([RECORD_VERSION, "PrivateChat", "too", "short"]).encode(),
+    json.dumps([RECORD_VERSION, "Channel"] + [None] * 11).encode(),
+])
+def test_unknown_or_malformed_record_rejected(record):
+    with pytest.raises(ValueError):
+        ChatEntry.from_record(record)
+
+
+def test_pickled_chat_replaced_by_record(db, slave, chat_manager):
+    legacy = convert_chat(db, GroupChat(channel=slave, uid="legacy", name="Legacy"))
+    legacy.add_member(uid="carol", name="Carol")
+    SlaveChatInfo.insert(slave_channel_id="fake.slave", slave_channel_emoji="F", slave_chat_uid="legacy",
+                         slave_chat_name="Legacy", slave_chat_type="GroupChat", pickle=pickle.dumps(legacy)).execute()
+
+    chat = chat_manager.get_chat("fake.slave", "legacy")
+    assert (chat.name, chat_manager.stats()["db_hit"]) == ("Legacy", 1)
+    row = db.get_slave_chat_info("fake.slave", "legacy")
+    assert load_chat(row.record, db).name == "Legacy"
+    assert load_member(db.get_slave_chat_info("fake.slave", "carol", "legacy").record, chat).name == "Carol"
+
+
+def test_entries_are_slotted_and_share_strings(db, slave):
+    first, second = (ChatEntry.from_chat(convert_chat(db, PrivateChat(
+        channel=slave, uid=uid, name=uid, vendor_specific={"is_mp": False}))) for uid in ("a", "b"))
+    assert not hasattr(first, "__dict__")
+    assert first.module_name is second.module_name
+    assert first.vendor_specific is second.vendor_specific
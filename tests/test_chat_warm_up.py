@@ -0,0 +1,113 @@
+# coding=utf-8
+
+import json
+import threading
+
+import pytest
+from ehforwarderbot import coordinator
+
+from efb_parabox_master.chat import ChatEntry
+from efb_parabox_master.chat_object_cache import ChatObjectCacheManager, SNAPSHOT_VERSION
+from .conftest import FakeSlave
+
+
+class OtherSlave(FakeSlave):
+    channel_id = "other.slave"
+
+
+@pytest.fixture
+def slaves(slave, monkeypatch):
+    """Two slave channels whose chats are only listed once released."""
+    other = OtherSlave()
+    monkeypatch.setitem(coordinator.slaves, other.channel_id, other)
+    release = threading.Event()
+    listing = threading.Barrier(3, timeout=5)
+    for i in (slave, other):
+        get_chats = i.get_chats
+
+        def blocked_get_chats(get_chats=get_chats):
+            listing.wait()
+            assert release.wait(5)
+            return get_chats()
+
+        monkeypatch.setattr(i, "get_chats", blocked_get_chats)
+    yield release, listing
+    release.set()
+
+
+@pytest.fixture
+def manager(channel, db):
+    channel.config["chat_snapshot"] = False
+    manager = ChatObjectCacheManager(channel)
+    yield manager
+    manager.ready.wait(5)
+
+
+def test_slave_channels_loaded_concurrently_in_background(slaves, manager):
+    release, listing = slaves
+    # Both slave channels are listing their chats at the same time, after the constructor returned.
+    listing.wait()
+    assert not manager.ready.is_set()
+    release.set()
+    assert manager.ready.wait(5)
+    assert {key[0] for key in manager.cache} == {"fake.slave", "other.slave"}
+
+
+def test_chats_looked_up_on_demand_before_ready(slaves, manager, slave):
+    release, listing = slaves
+    listing.wait()
+    assert manager.get_chat("fake.slave", "friend").name == "Friend"
+    assert manager.stats()["slave_hit"] == 1
+    slave.friend.name = "Renamed"
+    release.set()
+    assert manager.ready.wait(5)
+    # Not replaced by warm-up
+    assert manager.get_chat("fake.slave", "friend").name == "Friend"
+
+
+def test_failing_slave_channel_does_not_block_others(slave, db, channel, monkeypatch):
+    other = OtherSlave()
+    monkeypatch.setitem(coordinator.slaves, other.channel_id, other)
+    monkeypatch.setattr(slave, "get_chats", lambda: 1 / 0)
+    channel.config["chat_snapshot"] = False
+    manager = ChatObjectCacheManager(channel)
+    assert manager.ready.wait(5)
+    assert {key[0] for key in manager.cache} == {"other.slave"}
+
+
+@pytest.fixture
+def snapshot(channel, chat_manager):
+    """Chats of :class:`FakeSlave` saved to the snapshot, with snapshots enabled for restarts."""
+    channel.config["chat_snapshot"] = chat_manager.snapshot_enabled = True
+    chat_manager.stop()
+    return chat_manager.snapshot_path
+
+
+def test_restart_served_from_snapshot_before_slave_channels(snapshot, slaves, channel, slave):
+    release, listing = slaves
+    slave.friend.name = "Renamed"
+    manager = ChatObjectCacheManager(channel)
+    listing.wait()
+    assert manager.get_chat("fake.slave", "friend").name == "Friend"
+    assert manager.stats()["slave_hit"] == 0
+    release.set()
+    assert manager.ready.wait(5)
+    # Replaced by the chat reported by the slave channel
+    assert manager.get_chat("fake.slave", "friend").name == "Renamed"
+    assert not manager.stale
+
+
+def test_snapshot_written_on_stop(snapshot):
+    header, *records = snapshot.read_bytes().splitlines()
+    assert json.loads(header)["version"] == SNAPSHOT_VERSION
+    assert sorted(ChatEntry.from_record(i).uid for i in records) == ["friend", "group"]
+
+
+def test_snapshot_of_unknown_version_ignored(snapshot, slaves, channel):
+    release, listing = slaves
+    snapshot.write_bytes(b'{"version": 0}\n' + snapshot.read_bytes().split(b"\n", 1)[1])
+    manager = ChatObjectCacheManager(channel)
+    listing.wait()
+    assert not manager.cache
+    release.set()
+    assert manager.ready.wait(5)
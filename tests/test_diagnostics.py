@@ -0,0 +1,83 @@
+# coding=utf-8
+
+import sys
+import time
+import tracemalloc
+
+import pytest
+
+from efb_parabox_master import diagnostics
+from efb_parabox_master.diagnostics import DiagnosticsManager
+
+
+@pytest.fixture
+def manager(channel, metrics):
+    channel.config.update(admin_token="admin", profile_interval=0.001)
+    manager = DiagnosticsManager(channel)
+    yield manager
+    manager.stop()
+
+
+def handle(manager, action, **data):
+    return manager.handle(dict(data, token="admin", action=action))
+
+
+@pytest.mark.parametrize("token", [None, "", "wrong"])
+def test_incorrect_token_refused(manager, token):
+    with pytest.raises(PermissionError, match="token incorrect"):
+        manager.handle({"token": token, "action": "summary"})
+
+
+def test_refused_without_admin_token(manager):
+    manager.admin_token = None
+    with pytest.raises(PermissionError, match="disabled"):
+        handle(manager, "summary")
+
+
+def test_unknown_action_rejected(manager):
+    with pytest.raises(ValueError):
+        handle(manager, "reboot")
+
+
+def test_summary_reports_queues_and_caches(manager):
+    summary = handle(manager, "summary")
+    assert summary["outbound"] == {"queued": 1, "unconfirmed": 2, "unconfirmed_bytes": 4, "pending_acks": 3}
+    assert summary["chat_cache"]["size"] == 2
+    assert summary["process"]["threads"] > 1
+
+
+def test_cpu_profile_writes_stacks(manager):
+    assert handle(manager, "cpu_start")["interval"] == 0.001
+    with pytest.raises(ValueError):
+        handle(manager, "cpu_start")
+    time.sleep(0.1)
+    result = handle(manager, "cpu_stop", limit=5)
+    assert result["samples"] > 0
+    assert len(result["own"]) <= 5
+    with open(result["path"]) as f:
+        assert all(line.rsplit(" ", 1)[1].strip().isdigit() for line in f)
+    with pytest.raises(ValueError):
+        handle(manager, "cpu_stop")
+
+
+def test_memory_snapshots_report_growth(manager):
+    handle(manager, "memory_start")
+    assert "growth" not in handle(manager, "memory_snapshot")
+    data = [bytearray(1024) for _ in range(100)]
+    assert handle(manager, "memory_snapshot")["growth"]
+    assert handle(manager, "memory_stop")["peak_bytes"] >= len(data) * 1024
+    assert not tracemalloc.is_tracing()
+
+
+def test_max_rss_scaled_by_platform(monkeypatch):
+    resource = pytest.importorskip("resource")
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    monkeypatch.setattr(sys, "platform", "darwin")
+    assert max_rss <= diagnostics.get_max_rss() < max_rss * 1024
+    monkeypatch.setattr(sys, "platform", "linux")
+    assert diagnostics.get_max_rss() >= max_rss * 1024
+
+
+def test_max_rss_unavailable_without_resource(monkeypatch):
+    monkeypatch.setitem(sys.modules, "resource", None)
+    assert diagnostics.get_max_rss() is None
@@ -0,0 +1,127 @@
+# coding=utf-8
+
+import random
+import threading
+import time
+
+import pytest
+
+from efb_parabox_master.dispatcher import InboundDispatcher
+from efb_parabox_master.master_message import AckCode
+
+
+@pytest.fixture
+def dispatcher(channel, master, monkeypatch):
+    channel.config.update(dispatch_workers=4, dispatch_queue_size=1000)
+    dispatcher = InboundDispatcher(channel)
+    channel.dispatcher = dispatcher
+    processed = []
+    lock = threading.Lock()
+
+    def process(kind):
+        def record(param, *args):
+            time.sleep(random.random() / 1000)
+            with lock:
+                processed.append((kind, param.get('slaveOriginUid'), param['slaveMsgId'],
+                                  threading.current_thread().name))
+        return record
+
+    monkeypatch.setattr(master, "process_parabox_message_message", process("message"))
+    monkeypatch.setattr(master, "process_parabox_message_recall", process("recall"))
+    dispatcher.processed = processed
+    yield dispatcher
+    dispatcher.stop(time.monotonic() + 5)
+
+
+def message(chat, msg_id):
+    return {"slaveOriginUid": f"fake.slave {chat}", "slaveMsgId": msg_id, "content": {"type": 0, "text": ""}}
+
+
+def test_messages_to_a_chat_sent_in_order(dispatcher, slave):
+    chats = [f"chat{i}" for i in range(8)]
+    sent = {chat: [] for chat in chats}
+    for i in range(200):
+        chat = random.choice(chats)
+        sent[chat].append(f"m{i}")
+        assert dispatcher.submit(message(chat, f"m{i}"))
+    assert dispatcher.stop(time.monotonic() + 10)
+
+    assert len(dispatcher.processed) == 200
+    for chat in chats:
+        items = [i for i in dispatcher.processed if i[1] == f"fake.slave {chat}"]
+        assert [i[2] for i in items] == sent[chat]
+        assert len({i[3] for i in items}) <= 1
+    assert dispatcher.queued == {}
+
+
+def test_recall_processed_after_its_message(dispatcher, slave, master, msg_ids):
+    for i in range(50):
+        dispatcher.submit(message("chat", f"m{i}"))
+        dispatcher.submit_recall({"slaveMsgId": f"m{i}"})
+    assert dispatcher.stop(time.monotonic() + 10)
+
+    processed = [(i[0], i[2]) for i in dispatcher.processed]
+    for i in range(50):
+        assert processed.index(("message", f"m{i}")) < processed.index(("recall", f"m{i}"))
+
+
+def test_recall_of_sent_message_goes_to_its_chat(dispatcher, slave, msg_ids):
+    msg_ids.add("sent", "fake.slave chat", "s1")
+    dispatcher.submit_recall({"slaveMsgId": "sent"})
+    dispatcher.submit_recall({"slaveMsgId": "unknown"})
+    assert dispatcher.stop(time.monotonic() + 10)
+    assert sorted((i[0], i[2], i[3].startswith("EPMDispatch")) for i in dispatcher.processed) == \
+        [("recall", "sent", True), ("recall", "unknown", False)]
+
+
+def test_full_queue_rejected_and_drained_on_stop(dispatcher, slave, master):
+    dispatcher.workers = 1
+    dispatcher.queue_size = 2
+    blocked = threading.Event()
+    release = threading.Event()
+
+    def block(param, *args):
+        blocked.set()
+        release.wait(5)
+        dispatcher.processed.append(param['slaveMsgId'])
+
+    master.process_parabox_message_message = block
+    dispatcher.submit(message("chat", "m0"))
+    assert blocked.wait(5)
+    results = [dispatcher.submit(message("chat", f"m{i}")) for i in range(1, 4)]
+    assert results == [True, True, False]
+    assert master.channel.server_manager.acks[-1]["code"] == AckCode.REJECTED
+
+    start = time.monotonic()
+    assert not dispatcher.stop(time.monotonic() + 0.2)
+    assert time.monotonic() - start < 1
+    release.set()
+    assert dispatcher.lanes["fake.slave"].join(time.monotonic() + 5)
+    assert dispatcher.processed == ["m0", "m1", "m2"]
+
+
+def test_messages_expire_after_waiting_beyond_timeout(dispatcher, slave, master, channel):
+    channel.config["dispatch_timeouts"] = {"fake.slave": 0.05}
+    dispatcher.apply_config(channel.config)
+    release = threading.Event()
+    started = threading.Event()
+
+    def block(param, *args):
+        started.set()
+        release.wait(5)
+        dispatcher.processed.append(param['slaveMsgId'])
+
+    master.process_parabox_message_message = block
+    dispatcher.submit(message("chat", "m0"))
+    assert started.wait(5)
+    dispatcher.submit(message("chat", "m1"))
+    dispatcher.submit_recall({"slaveMsgId": "m1"})
+    time.sleep(0.1)
+    release.set()
+    assert dispatcher.stop(time.monotonic() + 5)
+
+    assert dispatcher.processed == ["m0"]
+    acks = [(i["action"], i["slaveMsgId"], i["code"]) for i in master.channel.server_manager.acks]
+    assert acks == [("message", "m1", AckCode.EXPIRED), ("recall", "m1", AckCode.EXPIRED)]
+    assert dispatcher.lanes["fake.slave"].stats()["expired"] == 2
+    assert dispatcher.queued == {}
@@ -0,0 +1,83 @@
+# coding=utf-8
+
+import json
+
+import pytest
+
+from efb_parabox_master.frame_validator import FrameValidator, InvalidFrame, MAX_HEADER_SIZE
+
+
+@pytest.fixture
+def validator():
+    return FrameValidator(1024 * 1024)
+
+
+def message(content, **data):
+    return {"type": "message", "data": dict({"slaveOriginUid": "fake.slave friend", "slaveMsgId": "p1",
+                                             "content": content}, **data)}
+
+
+def binary(header, payload=b"media"):
+    header = header if isinstance(header, bytes) else json.dumps(header).encode()
+    return len(header).to_bytes(4, "big") + header + payload
+
+
+def rejected(validator, frame, parse=None):
+    with pytest.raises(InvalidFrame) as e:
+        (parse or validator.parse)(frame)
+    return e.value.frame_type
+
+
+def test_valid_frames_accepted(validator):
+    assert validator.parse(json.dumps(message({"type": 0, "text": "hi"})))["data"]["slaveMsgId"] == "p1"
+    assert validator.parse('{"type": "chat_sync"}') == {"type": "chat_sync"}
+    # Content types not known are left to be rejected as unsupported when sent
+    validator.parse(json.dumps(message({"type": 99})))
+    header, payload = validator.parse_binary(binary(message({"type": 1, "fileName": "a.jpg"})))
+    assert bytes(payload) == b"media"
+    assert validator.stats()["received"] == {"message": 3, "chat_sync": 1}
+
+
+@pytest.mark.parametrize("frame, frame_type", [
+    ("x" * (1024 * 1024 + 1), "oversized"),
+    ("{", "malformed"),
+    ("[]", "malformed"),
+    ('{"data": {}}', "malformed"),
+    ('{"type": 1}', "malformed"),
+    ('{"type": "unknown"}', "unknown"),
+    ('{"type": "response", "data": 1}', "response"),
+    ('{"type": "recall", "data": {}}', "recall"),
+    ('{"type": "recall"}', "recall"),
+    ('{"type": "chat_sync", "data": {"version": true}}', "chat_sync"),
+    ('{"type": "chat_search", "data": {"query": "a", "limit": "1"}}', "chat_search"),
+    ('{"type": "diagnostics", "data": {"action": "summary", "interval": "1"}}', "diagnostics"),
+    (json.dumps(message({"type": 0})), "message"),
+    (json.dumps(message({"type": 0, "text": 1})), "message"),
+    (json.dumps(message({"type": "0", "text": "hi"})), "message"),
+    (json.dumps(message({"type": 1, "fileName": "a.jpg"})), "message"),
+    (json.dumps(message({"type": 0, "text": "hi"}, slaveOriginUid="friend")), "message"),
+    (json.dumps(message({"type": 0, "text": "hi"}, slaveMsgId=1)), "message"),
+    (json.dumps(message([])), "message"),
+])
+def test_invalid_text_frames_rejected(validator, frame, frame_type):
+    assert rejected(validator, frame) == frame_type
+    assert validator.stats() == {"received": {}, "rejected": {frame_type: 1}}
+
+
+@pytest.mark.parametrize("frame, frame_type", [
+    (b"\0\0", "malformed"),
+    ((MAX_HEADER_SIZE + 1).to_bytes(4, "big") + b"{" * (MAX_HEADER_SIZE + 1), "malformed"),
+    ((100).to_bytes(4, "big") + b"{}", "malformed"),
+    (binary(b"{"), "malformed"),
+    (binary({"type": "recall", "data": {"slaveMsgId": "p1"}}), "malformed"),
+    (binary(message({"type": 1})), "message"),
+    (binary(message({"type": 1, "fileName": 1})), "message"),
+    (b"\0" * (1024 * 1024 + 1), "oversized"),
+])
+def test_invalid_binary_frames_rejected(validator, frame, frame_type):
+    assert rejected(validator, frame, validator.parse_binary) == frame_type
+
+
+def test_size_limit_follows_configuration(validator):
+    validator.max_size = 10
+    assert rejected(validator, '{"type": "refresh"}') == "oversized"
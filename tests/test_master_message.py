@@ -0,0 +1,157 @@
+# coding=utf-8
+
+import base64
+import binascii
+import os
+from types import SimpleNamespace
+
+import pytest
+from ehforwarderbot import coordinator
+from ehforwarderbot.status import MessageRemoval
+
+from efb_parabox_master import master_message
+from efb_parabox_master.master_message import AckCode
+
+
+def recall(master, msg_id):
+    master.process_parabox_message_recall({"slaveMsgId": msg_id})
+    return master.channel.server_manager.acks[-1]
+
+
+def test_recall_in_chat_of_mapping(master, msg_ids, slave):
+    msg_ids.add("p1", "fake.slave friend", "s1")
+    ack = recall(master, "p1")
+    assert (ack["action"], ack["code"], ack["sentMsgId"], ack["slaveOriginUid"]) == \
+        ("recall", AckCode.SENT, "s1", "fake.slave friend")
+    status, = slave.statuses
+    assert isinstance(status, MessageRemoval)
+    assert (status.message.uid, status.message.chat) == ("s1", slave.friend)
+
+
+def test_recall_to_group_member_in_group(master, msg_ids, slave):
+    msg_ids.add("p1", "fake.slave alice group", "s1")
+    assert recall(master, "p1")["code"] == AckCode.SENT
+    assert slave.statuses[0].message.chat == slave.group
+
+
+def test_recall_fails_without_mapping(master, slave):
+    ack = recall(master, "unknown")
+    assert (ack["code"], ack["sentMsgId"]) == (AckCode.MESSAGE_NOT_FOUND, None)
+    assert slave.statuses == []
+
+
+def test_recall_fails_when_chat_is_gone(master, msg_ids, slave):
+    msg_ids.add("p1", "fake.slave stranger", "s1")
+    assert recall(master, "p1")["code"] == AckCode.CHAT_NOT_FOUND
+    assert slave.statuses == []
+
+
+@pytest.mark.parametrize("wrap", [0, 76, 5])
+def test_decode_media_in_chunks_with_line_breaks(master, monkeypatch, wrap):
+    monkeypatch.setattr(master_message, "BASE64_CHUNK_SIZE", 8)
+    data = os.urandom(100)
+    b64 = base64.b64encode(data).decode()
+    if wrap:
+        b64 = "\r\n".join(b64[i:i + wrap] for i in range(0, len(b64), wrap))
+    with master.decode_media(b64, ".bin") as f:
+        assert f.read() == data
+        assert os.path.dirname(f.name) == str(master.media_path)
+
+
+def test_decode_media_rejects_truncated_base64(master):
+    with pytest.raises(binascii.Error):
+        master.decode_media(base64.b64encode(b"media").decode()[:-2], ".bin")
+
+
+def send(master, msg_id, text="hello"):
+    master.process_parabox_message_message(
+        {"slaveOriginUid": "fake.slave friend", "slaveMsgId": msg_id, "content": {"type": 0, "text": text}})
+    return master.channel.server_manager.acks[-1]
+
+
+def test_resent_message_without_slave_id_is_duplicate(master, msg_ids, slave, monkeypatch):
+    monkeypatch.setattr(coordinator, "master", master.channel, raising=False)
+    monkeypatch.setattr(slave, "send_message", lambda msg: slave.sent.append(msg))
+    ack = send(master, "p1")
+    assert (ack["code"], ack["sentMsgId"]) == (AckCode.SENT, None)
+    ack = send(master, "p1")
+    assert (ack["code"], ack["sentMsgId"]) == (AckCode.DUPLICATE, None)
+    assert len(slave.sent) == 1
+    # Changed content is sent again
+    assert send(master, "p1", "edited")["code"] == AckCode.SENT
+    assert len(slave.sent) == 2
+    assert recall(master, "p1")["code"] == AckCode.MESSAGE_NOT_FOUND
+
+
+def test_sent_message_acked_with_slave_id_and_time(master, slave, monkeypatch):
+    monkeypatch.setattr(coordinator, "master", master.channel, raising=False)
+    ack = send(master, "p1")
+    assert ack == {"action": "message", "slaveMsgId": "p1", "slaveOriginUid": "fake.slave friend",
+                   "sentMsgId": "slave_1", "code": AckCode.SENT, "msg": "sent", "time": ack["time"]}
+    assert ack["time"] >= 0
+    ack = send(master, "p1")
+    assert (ack["code"], ack["sentMsgId"]) == (AckCode.DUPLICATE, "slave_1")
+
+
+@pytest.mark.parametrize("destination, content_type, code", [
+    ("fake.slave friend", 2, AckCode.UNSUPPORTED),
+    ("other.slave friend", 0, AckCode.CHANNEL_NOT_FOUND),
+])
+def test_failed_message_acked_with_reason(master, slave, monkeypatch, destination, content_type, code):
+    monkeypatch.setattr(coordinator, "master", master.channel, raising=False)
+    content = {"type": content_type, "text": "", "fileName": "voice.mp3", "b64String": ""}
+    master.process_parabox_message_message({"slaveOriginUid": destination, "slaveMsgId": "p1", "content": content})
+    ack, = master.channel.server_manager.acks
+    assert (ack["code"], ack["msg"], ack["sentMsgId"]) == (code, code.name.lower(), None)
+    assert slave.sent == []
+
+
+@pytest.fixture
+def uploads(master, channel):
+    """Media of binary uploads handed to the dispatcher."""
+    received = []
+    channel.dispatcher = SimpleNamespace(submit=lambda param, media: received.append(media.read()))
+    return received
+
+
+def upload(master, chunk, offset, more=True):
+    master.process_parabox_binary({
+        "type": "message", "offset": offset, "more": more,
+        "data": {"slaveOriginUid": "fake.slave friend", "slaveMsgId": "p1",
+                 "content": {"type": 4, "fileName": "media.bin"}},
+    }, memoryview(chunk))
+
+
+def test_upload_in_chunks(master, uploads):
+    upload(master, b"abc", 0)
+    upload(master, b"def", 3)
+    upload(master, b"gh", 6, more=False)
+    assert uploads == [b"abcdefgh"]
+    assert not master.uploads
+
+
+def test_restarted_upload_replaces_partial_media(master, uploads):
+    upload(master, b"abc", 0)
+    upload(master, b"def", 3)
+    upload(master, b"abc", 0)
+    upload(master, b"def", 3)
+    upload(master, b"gh", 6, more=False)
+    assert uploads == [b"abcdefgh"]
+
+
+@pytest.mark.parametrize("offset", [2, 6])
+def test_upload_at_wrong_offset_fails(master, uploads, offset):
+    upload(master, b"abc", 0)
+    upload(master, b"def", offset)
+    assert master.channel.server_manager.acks[-1]["code"] == AckCode.FAILED
+    assert not master.uploads
+    upload(master, b"gh", 6, more=False)
+    assert uploads == []
+
+
+def test_upload_not_resumed_after_connection_closed(master, uploads):
+    upload(master, b"abc", 0)
+    master.drop_uploads()
+    upload(master, b"def", 3, more=False)
+    assert master.channel.server_manager.acks[-1]["code"] == AckCode.FAILED
+    assert uploads == []
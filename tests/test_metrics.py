@@ -0,0 +1,56 @@
+# coding=utf-8
+
+import asyncio
+import socket
+
+import pytest
+
+from efb_parabox_master.metrics import MetricsManager, LATENCY_BUCKETS
+
+
+def samples(text):
+    return dict(line.rsplit(" ", 1) for line in text.splitlines() if not line.startswith("#"))
+
+
+def test_render_counters_histograms_and_gauges(metrics, channel):
+    metrics.inc("inbound_messages", type="0", result="SENT")
+    metrics.inc("inbound_messages", 2, type="0", result="SENT")
+    metrics.inc("outbound_messages", type='say "hi"\n')
+    metrics.observe("queue_wait", 0.003)
+    metrics.observe("queue_wait", 100)
+    channel.server_manager.frames.parse('{"type": "refresh"}')
+    channel.dispatcher.get_lane("fake.slave")
+
+    text = metrics.render()
+    assert text.endswith("\n")
+    assert "# TYPE epm_inbound_messages_total counter" in text
+    assert "# HELP epm_stage_seconds Time taken by each stage of message processing." in text
+    values = samples(text)
+    assert values['epm_inbound_messages_total{result="SENT",type="0"}'] == "3"
+    assert values['epm_outbound_messages_total{type="say \\"hi\\"\\n"}'] == "1"
+    assert values['epm_stage_seconds_bucket{stage="queue_wait",le="0.0025"}'] == "0"
+    assert values['epm_stage_seconds_bucket{stage="queue_wait",le="0.005"}'] == "1"
+    assert values[f'epm_stage_seconds_bucket{{stage="queue_wait",le="{LATENCY_BUCKETS[-1]}"}}'] == "1"
+    assert values['epm_stage_seconds_bucket{stage="queue_wait",le="+Inf"}'] == "2"
+    assert values['epm_stage_seconds_count{stage="queue_wait"}'] == "2"
+    assert float(values['epm_stage_seconds_sum{stage="queue_wait"}']) == pytest.approx(100.003)
+    assert values['epm_clients'] == "1"
+    assert values['epm_outbound_queue'] == "1"
+    assert values['epm_unconfirmed_messages'] == "2"
+    assert values['epm_unconfirmed_bytes'] == "4"
+    assert values['epm_pending_acks'] == "3"
+    assert values['epm_inbound_queue{slave="fake.slave"}'] == "0"
+    assert values['epm_frames_received_total{type="refresh"}'] == "1"
+    assert values['epm_chat_cache_chats'] == "2"
+    assert 'epm_db_commit_seconds_count' in values
+
+
+def test_metrics_port_in_use_does_not_fail_start(channel, caplog):
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        sock.listen()
+        channel.config["metrics_port"] = sock.getsockname()[1]
+        channel.server_manager = None
+        metrics = MetricsManager(channel)
+        asyncio.run(metrics.start())
+    assert "Metrics are not served" in caplog.text
@@ -0,0 +1,105 @@
+# coding=utf-8
+
+import sqlite3
+import time
+
+from efb_parabox_master.db import DatabaseManager, MIGRATIONS, MsgIdMap, MsgJson, SlaveChatInfo, database
+
+LEGACY_SCHEMA = '''
+CREATE TABLE "slavechatinfo" ("id" INTEGER NOT NULL PRIMARY KEY, "slave_channel_id" TEXT NOT NULL,
+    "slave_channel_emoji" VARCHAR(255) NOT NULL, "slave_chat_uid" TEXT NOT NULL, "slave_chat_group_id" TEXT,
+    "slave_chat_name" TEXT NOT NULL, "slave_chat_alias" TEXT, "slave_chat_type" VARCHAR(255) NOT NULL,
+    "pickle" BLOB);
+CREATE TABLE "msgjson" ("uid" TEXT NOT NULL PRIMARY KEY, "json" TEXT NOT NULL, "tried" INTEGER NOT NULL);
+'''
+"""Schema of databases created before migrations were versioned."""
+
+
+def create_legacy(data_path, script: str):
+    data_path.mkdir(parents=True)
+    conn = sqlite3.connect(data_path / "pbdata.db")
+    conn.executescript(LEGACY_SCHEMA + script)
+    conn.commit()
+    conn.close()
+
+
+def columns(table: str):
+    return {i.name for i in database.get_columns(table)}
+
+
+def indexes(table: str):
+    return {tuple(i.columns) for i in database.get_indexes(table)}
+
+
+def test_new_database_is_created_at_latest_version(db):
+    assert database.user_version == len(MIGRATIONS)
+    assert MsgIdMap.table_exists()
+    assert db.incremental_vacuum
+
+
+def test_legacy_database_is_migrated(data_path, channel):
+    create_legacy(data_path, '''
+        INSERT INTO slavechatinfo VALUES (1, 'a', 'e', 'u1', NULL, 'old', NULL, 'PrivateChat', NULL),
+                                         (2, 'a', 'e', 'u1', NULL, 'new', NULL, 'PrivateChat', NULL),
+                                         (3, 'a', 'e', 'm1', 'g1', 'member', NULL, 'Member', NULL);
+        INSERT INTO msgjson VALUES ('x', '{}', 3);
+    ''')
+    before = int(time.time())
+    db = DatabaseManager(channel)
+    try:
+        assert database.user_version == len(MIGRATIONS)
+        assert {"last_try_timestamp", "next_attempt_at", "state", "created_at"} <= columns("msgjson")
+        assert "record" in columns("slavechatinfo")
+        assert ("slave_channel_id", "slave_chat_uid", "slave_chat_group_id") in indexes("slavechatinfo")
+        assert ("slave_channel_id", "slave_chat_group_id") in indexes("slavechatinfo")
+        assert "content_hash" in columns("msgidmap")
+
+        # Duplicate chats are merged into the latest one, and members are kept.
+        assert [(i.id, i.slave_chat_name, i.slave_chat_group_id) for i in SlaveChatInfo.select()] == \
+            [(2, "new", ""), (3, "member", "g1")]
+        assert db.get_slave_chat_info("a", "m1", "g1").slave_chat_name == "member"
+        assert [(i.uid, i.tried) for i in MsgJson.select()] == [("x", 3)]
+        # Not the first to expire in retention
+        assert MsgJson.get().created_at >= before
+    finally:
+        db.stop_worker()
+
+
+def test_legacy_database_is_converted_for_incremental_vacuum_later(data_path, channel):
+    create_legacy(data_path, "")
+    db = DatabaseManager(channel)
+    try:
+        # Not at startup, where a full VACUUM would hold it.
+        assert not db.incremental_vacuum
+        assert database.pragma("auto_vacuum") == 0
+        db.convert_auto_vacuum()
+        assert db.incremental_vacuum
+        assert database.pragma("auto_vacuum") == 2
+    finally:
+        db.stop_worker()
+
+
+def test_migrations_resume_from_recorded_version(data_path, channel):
+    create_legacy(data_path, '''
+        ALTER TABLE msgjson ADD COLUMN last_try_timestamp INTEGER NOT NULL DEFAULT 0;
+        ALTER TABLE msgjson ADD COLUMN next_attempt_at INTEGER NOT NULL DEFAULT 0;
+        ALTER TABLE msgjson ADD COLUMN state INTEGER NOT NULL DEFAULT 0;
+        ALTER TABLE msgjson ADD COLUMN created_at INTEGER NOT NULL DEFAULT 0;
+        PRAGMA user_version = 6;
+    ''')
+    # The record column of migration 3 is left out on purpose, to show it is not run again.
+    db = DatabaseManager(channel)
+    try:
+        assert database.user_version == len(MIGRATIONS)
+        assert "record" not in columns("slavechatinfo")
+        assert ("slave_channel_id", "slave_chat_group_id") in indexes("slavechatinfo")
+        assert "content_hash" in columns("msgidmap")
+    finally:
+        db.stop_worker()
+
+
+def test_migrated_database_is_not_migrated_again(data_path, channel, caplog):
+    DatabaseManager(channel).stop_worker()
+    with caplog.at_level("INFO", logger="efb_parabox_master.db"):
+        DatabaseManager(channel).stop_worker()
+    assert "migration" not in caplog.text
@@ -0,0 +1,46 @@
+# coding=utf-8
+
+from efb_parabox_master.db import MsgIdMap
+from efb_parabox_master.msg_id_cache import MessageIdCacheManager
+
+
+def test_mappings_written_on_flush(msg_ids):
+    msg_ids.add("p1", "fake.slave friend", "s1", "hash")
+    msg_ids.add("p2", "fake.slave group", "s2")
+    assert MsgIdMap.select().count() == 0
+    assert msg_ids.get_slave("p1").slave_msg_id == "s1"
+
+    msg_ids.flush()
+    assert msg_ids.pending == []
+    assert {(i.parabox_msg_id, i.slave_channel_id, i.slave_msg_id, i.content_hash) for i in MsgIdMap.select()} == \
+        {("p1", "fake.slave", "s1", "hash"), ("p2", "fake.slave", "s2", None)}
+
+
+def test_evicted_mappings_read_from_database(msg_ids):
+    msg_ids.cache_size = 1
+    msg_ids.add("p1", "fake.slave friend", "s1")
+    msg_ids.add("p2", "fake.slave friend", "s2")
+    msg_ids.flush()
+    assert list(msg_ids.by_parabox) == ["p2"]
+
+    assert msg_ids.get_slave("p1").slave_origin_uid == "fake.slave friend"
+    assert msg_ids.get_parabox("fake.slave", "s2").parabox_msg_id == "p2"
+    assert msg_ids.get_slave("unknown") is None
+
+
+def test_pending_mappings_flushed_on_stop(channel, msg_ids):
+    msg_ids.add("p1", "fake.slave friend", "s1")
+    msg_ids.stop()
+    assert MsgIdMap.get_by_id("p1").slave_msg_id == "s1"
+    assert MessageIdCacheManager(channel).get_slave("p1").slave_msg_id == "s1"
+
+
+def test_mappings_without_slave_id_only_found_from_parabox(msg_ids):
+    msg_ids.add("p1", "fake.slave friend", None, "hash")
+    assert msg_ids.get_slave("p1").content_hash == "hash"
+    assert msg_ids.by_slave == {}
+    msg_ids.flush()
+    msg_ids.by_parabox.clear()
+    assert msg_ids.get_slave("p1").slave_msg_id == ""
+    assert msg_ids.get_parabox("fake.slave", "") is None
+    assert msg_ids.by_slave == {}
@@ -0,0 +1,69 @@
+# coding=utf-8
+
+import time
+
+import pytest
+
+from efb_parabox_master import db as db_module
+from efb_parabox_master.constants import MsgState
+from efb_parabox_master.db import MsgJson
+
+
+@pytest.fixture(autouse=True, params=[True, False], ids=["returning", "select_update"])
+def returning(request, monkeypatch):
+    """Claim with UPDATE ... RETURNING, and as on SQLite older than 3.35."""
+    if request.param and not db_module.SQLITE_RETURNING:
+        pytest.skip("SQLite does not support RETURNING")
+    monkeypatch.setattr(db_module, "SQLITE_RETURNING", request.param)
+
+
+def test_first_retry_after_base_delay(db):
+    now = int(time.time())
+    db.add_msg_jsons([("a", "{}", now)])
+    assert db.take_all_msg_json() is None
+
+    MsgJson.update(next_attempt_at=now).execute()
+    claimed = db.take_all_msg_json()
+    assert [i.uid for i in claimed] == ["a"]
+    assert claimed[0].tried == 2
+    assert claimed[0].state == MsgState.PENDING
+
+
+def test_backoff_grows_with_jitter_and_is_capped(db):
+    db.retry_base_delay, db.retry_max_delay = 5, 60
+    now = int(time.time())
+    db.add_msg_jsons([("a", "{}", now)])
+    for tried in range(1, 8):
+        MsgJson.update(next_attempt_at=0).execute()
+        msg_json = db.take_all_msg_json()[0]
+        delay = min(60, 5 << tried)
+        assert now + delay // 2 <= msg_json.next_attempt_at <= int(time.time()) + delay // 2 + delay // 2 + 1
+
+
+def test_dead_letter_after_max_attempts(db):
+    db.retry_max_attempts = 3
+    db.add_msg_jsons([("a", "{}", 0)])
+    states = []
+    for _ in range(3):
+        MsgJson.update(next_attempt_at=0).where(MsgJson.state == MsgState.PENDING).execute()
+        claimed = db.take_all_msg_json()
+        states.append(claimed and claimed[0].state)
+    assert states == [MsgState.PENDING, MsgState.DEAD, None]
+
+    db.refresh_msg_json(include_dead=False)
+    assert db.take_all_msg_json() is None
+    db.refresh_msg_json()
+    assert [i.tried for i in db.take_all_msg_json()] == [1]
+
+
+def test_batch_is_limited_and_oldest_first(db):
+    db.add_msg_jsons([(f"m{i}", "{}", 1000 + i) for i in range(5)])
+    assert [i.uid for i in db.take_all_msg_json(limit=3)] == ["m0", "m1", "m2"]
+    assert [i.uid for i in db.take_all_msg_json()] == ["m3", "m4"]
+
+
+def test_pending_kept_until_deleted(db):
+    db.add_msg_jsons([("a", "1", 1), ("b", "2", 2)])
+    db.delete_msg_jsons(["a"])
+    assert db.get_pending_msg_json() == [("b", "2")]
+
@@ -0,0 +1,51 @@
+# coding=utf-8
+
+import threading
+
+import pytest
+
+from efb_parabox_master import ParaboxChannel
+
+
+class Manager:
+    def __init__(self):
+        self.applied = []
+
+    def apply_config(self, config):
+        self.applied.append(config)
+
+
+@pytest.fixture
+def parabox(data_path):
+    channel = ParaboxChannel.__new__(ParaboxChannel)
+    channel.logger = __import__("logging").getLogger(__name__)
+    channel.config_lock = threading.Lock()
+    for name in ("db", "retention", "chat_manager", "msg_ids", "slave_messages", "master_messages", "dispatcher",
+                 "server_manager", "tracing", "diagnostics"):
+        setattr(channel, name, Manager())
+    channel.config_path = data_path / "config.yaml"
+    channel.config_path.parent.mkdir(parents=True, exist_ok=True)
+    channel.config_path.write_text("host: 127.0.0.1\nport: 8000\ntoken: token\nretry_interval: 1\n")
+    channel.config = channel.load_config()
+    return channel
+
+
+def test_reload_applies_tunables_and_keeps_restart_settings(parabox):
+    parabox.config_path.write_text("host: 127.0.0.1\nport: 9000\ntoken: token\nretry_interval: 2.5\n")
+    assert parabox.reload_config() == (["retry_interval"], ["port"])
+    assert parabox.config["retry_interval"] == 2.5
+    assert parabox.config["port"] == 8000
+    assert parabox.db.applied == [parabox.config]
+
+
+@pytest.mark.parametrize("content", [
+    "host: 127.0.0.1\nport: 8000\ntoken: token\nretry_interval: fast\n",
+    "host: 127.0.0.1\nport: 8000\n",
+])
+def test_invalid_reload_keeps_running_configuration(parabox, content):
+    old = parabox.config
+    parabox.config_path.write_text(content)
+    with pytest.raises(ValueError):
+        parabox.reload_config()
+    assert parabox.config is old
+    assert parabox.db.applied == []
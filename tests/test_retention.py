@@ -0,0 +1,103 @@
+# coding=utf-8
+
+import os
+import time
+
+import pytest
+
+from efb_parabox_master import db as db_module
+from efb_parabox_master.db import MsgJson
+from efb_parabox_master.retention import RetentionManager
+
+
+@pytest.fixture(params=[True, False], ids=["returning", "select_delete"])
+def returning(request, monkeypatch):
+    """Delete with DELETE ... RETURNING, and as on SQLite older than 3.35."""
+    if request.param and not db_module.SQLITE_RETURNING:
+        pytest.skip("SQLite does not support RETURNING")
+    monkeypatch.setattr(db_module, "SQLITE_RETURNING", request.param)
+
+
+@pytest.fixture
+def retention(channel, db):
+    channel.config.update(msg_max_age=0, msg_max_count=0, msg_max_bytes=0, msg_id_max_age=0,
+                          media_max_age=0, media_max_count=0, media_max_bytes=0, media_inflight_window=0)
+    manager = RetentionManager(channel)
+    yield manager
+    manager.stop()
+
+
+def add_messages(db, sizes, created_at=None):
+    now = int(time.time())
+    db.add_msg_jsons([(f"m{i}", "x" * size, now if created_at is None else created_at + i)
+                      for i, size in enumerate(sizes)])
+
+
+def stored():
+    return [i.uid for i in MsgJson.select().order_by(MsgJson.created_at)]
+
+
+def test_messages_expire_by_age(retention, db, returning):
+    add_messages(db, [1, 1, 1], created_at=int(time.time()) - 100)
+    MsgJson.update(created_at=int(time.time())).where(MsgJson.uid == "m2").execute()
+    retention.msg_max_age = 50
+    assert retention.compact_msg_json() == (2, 2)
+    assert stored() == ["m2"]
+
+
+def test_messages_beyond_count_removed_oldest_first(retention, db, returning):
+    add_messages(db, [1] * 10, created_at=1000)
+    retention.msg_max_count, retention.batch_size = 4, 4
+    assert retention.compact_msg_json() == (6, 6)
+    assert stored() == ["m6", "m7", "m8", "m9"]
+
+
+def test_byte_limit_removes_by_row_size(retention, db, monkeypatch, returning):
+    add_messages(db, [100, 100, 100, 10, 10], created_at=1000)
+    retention.msg_max_bytes = 100
+    deletes = []
+    delete = db.delete_oldest_msg_json
+    monkeypatch.setattr(db, "delete_oldest_msg_json", lambda limit, **kwargs: deletes.append(limit) or
+                        delete(limit, **kwargs))
+    assert retention.compact_msg_json() == (3, 300)
+    # One batch sized to free enough, not one message per statement.
+    assert deletes == [3]
+    assert stored() == ["m3", "m4"]
+
+
+def test_messages_removed_in_batches(retention, db, monkeypatch, returning):
+    add_messages(db, [1] * 10, created_at=1000)
+    retention.msg_max_count, retention.batch_size = 2, 3
+    deletes = []
+    delete = db.delete_oldest_msg_json
+    monkeypatch.setattr(db, "delete_oldest_msg_json", lambda limit, **kwargs: deletes.append(limit) or
+                        delete(limit, **kwargs))
+    assert retention.compact_msg_json() == (8, 8)
+    assert deletes == [3, 3, 2]
+    assert stored() == ["m8", "m9"]
+
+
+def make_media(retention, name, size, age):
+    path = retention.media_path / name
+    path.write_bytes(b"x" * size)
+    mtime = time.time() - age
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+def test_media_beyond_limits_removed_oldest_first(retention):
+    for i in range(4):
+        make_media(retention, f"f{i}", 10, 1000 - i)
+    retention.media_max_count = 3
+    retention.media_max_bytes = 25
+    assert retention.compact_media() == (2, 20)
+    assert sorted(i.name for i in retention.media_path.iterdir()) == ["f2", "f3"]
+
+
+def test_media_in_flight_kept(retention):
+    make_media(retention, "old", 10, 1000)
+    make_media(retention, "recent", 10, 10)
+    retention.media_max_age = 5
+    retention.media_inflight_window = 60
+    assert retention.compact_media() == (1, 10)
+    assert [i.name for i in retention.media_path.iterdir()] == ["recent"]
@@ -0,0 +1,279 @@
+# coding=utf-8
+
+import asyncio
+import json
+import socket
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
+from types import SimpleNamespace
+
+import pytest
+import websockets
+
+from efb_parabox_master.diagnostics import DiagnosticsManager
+from efb_parabox_master.server import ServerManager
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture
+def server(channel, master, chat_manager):
+    """Websocket server listening on a free port, with configuration reloads recorded."""
+    channel.config.update(port=free_port(), admin_token="admin")
+    channel.started_at = time.perf_counter()
+    channel.startup_times = dict()
+    channel.slave_messages = SimpleNamespace(resend_pending=lambda: None)
+    channel.diagnostics = DiagnosticsManager(channel)
+    channel.reloads = []
+    channel.reload_config = lambda: channel.reloads.append(True) or ([], [])
+    manager = ServerManager(channel)
+    channel.server_manager = manager
+    for _ in range(500):
+        if "listening" in channel.startup_times:
+            break
+        time.sleep(0.01)
+    yield manager
+    manager.graceful_stop()
+
+
+def exchange(server, frames, token="token"):
+    """Connect with a token, send frames one by one, and collect replies
+    until the connection is closed."""
+
+    async def run():
+        replies = []
+        async with websockets.connect(f"ws://127.0.0.1:{server.port}") as websocket:
+            await websocket.send(token)
+            try:
+                replies.append(json.loads(await asyncio.wait_for(websocket.recv(), 5)))
+                for frame in frames:
+                    await websocket.send(json.dumps(frame))
+                    replies.append(json.loads(await asyncio.wait_for(websocket.recv(), 5)))
+            except websockets.ConnectionClosed:
+                pass
+        return replies
+
+    return asyncio.run(run())
+
+
+def codes(replies):
+    return [reply["data"]["code"] if reply["type"] == "code" else reply["type"] for reply in replies]
+
+
+def test_reload_config_with_admin_token(server, channel):
+    replies = exchange(server, [{"type": "reload_config", "data": {"token": "admin"}}])
+    assert codes(replies) == [4000, "reload_config"]
+    assert channel.reloads == [True]
+
+
+@pytest.mark.parametrize("data", [None, {}, {"token": "wrong"}])
+def test_reload_config_without_admin_token_refused(server, channel, data):
+    frame = {"type": "reload_config"} if data is None else {"type": "reload_config", "data": data}
+    replies = exchange(server, [frame])
+    assert codes(replies) == [4000, 1003]
+    assert "token incorrect" in replies[1]["data"]["msg"]
+    assert channel.reloads == []
+
+
+def test_reload_config_refused_when_admin_token_unset(server, channel):
+    channel.diagnostics.admin_token = None
+    replies = exchange(server, [{"type": "reload_config", "data": {"token": ""}}])
+    assert codes(replies) == [4000, 1003]
+    assert channel.reloads == []
+
+
+def test_wrong_token_closes_connection(server, channel):
+    replies = exchange(server, [{"type": "reload_config", "data": {"token": "admin"}}], token="wrong")
+    assert codes(replies) == [1000]
+    assert channel.reloads == []
+    assert not server.websocket_users
+
+
+class FakeWebsocket:
+    """Connection handing frames to :meth:`ServerManager.recv_user_msg` directly, recording replies."""
+
+    def __init__(self, frames):
+        self.frames = list(frames)
+        self.sent = []
+
+    async def recv(self):
+        if not self.frames:
+            raise websockets.ConnectionClosed(None, None)
+        return json.dumps(self.frames.pop(0))
+
+    async def send(self, text):
+        self.sent.append(json.loads(text))
+
+
+def receive(server, frames):
+    """Process frames from a connection that did not pass the token check."""
+    websocket = FakeWebsocket(frames)
+    future = asyncio.run_coroutine_threadsafe(server.recv_user_msg(websocket), server.loop)
+    with pytest.raises(websockets.ConnectionClosed):
+        future.result(5)
+    return websocket.sent
+
+
+def test_chat_sync_sends_directory(server):
+    replies = exchange(server, [{"type": "chat_sync"}])
+    assert codes(replies) == [4000, "chat_sync"]
+    assert {chat["name"] for chat in replies[1]["data"]["added"]} == {"Friend", "Group"}
+
+
+def test_chat_sync_refused_before_authentication(server):
+    assert codes(exchange(server, [{"type": "chat_sync"}], token="wrong")) == [1000]
+    replies = receive(server, [{"type": "chat_sync"}])
+    assert codes(replies) == [1000]
+    assert replies[0]["data"]["msg"] == "not authenticated"
+    assert not server.chat_sync_states
+
+
+def test_chat_search_finds_chats(server):
+    replies = exchange(server, [{"type": "chat_search", "data": {"query": "friend"}}])
+    assert codes(replies) == [4000, "chat_search"]
+    assert [chat["name"] for chat in replies[1]["data"]["results"]] == ["Friend"]
+
+
+def test_chat_search_refused_before_authentication(server):
+    frame = {"type": "chat_search", "data": {"query": "friend"}}
+    assert codes(exchange(server, [frame], token="wrong")) == [1000]
+    replies = receive(server, [frame])
+    assert codes(replies) == [1000]
+    assert replies[0]["data"]["msg"] == "not authenticated"
+
+
+def test_oversized_frame_closed_before_it_is_buffered(server, channel):
+    channel.config["frame_max_size"] = 1024
+    server.apply_config(channel.config)
+
+    async def run():
+        async with websockets.connect(f"ws://127.0.0.1:{server.port}", max_size=None) as websocket:
+            await websocket.send("token")
+            await websocket.recv()
+            await websocket.send(json.dumps({"type": "response", "data": "x" * 1024 * 1024}))
+            with pytest.raises(websockets.ConnectionClosed) as e:
+                await asyncio.wait_for(websocket.recv(), 5)
+            return e.value.rcvd.code
+
+    assert asyncio.run(run()) == 1009
+    assert server.frames.stats()["received"] == {}
+
+
+def test_acks_kept_until_connected_and_sent_in_batches(server, channel):
+    server.ack_batch_size = 2
+    for i in range(5):
+        server.send_ack({"slaveMsgId": f"p{i}"})
+
+    async def run():
+        async with websockets.connect(f"ws://127.0.0.1:{server.port}") as websocket:
+            await websocket.send("token")
+            frames = [json.loads(await asyncio.wait_for(websocket.recv(), 5)) for _ in range(4)]
+        return frames
+
+    code, *frames = asyncio.run(run())
+    assert code["data"]["code"] == 4000
+    assert [[ack["slaveMsgId"] for ack in frame["data"]] for frame in frames] == [["p0", "p1"], ["p2", "p3"], ["p4"]]
+    assert all(frame["type"] == "ack" for frame in frames)
+
+
+def test_oldest_acks_dropped_beyond_queue_size(channel, master, chat_manager):
+    channel.config["ack_queue_size"] = 2
+    channel.config["port"] = free_port()
+    channel.started_at, channel.startup_times = time.perf_counter(), dict()
+    manager = ServerManager(channel)
+    try:
+        for i in range(3):
+            manager.send_ack({"slaveMsgId": f"p{i}"})
+        assert [ack["slaveMsgId"] for ack in manager.acks] == ["p1", "p2"]
+    finally:
+        manager.graceful_stop()
+
+
+def test_messages_sent_from_other_threads_delivered(server):
+    async def run():
+        async with websockets.connect(f"ws://127.0.0.1:{server.port}") as websocket:
+            await websocket.send("token")
+            frames = [json.loads(await asyncio.wait_for(websocket.recv(), 5))]
+            for uid in ("m1", "m2"):
+                threading.Thread(target=server.send_message, args=({"uid": uid},)).start()
+                frames.append(json.loads(await asyncio.wait_for(websocket.recv(), 5)))
+        return frames
+
+    code, *frames = asyncio.run(run())
+    assert code["data"]["code"] == 4000
+    assert [(frame["type"], frame["data"]["uid"]) for frame in frames] == [("message", "m1"), ("message", "m2")]
+
+
+def test_loop_closed_after_stop(server):
+    server.graceful_stop()
+    assert not server.ws_thread.is_alive()
+    assert server.loop.is_closed()
+    # Messages queued late are kept, not sent to a closed loop.
+    server.send_message({"uid": "late"})
+    assert server.msg_temp.qsize() == 1
+
+
+def test_import_does_not_load_pillow():
+    code = "import sys, efb_parabox_master; assert 'PIL.Image' not in sys.modules"
+    subprocess.run([sys.executable, "-c", code], check=True)
+
+
+def test_graceful_stop_sends_queued_frames_before_closing(server):
+    connected = threading.Event()
+    received = []
+
+    async def run():
+        async with websockets.connect(f"ws://127.0.0.1:{server.port}") as websocket:
+            await websocket.send("token")
+            received.append(json.loads(await websocket.recv()))
+            connected.set()
+            try:
+                while True:
+                    received.append(json.loads(await asyncio.wait_for(websocket.recv(), 5)))
+            except websockets.ConnectionClosed as e:
+                return e.rcvd.code
+
+    client = ThreadPoolExecutor(1).submit(asyncio.run, run())
+    assert connected.wait(5)
+    server.sending_interval = 0.05
+    for i in range(5):
+        server.send_message({"uid": f"m{i}"})
+    server.send_ack({"slaveMsgId": "p0"})
+    server.graceful_stop(time.monotonic() + 5)
+
+    assert client.result(5) == 1001
+    assert [frame["data"]["uid"] for frame in received if frame["type"] == "message"] == [f"m{i}" for i in range(5)]
+    assert [frame["data"] for frame in received if frame["type"] == "ack"] == [[{"slaveMsgId": "p0"}]]
+    assert not server.ws_thread.is_alive()
+
+
+def test_graceful_stop_gives_up_at_deadline(server):
+    server.sending_interval = 10
+    connected = threading.Event()
+
+    async def run():
+        async with websockets.connect(f"ws://127.0.0.1:{server.port}") as websocket:
+            await websocket.send("token")
+            await websocket.recv()
+            connected.set()
+            with suppress(websockets.ConnectionClosed):
+                while True:
+                    await asyncio.wait_for(websocket.recv(), 5)
+
+    client = ThreadPoolExecutor(1).submit(asyncio.run, run())
+    assert connected.wait(5)
+    for i in range(3):
+        server.send_message({"uid": f"m{i}"})
+    start = time.monotonic()
+    server.graceful_stop(start + 0.2)
+    assert time.monotonic() - start < 2
+    assert not server.msg_temp.empty()
+    client.result(5)
@@ -0,0 +1,74 @@
+# coding=utf-8
+
+import pytest
+
+from efb_parabox_master.db import MsgJson
+from efb_parabox_master.metrics import MetricsManager
+from efb_parabox_master.slave_message import SlaveMessageProcessor
+from efb_parabox_master.tracing import TraceManager
+
+from .conftest import FakeServer
+
+
+@pytest.fixture
+def processor(channel, db):
+    channel.config["retry_interval"] = 3600
+    channel.metrics = MetricsManager(channel)
+    channel.tracing = TraceManager(channel)
+    channel.server_manager = FakeServer()
+    processor = SlaveMessageProcessor(channel)
+    yield processor
+    processor.save_pending()
+    channel.tracing.stop()
+
+
+def queue(processor, uid, json_str, sent_at=1):
+    with processor.lock:
+        processor._keep(uid, json_str)
+        processor.unstored.append((uid, sent_at))
+        processor._trim()
+
+
+def test_unconfirmed_messages_are_resent(processor, channel):
+    queue(processor, "a", "A")
+    queue(processor, "b", "B")
+    processor.resort_message("a")
+    processor.flush()
+    assert [i.uid for i in MsgJson.select()] == ["b"]
+
+    processor.retry()
+    assert channel.server_manager.sent == ["B"]
+
+
+def test_confirmed_after_claim_is_not_resent(processor, channel):
+    queue(processor, "a", "A")
+    processor.flush()
+    processor.resort_message("a")
+    processor.retry()
+    assert channel.server_manager.sent == []
+    assert MsgJson.select().count() == 0
+
+
+def test_pending_restored_on_start(processor, channel, db):
+    queue(processor, "a", "A", sent_at=2 ** 40)
+    processor.save_pending()
+
+    restored = SlaveMessageProcessor(channel)
+    assert restored.msg_temp == {"a": "A"}
+    restored.retry()
+    assert channel.server_manager.sent == ["A"]
+    restored.save_pending()
+
+
+def test_oldest_unconfirmed_dropped_beyond_limits(processor):
+    processor.max_count, processor.max_bytes = 3, 10
+    for i in range(4):
+        queue(processor, f"m{i}", "xx")
+    assert list(processor.msg_temp) == ["m1", "m2", "m3"]
+
+    queue(processor, "big", "x" * 7)
+    assert list(processor.msg_temp) == ["m3", "big"]
+    assert processor.msg_temp_bytes == 9
+
+    processor.flush()
+    assert [i.uid for i in MsgJson.select()] == ["m3", "big"]
@@ -0,0 +1,63 @@
+# coding=utf-8
+
+import logging
+
+import pytest
+
+from efb_parabox_master import ParaboxChannel
+
+
+class Recorder:
+    """Manager recording the order its stopping methods are called in."""
+
+    def __init__(self, name, calls, stopped=True):
+        self.name = name
+        self.calls = calls
+        self.stopped = stopped
+
+    def __getattr__(self, method):
+        def call(*args):
+            self.calls.append((self.name, method, *args))
+            return self.stopped if method == "stop" and self.name == "dispatcher" else 0
+
+        return call
+
+
+@pytest.fixture
+def parabox():
+    channel = ParaboxChannel.__new__(ParaboxChannel)
+    channel.logger = logging.getLogger(__name__)
+    channel.config = {"shutdown_timeout": 3}
+    channel.calls = []
+    for name in ("db", "retention", "chat_manager", "msg_ids", "slave_messages", "dispatcher", "server_manager",
+                 "tracing", "diagnostics"):
+        setattr(channel, name, Recorder(name, channel.calls))
+    return channel
+
+
+def test_queued_messages_sent_before_state_is_saved(parabox):
+    parabox.stop_polling()
+    assert [call[:2] for call in parabox.calls] == [
+        ("dispatcher", "stop"),
+        ("server_manager", "graceful_stop"),
+        ("slave_messages", "save_pending"),
+        ("tracing", "stop"),
+        ("diagnostics", "stop"),
+        ("retention", "stop"),
+        ("msg_ids", "stop"),
+        ("chat_manager", "stop"),
+        ("db", "stop_worker"),
+    ]
+
+
+def test_dispatcher_and_server_share_deadline(parabox):
+    parabox.stop_polling()
+    (_, _, dispatcher_deadline), (_, _, server_deadline) = parabox.calls[:2]
+    assert dispatcher_deadline == server_deadline
+
+
+def test_abandoned_messages_logged(parabox, caplog):
+    parabox.dispatcher.stopped = False
+    parabox.stop_polling()
+    assert "abandoned" in caplog.text
+    assert parabox.calls[-1][:2] == ("db", "stop_worker")
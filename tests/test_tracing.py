@@ -0,0 +1,77 @@
+# coding=utf-8
+
+import json
+import time
+
+import pytest
+
+from efb_parabox_master.tracing import TraceManager, RotatingFileExporter, NULL_TRACE, get_trace_path
+
+
+@pytest.fixture
+def tracing(channel):
+    channel.config["trace_sample_rate"] = 1
+    manager = TraceManager(channel)
+    yield manager
+    manager.stop()
+
+
+def exported(channel):
+    with open(get_trace_path(channel.channel_id)) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_trace_exported_with_spans_when_finished(channel, tracing):
+    trace = tracing.start("outbound", "m1", type="Text")
+    with trace.span("build_json"):
+        pass
+    assert tracing.get("outbound", "m1") is trace
+    tracing.finish("outbound", "m1", last_span="client_ack", result="sent")
+    tracing.stop()
+    record, = exported(channel)
+    assert (record["direction"], record["key"]) == ("outbound", "m1")
+    assert record["attrs"] == {"type": "Text", "result": "sent", "finished": True}
+    assert [span["name"] for span in record["spans"]] == ["build_json", "client_ack"]
+
+
+def test_open_traces_exported_unfinished_on_stop(channel, tracing):
+    tracing.start("inbound", "m1")
+    tracing.stop()
+    assert exported(channel)[0]["attrs"] == {"finished": False}
+
+
+def test_expired_traces_exported_unfinished(channel, tracing):
+    tracing.start("outbound", "m1", started_at=time.monotonic() - tracing.ack_timeout - 1)
+    tracing.start("outbound", "m2")
+    assert list(tracing.active) == [("outbound", "m2")]
+    tracing.finish("outbound", "m2")
+    tracing.stop()
+    assert [(i["key"], i["attrs"]["finished"]) for i in exported(channel)] == [("m1", False), ("m2", True)]
+
+
+def test_messages_not_sampled_without_exporter(channel):
+    manager = TraceManager(channel)
+    assert manager.start("outbound", "m1") is NULL_TRACE
+    assert manager.exporter is None
+    assert not get_trace_path(channel.channel_id).exists()
+    manager.stop()
+
+
+def test_exporter_created_when_enabled_on_reload(channel):
+    manager = TraceManager(channel)
+    channel.config["trace_sample_rate"] = 1
+    manager.apply_config(channel.config)
+    manager.start("outbound", "m1")
+    manager.finish("outbound", "m1")
+    manager.stop()
+    assert [i["key"] for i in exported(channel)] == ["m1"]
+
+
+def test_trace_file_rotated_by_size(tmp_path):
+    path = tmp_path / "traces.jsonl"
+    exporter = RotatingFileExporter(path, max_bytes=100, backups=2)
+    for i in range(10):
+        exporter.export({"key": i, "padding": "x" * 40})
+    exporter.close()
+    assert sorted(i.name for i in tmp_path.iterdir()) == ["traces.jsonl", "traces.jsonl.1", "traces.jsonl.2"]
+    assert json.loads(path.read_text().splitlines()[-1])["key"] == 9